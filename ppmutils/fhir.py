@@ -1,19 +1,37 @@
+import asyncio
+import bisect
 import collections
+import collections.abc
+import contextvars
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import math
 import json as libjson
 import warnings
 import uuid
 import re
 import base64
+import http
 import string
 import os
+import queue
+import random
+import time
 import traceback
+import threading
+import weakref
+import urllib.parse
 from abc import ABC, abstractmethod
-from typing import Optional, Union, Any, Literal, Callable, TypeAlias
+from email.utils import parsedate_to_datetime
+from typing import Optional, Union, Any, Literal, Callable, TypeAlias, Generator
 from typing_extensions import Self
-from datetime import datetime, date, timezone
+from datetime import datetime, date, timezone, timedelta
 
 import boto3
 import requests
+from requests.adapters import HTTPAdapter
 from furl import furl, Query
 from dateutil.parser import parse
 from dateutil.tz import tz
@@ -22,6 +40,7 @@ from google.auth.transport import requests as google_requests
 from requests_auth_aws_sigv4 import AWSSigV4
 from django.utils.safestring import mark_safe
 from django.conf import settings
+from django.core.cache import caches
 from fhirclient.models.domainresource import DomainResource
 from fhirclient.models.fhirdate import FHIRDate
 from fhirclient.models.period import Period
@@ -40,7 +59,7 @@ from fhirclient.models.codeableconcept import CodeableConcept
 from fhirclient.models.coding import Coding
 from fhirclient.models.communication import Communication
 from fhirclient.models.resource import Resource
-from fhirclient.models.questionnaire import Questionnaire, QuestionnaireItem
+from fhirclient.models.questionnaire import Questionnaire, QuestionnaireItem, QuestionnaireItemEnableWhen
 from fhirclient.models.questionnaireresponse import QuestionnaireResponse
 from fhirclient.models.humanname import HumanName
 from fhirclient.models.relatedperson import RelatedPerson
@@ -68,182 +87,4216 @@ HttpMethod: TypeAlias = Literal["get", "post", "put", "patch", "delete", "head"]
 PPM_GCP_CREDENTIALS_KEY = "PPM_GCP_HEALTHCARE_CREDENTIALS"
 
 
+def _setting(name: str, default: Any = None) -> Any:
+    """
+    Returns the value of the Django setting if Django is configured and the
+    setting is defined, otherwise the default is returned.
+
+    :param name: The name of the setting
+    :type name: str
+    :param default: The value to return if the setting is not set
+    :type default: Any, defaults to None
+    :return: The setting's value
+    :rtype: Any
+    """
+    if not settings.configured:
+        return default
+
+    return getattr(settings, name, default)
+
+
+class RetryPolicy(object):
+    """
+    Determines whether and when a failed FHIR request is retried. Transient
+    responses (throttling and gateway errors) and connection errors are
+    retried with full-jitter exponential backoff, honoring `Retry-After`
+    when the server sends it, until either the maximum number of attempts
+    or the per-call deadline is reached. Each attempt's timeout is limited
+    to the time left before the deadline. Only requests that are safe to
+    repeat are retried: idempotent methods, POST searches, conditional
+    creates and conditional patches.
+    """
+
+    # Statuses that indicate a transient failure
+    RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+    # Methods that may be repeated without side effects
+    IDEMPOTENT_METHODS = frozenset({"get", "head", "options", "put", "delete"})
+
+    # Headers that make a request safe to repeat, by method
+    CONDITIONAL_HEADERS = {
+        "post": frozenset({"if-none-exist"}),
+        "put": frozenset({"if-match"}),
+        "patch": frozenset({"if-match"}),
+    }
+
+    # Defaults
+    MAX_ATTEMPTS = 4
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30.0
+    DEADLINE = 60.0
+
+    # The shortest timeout given to an attempt
+    MIN_TIMEOUT = 1.0
+
+    def __init__(
+        self,
+        max_attempts: int = None,
+        backoff_base: float = None,
+        backoff_max: float = None,
+        deadline: float = None,
+    ):
+        """
+        :param max_attempts: The maximum number of attempts per request
+        :type max_attempts: int, defaults to None
+        :param backoff_base: The delay in seconds before the first retry
+        :type backoff_base: float, defaults to None
+        :param backoff_max: The maximum delay in seconds between retries
+        :type backoff_max: float, defaults to None
+        :param deadline: The maximum number of seconds to spend on a request
+        :type deadline: float, defaults to None
+        """
+        self.max_attempts = max_attempts or _setting("FHIR_RETRY_MAX_ATTEMPTS", self.MAX_ATTEMPTS)
+        self.backoff_base = backoff_base or _setting("FHIR_RETRY_BACKOFF_BASE", self.BACKOFF_BASE)
+        self.backoff_max = backoff_max or _setting("FHIR_RETRY_BACKOFF_MAX", self.BACKOFF_MAX)
+        self.deadline = deadline or _setting("FHIR_RETRY_DEADLINE", self.DEADLINE)
+
+    def is_retryable(self, method: HttpMethod, url: str, headers: dict = None) -> bool:
+        """
+        Returns whether the request can safely be sent more than once.
+
+        :param method: The HTTP method of the request
+        :type method: HttpMethod
+        :param url: The URL of the request
+        :type url: str
+        :param headers: The headers of the request
+        :type headers: dict, defaults to None
+        :return: Whether the request may be retried
+        :rtype: bool
+        """
+        method = method.lower()
+        if method in self.IDEMPOTENT_METHODS:
+            return True
+
+        # Searches via POST do not modify anything
+        if method == "post" and furl(url).path.segments[-1:] == ["_search"]:
+            return True
+
+        # Conditional requests are only applied once
+        conditional = self.CONDITIONAL_HEADERS.get(method, frozenset())
+        return any(header.lower() in conditional for header in (headers or {}))
+
+    def timeout(self, deadline: float, timeout: Union[float, tuple] = None) -> Union[float, tuple]:
+        """
+        Returns the timeout for the next attempt, limited to the time left
+        before the deadline.
+
+        :param deadline: The monotonic time by which the request must finish
+        :type deadline: float
+        :param timeout: The timeout passed by the caller, if any
+        :type timeout: Union[float, tuple], defaults to None
+        :return: The timeout for the attempt
+        :rtype: Union[float, tuple]
+        """
+        remaining = max(self.MIN_TIMEOUT, deadline - time.monotonic())
+        if timeout is None:
+            return remaining
+        if type(timeout) is tuple:
+            return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+
+        return min(timeout, remaining)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Returns the delay before the next attempt using full jitter.
+
+        :param attempt: The number of attempts made so far
+        :type attempt: int
+        :return: The delay in seconds
+        :rtype: float
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+
+    def retry_after(self, response: requests.Response) -> Optional[float]:
+        """
+        Returns the delay requested by the server via the `Retry-After`
+        header, if any. Both delay-seconds and HTTP-date values are
+        supported.
+
+        :param response: The response to inspect
+        :type response: requests.Response
+        :return: The delay in seconds, if any
+        :rtype: Optional[float]
+        """
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            logger.debug(f"PPM/FHIR: Invalid Retry-After: {value}")
+
+        return None
+
+    def sleep(self, seconds: float):
+        """
+        Waits before the next attempt.
+
+        :param seconds: The number of seconds to wait
+        :type seconds: float
+        """
+        time.sleep(seconds)
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket. Tokens accrue at `rate` per second up to
+    `burst`. Callers that find the bucket empty reserve the next token and
+    sleep until it is due, so waiting callers are served in order without
+    polling.
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        """
+        :param rate: The number of requests allowed per second
+        :type rate: float
+        :param burst: The maximum number of requests allowed at once
+        :type burst: int, defaults to None
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, int(rate)))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token from the bucket and returns how long the caller must
+        wait before the token is available.
+
+        :return: The number of seconds to wait
+        :rtype: float
+        """
+        with self._lock:
+
+            # Add tokens accrued since the last call
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            # Take a token, going into debt if none are available
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self) -> float:
+        """
+        Blocks until a token is available.
+
+        :return: The number of seconds waited
+        :rtype: float
+        """
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+
+        return wait
+
+    def sleep(self, seconds: float):
+        """
+        Waits for a token.
+
+        :param seconds: The number of seconds to wait
+        :type seconds: float
+        """
+        time.sleep(seconds)
+
+
+class CacheTokenBucket(TokenBucket):
+    """
+    A token bucket shared by every process using the same Django cache.
+    Since the cache only offers atomic increments, the bucket is
+    approximated with fixed windows: each request increments the counter
+    for the current window and waits for the next window if the window's
+    budget has been spent. Windows last the shortest multiple of 1/rate
+    seconds that is at least one second, so each allows a whole number of
+    requests and the bucket honors fractional rates.
+    """
+
+    # The maximum number of windows to wait for before giving up on the limit
+    MAX_WINDOWS = 30
+
+    def __init__(self, rate: float, key: str, cache: Any = None, alias: str = "default"):
+        """
+        :param rate: The number of requests allowed per second
+        :type rate: float
+        :param key: The cache key prefix for this bucket
+        :type key: str
+        :param cache: The cache to use, defaults to the `alias` cache
+        :type cache: Any, defaults to None
+        :param alias: The alias of the Django cache to use
+        :type alias: str, defaults to "default"
+        """
+        super().__init__(rate)
+        self.key = key
+        self._cache = cache
+        self.alias = alias
+
+        # Size windows so that each allows a whole number of requests, at least one
+        self.budget = max(1, math.ceil(self.rate))
+        self.window = self.budget / self.rate
+
+    @property
+    def cache(self) -> Any:
+        """
+        Returns the Django cache used to share the bucket.
+
+        :return: The cache
+        :rtype: BaseCache
+        """
+        if self._cache is None:
+            self._cache = caches[self.alias]
+
+        return self._cache
+
+    def acquire(self) -> float:
+        """
+        Blocks until the current window has budget for the request.
+
+        :return: The number of seconds waited
+        :rtype: float
+        """
+        waited = 0.0
+        for _ in range(self.MAX_WINDOWS):
+
+            # Count this request against the current window
+            now = time.time()
+            key = f"{self.key}:{int(now // self.window)}"
+            self.cache.add(key, 0, timeout=int(self.window) + 5)
+            try:
+                count = self.cache.incr(key)
+            except ValueError:
+                # The window expired between add and incr
+                continue
+
+            if count <= self.budget:
+                return waited
+
+            # Wait for the next window
+            wait = self.window - (now % self.window)
+            self.sleep(wait)
+            waited += wait
+
+        logger.warning(f"PPM/FHIR: Rate limit '{self.key}' not acquired after {self.MAX_WINDOWS} windows")
+        return waited
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of requests made to the FHIR instance, with separate
+    budgets for reads (GET, HEAD and POST searches) and writes. A budget of
+    `None` disables limiting for that kind of request. When `shared` is
+    set, budgets are enforced across processes through the Django cache
+    instead of per process.
+
+    Budgets can be set via the Django settings `FHIR_RATE_LIMIT_READS`,
+    `FHIR_RATE_LIMIT_WRITES`, `FHIR_RATE_LIMIT_BURST`,
+    `FHIR_RATE_LIMIT_SHARED` and `FHIR_RATE_LIMIT_CACHE`.
+    """
+
+    # Methods that do not modify resources
+    READ_METHODS = frozenset({"get", "head", "options"})
+
+    # The prefix for shared bucket cache keys
+    CACHE_KEY_PREFIX = "ppm-fhir-rate-limit"
+
+    def __init__(
+        self,
+        read_rate: float = None,
+        write_rate: float = None,
+        burst: int = None,
+        shared: bool = None,
+        cache_alias: str = None,
+    ):
+        """
+        :param read_rate: The number of reads allowed per second
+        :type read_rate: float, defaults to None
+        :param write_rate: The number of writes allowed per second
+        :type write_rate: float, defaults to None
+        :param burst: The maximum number of requests of each kind at once
+        :type burst: int, defaults to None
+        :param shared: Whether to share budgets across processes
+        :type shared: bool, defaults to None
+        :param cache_alias: The alias of the Django cache for shared budgets
+        :type cache_alias: str, defaults to None
+        """
+        read_rate = read_rate or _setting("FHIR_RATE_LIMIT_READS")
+        write_rate = write_rate or _setting("FHIR_RATE_LIMIT_WRITES")
+        burst = burst or _setting("FHIR_RATE_LIMIT_BURST")
+        shared = shared if shared is not None else _setting("FHIR_RATE_LIMIT_SHARED", False)
+        cache_alias = cache_alias or _setting("FHIR_RATE_LIMIT_CACHE", "default")
+
+        def bucket(kind: str, rate: Optional[float]) -> Optional[TokenBucket]:
+            if not rate:
+                return None
+            if shared:
+                return CacheTokenBucket(rate, key=f"{self.CACHE_KEY_PREFIX}:{kind}", alias=cache_alias)
+            return TokenBucket(rate, burst=burst)
+
+        self.read_bucket = bucket("read", read_rate)
+        self.write_bucket = bucket("write", write_rate)
+
+    def is_read(self, method: HttpMethod, url: str) -> bool:
+        """
+        Returns whether the request only reads resources.
+
+        :param method: The HTTP method of the request
+        :type method: HttpMethod
+        :param url: The URL of the request
+        :type url: str
+        :return: Whether the request is a read
+        :rtype: bool
+        """
+        method = method.lower()
+        return method in self.READ_METHODS or (method == "post" and furl(url).path.segments[-1:] == ["_search"])
+
+    def acquire(self, method: HttpMethod, url: str) -> float:
+        """
+        Blocks until the request is allowed by the relevant budget.
+
+        :param method: The HTTP method of the request
+        :type method: HttpMethod
+        :param url: The URL of the request
+        :type url: str
+        :return: The number of seconds waited
+        :rtype: float
+        """
+        bucket = self.read_bucket if self.is_read(method, url) else self.write_bucket
+        return bucket.acquire() if bucket is not None else 0.0
+
+
+class RequestCoalescer(object):
+    """
+    Collapses identical concurrent calls into one. The first caller for a
+    key makes the call while any others that arrive before it completes
+    wait for, and share, its result or exception. Nothing is cached once
+    the call completes.
+    """
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: tuple, func: Callable[[], Any]) -> Any:
+        """
+        Runs the function for the key, or waits for the call already in
+        flight for the key.
+
+        :param key: The key identifying identical calls
+        :type key: tuple
+        :param func: The function to call
+        :type func: Callable[[], Any]
+        :raises Exception: Any exception raised by the function
+        :return: The return value of the function
+        :rtype: Any
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = RequestCoalescer.Call()
+            else:
+                call.waiters += 1
+
+        if leader:
+            try:
+                call.result = func()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+            if call.waiters:
+                logger.debug(f"PPM/FHIR: Shared request with {call.waiters} waiter(s): {key}")
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+
+class ConditionalReadCache(object):
+    """
+    A bounded, thread-safe store of response bodies keyed by request,
+    along with the entity tag they were served with. This allows a read to
+    be made with `If-None-Match` and served from the stored body when the
+    server responds with `304 Not Modified`. Bodies are stored as bytes
+    so every hit is parsed into a new dict that callers are free to modify.
+    """
+
+    # The default number of responses to keep
+    MAX_SIZE = 256
+
+    def __init__(self, max_size: int = None):
+        """
+        :param max_size: The maximum number of responses to keep
+        :type max_size: int, defaults to None
+        """
+        self.max_size = max_size or _setting("FHIR_CONDITIONAL_READ_CACHE_SIZE", self.MAX_SIZE)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def etag(response: requests.Response, resource: dict) -> Optional[str]:
+        """
+        Returns the entity tag for the response, falling back to a weak tag
+        built from the resource's version ID if the server did not send one.
+
+        :param response: The response for the resource
+        :type response: requests.Response
+        :param resource: The parsed resource
+        :type resource: dict
+        :return: The entity tag, if any
+        :rtype: Optional[str]
+        """
+        etag = response.headers.get("ETag")
+        if not etag and resource.get("meta", {}).get("versionId"):
+            etag = f'W/"{resource["meta"]["versionId"]}"'
+
+        return etag
+
+    def get(self, key: tuple) -> Optional[tuple[str, bytes]]:
+        """
+        Returns the entity tag and body stored for the key, if any.
+
+        :param key: The key of the request
+        :type key: tuple
+        :return: The entity tag and body
+        :rtype: Optional[tuple[str, bytes]]
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+            return entry
+
+    def set(self, key: tuple, etag: str, content: bytes):
+        """
+        Stores the entity tag and body for the key, evicting the least
+        recently used entry if the store is full.
+
+        :param key: The key of the request
+        :type key: tuple
+        :param etag: The entity tag of the response
+        :type etag: str
+        :param content: The body of the response
+        :type content: bytes
+        """
+        with self._lock:
+            self._entries[key] = (etag, content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all stored responses.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class ResourceCache(object):
+    """
+    A bounded, thread-safe, process-local cache of FHIR resources keyed by
+    `ResourceType/id`. Entries expire after `ttl` seconds and the least
+    recently used entry is evicted once `max_size` are stored. Resources are
+    stored as bytes so every hit is parsed into a new dict.
+
+    Every invalidation increments the cache's generation. Resources fetched
+    by a request are only stored if no invalidation happened while it was
+    in flight, so a read racing a write cannot store a stale resource.
+    """
+
+    # The default number of resources to keep and for how many seconds
+    MAX_SIZE = 1024
+    TTL = 60
+
+    def __init__(self, max_size: int = None, ttl: float = None):
+        """
+        :param max_size: The maximum number of resources to keep
+        :type max_size: int, defaults to None
+        :param ttl: The number of seconds to keep a resource
+        :type ttl: float, defaults to None
+        """
+        self.max_size = max_size or _setting("FHIR_RESOURCE_CACHE_SIZE", self.MAX_SIZE)
+        self.ttl = ttl or _setting("FHIR_RESOURCE_CACHE_TTL", self.TTL)
+        self._entries = collections.OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cacheable(resource: Any) -> bool:
+        """
+        Returns whether the resource can be cached. Resources without an ID
+        and those subsetted by `_elements` or `_summary` are not.
+
+        :param resource: The resource
+        :type resource: Any
+        :return: Whether to cache it
+        :rtype: bool
+        """
+        if not isinstance(resource, dict) or not resource.get("resourceType") or not resource.get("id"):
+            return False
+
+        return not any(t.get("code") == "SUBSETTED" for t in resource.get("meta", {}).get("tag", []))
+
+    @property
+    def generation(self) -> int:
+        """
+        Returns the number of invalidations made so far.
+
+        :return: The generation
+        :rtype: int
+        """
+        return self._generation
+
+    def get(self, resource_type: str, resource_id: str) -> Optional[dict]:
+        """
+        Returns the cached resource, if any.
+
+        :param resource_type: The resource type
+        :type resource_type: str
+        :param resource_id: The resource ID
+        :type resource_id: str
+        :return: A copy of the resource
+        :rtype: Optional[dict]
+        """
+        content = self._load(f"{resource_type}/{resource_id}")
+        return libjson.loads(content) if content is not None else None
+
+    def set_many(self, resources: list[dict], generation: int = None):
+        """
+        Caches the resources. If the generation at the time they were
+        requested is passed and the cache has been invalidated since,
+        they are not stored.
+
+        :param resources: The resources to cache
+        :type resources: list[dict]
+        :param generation: The generation when the resources were requested
+        :type generation: int, defaults to None
+        """
+        entries = {f"{r['resourceType']}/{r['id']}": libjson.dumps(r).encode() for r in resources if self.cacheable(r)}
+        if entries:
+            self._store(entries, generation)
+
+    def set(self, resource: dict, generation: int = None):
+        """
+        Caches the resource.
+
+        :param resource: The resource to cache
+        :type resource: dict
+        :param generation: The generation when the resource was requested
+        :type generation: int, defaults to None
+        """
+        self.set_many([resource], generation)
+
+    def set_bundle(self, bundle: dict, generation: int = None):
+        """
+        Caches each resource in the bundle.
+
+        :param bundle: The bundle of resources to cache
+        :type bundle: dict
+        :param generation: The generation when the bundle was requested
+        :type generation: int, defaults to None
+        """
+        self.set_many([e["resource"] for e in bundle.get("entry", []) if e.get("resource")], generation)
+
+    def invalidate(self, resource_type: str, resource_id: str = None):
+        """
+        Removes the resource from the cache, or every resource of the type
+        if no ID is passed.
+
+        :param resource_type: The resource type
+        :type resource_type: str
+        :param resource_id: The resource ID
+        :type resource_id: str, defaults to None
+        """
+        logger.debug(f"PPM/FHIR: Invalidating cached {resource_type}/{resource_id or '*'}")
+        with self._lock:
+            self._generation += 1
+            if resource_id:
+                self._entries.pop(f"{resource_type}/{resource_id}", None)
+            else:
+                for key in [k for k in self._entries if k.startswith(f"{resource_type}/")]:
+                    del self._entries[key]
+
+    def clear(self):
+        """
+        Removes all cached resources.
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _load(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            # Check expiration
+            expires, content = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return content
+
+    def _store(self, entries: dict[str, bytes], generation: Optional[int]):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+
+            expires = time.monotonic() + self.ttl
+            for key, content in entries.items():
+                self._entries[key] = (expires, content)
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class DjangoResourceCache(ResourceCache):
+    """
+    A resource cache stored in a Django cache so it is shared by every
+    process using it. Size is bounded by the Django cache itself. Since
+    Django caches cannot delete by prefix, keys include a version for the
+    whole cache and for each resource type, and clearing either increments
+    its version instead.
+    """
+
+    CACHE_KEY_PREFIX = "ppm-fhir-resource"
+
+    def __init__(self, ttl: float = None, cache: Any = None, alias: str = None):
+        """
+        :param ttl: The number of seconds to keep a resource
+        :type ttl: float, defaults to None
+        :param cache: The cache to use, defaults to the `alias` cache
+        :type cache: Any, defaults to None
+        :param alias: The alias of the Django cache to use
+        :type alias: str, defaults to None
+        """
+        super().__init__(ttl=ttl)
+        self._cache = cache
+        self.alias = alias or _setting("FHIR_RESOURCE_CACHE_ALIAS", "default")
+
+    @property
+    def cache(self) -> Any:
+        """
+        Returns the Django cache the resources are stored in.
+
+        :return: The cache
+        :rtype: BaseCache
+        """
+        if self._cache is None:
+            self._cache = caches[self.alias]
+
+        return self._cache
+
+    def _version_key(self, resource_type: str = None) -> str:
+        return f"{self.CACHE_KEY_PREFIX}:{resource_type or ''}:version"
+
+    def _keys(self, keys: list[str]) -> dict[str, str]:
+        # Get the current versions for the types of the keys
+        resource_types = {k.split("/", 1)[0] for k in keys}
+        versions = self.cache.get_many([self._version_key()] + [self._version_key(t) for t in resource_types])
+        version = versions.get(self._version_key(), 0)
+
+        return {
+            k: f"{self.CACHE_KEY_PREFIX}:{version}:{versions.get(self._version_key(k.split('/', 1)[0]), 0)}:{k}"
+            for k in keys
+        }
+
+    def _increment(self, version_key: str):
+        self.cache.add(version_key, 0, timeout=None)
+        self.cache.incr(version_key)
+
+    def invalidate(self, resource_type: str, resource_id: str = None):
+        logger.debug(f"PPM/FHIR: Invalidating cached {resource_type}/{resource_id or '*'}")
+        with self._lock:
+            self._generation += 1
+
+        if resource_id:
+            key = f"{resource_type}/{resource_id}"
+            self.cache.delete(self._keys([key])[key])
+        else:
+            self._increment(self._version_key(resource_type))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+
+        self._increment(self._version_key())
+
+    def _load(self, key: str) -> Optional[bytes]:
+        return self.cache.get(self._keys([key])[key])
+
+    def _store(self, entries: dict[str, bytes], generation: Optional[int]):
+        if generation is not None and generation != self._generation:
+            return
+
+        keys = self._keys(list(entries))
+        self.cache.set_many({keys[k]: v for k, v in entries.items()}, timeout=self.ttl)
+
+
+class ReferenceCache(ResourceCache):
+    """
+    A resource cache for the rarely changing resources that are shared by
+    every participant, e.g. Questionnaire and ResearchStudy resources.
+    Only resources of its types are stored, and they are kept much longer
+    than other resources. Writes made through `FHIR` still invalidate them.
+    """
+
+    # The default types of resources to keep, how many and for how many seconds
+    RESOURCE_TYPES = ("Questionnaire", "ResearchStudy", "Organization")
+    MAX_SIZE = 4096
+    TTL = 3600
+
+    def __init__(self, max_size: int = None, ttl: float = None, resource_types: list[str] = None):
+        """
+        :param max_size: The maximum number of resources to keep
+        :type max_size: int, defaults to None
+        :param ttl: The number of seconds to keep a resource
+        :type ttl: float, defaults to None
+        :param resource_types: The types of resources to keep
+        :type resource_types: list[str], defaults to None
+        """
+        super().__init__(
+            max_size=max_size or _setting("FHIR_REFERENCE_CACHE_SIZE", self.MAX_SIZE),
+            ttl=ttl or _setting("FHIR_REFERENCE_CACHE_TTL", self.TTL),
+        )
+        self.resource_types = tuple(resource_types or self.RESOURCE_TYPES)
+
+    def cacheable(self, resource: Any) -> bool:
+        return ResourceCache.cacheable(resource) and resource["resourceType"] in self.resource_types
+
+
+class ParticipantCache(object):
+    """
+    A bounded, thread-safe, process-local cache of the bundles returned by
+    `FHIR.get_participant`, keyed by the participant query. Each entry
+    tracks the Patient it belongs to and the resources it contains so that
+    any write made through `FHIR` that touches one of those resources, or
+    references the Patient, drops the participant's entries. Entries also
+    expire after `ttl` seconds to bound staleness from writes made
+    elsewhere, and may optionally be revalidated with a probe request.
+
+    Like `ResourceCache`, bundles fetched while an invalidation happened
+    are not stored.
+    """
+
+    # The default number of participants to keep and for how many seconds
+    MAX_SIZE = 256
+    TTL = 300
+
+    def __init__(self, max_size: int = None, ttl: float = None, probe: bool = None):
+        """
+        :param max_size: The maximum number of bundles to keep
+        :type max_size: int, defaults to None
+        :param ttl: The number of seconds to keep a bundle
+        :type ttl: float, defaults to None
+        :param probe: Whether to check FHIR for changes before using a bundle
+        :type probe: bool, defaults to None
+        """
+        self.max_size = max_size or _setting("FHIR_PARTICIPANT_CACHE_SIZE", self.MAX_SIZE)
+        self.ttl = ttl or _setting("FHIR_PARTICIPANT_CACHE_TTL", self.TTL)
+        self.probe = probe if probe is not None else bool(_setting("FHIR_PARTICIPANT_CACHE_PROBE", False))
+
+        # Bundles by key, the keys and resources for each Patient, and the Patients for each resource
+        self._entries = collections.OrderedDict()
+        self._patient_keys = collections.defaultdict(set)
+        self._patient_resources = collections.defaultdict(set)
+        self._resource_patients = collections.defaultdict(set)
+
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        """
+        Returns the number of invalidations made so far.
+
+        :return: The generation
+        :rtype: int
+        """
+        return self._generation
+
+    @staticmethod
+    def key(patient_query: dict) -> tuple:
+        """
+        Returns the cache key for a participant query.
+
+        :param patient_query: The query identifying the Patient
+        :type patient_query: dict
+        :return: The key
+        :rtype: tuple
+        """
+        return tuple(sorted((k, str(v)) for k, v in patient_query.items()))
+
+    def get(self, key: tuple) -> Optional[tuple[dict, str, Optional[str]]]:
+        """
+        Returns a copy of the cached bundle for the key, along with the ID
+        of its Patient and the latest `lastUpdated` of its resources.
+
+        :param key: The participant key
+        :type key: tuple
+        :return: The bundle, Patient ID and last update
+        :rtype: Optional[tuple[dict, str, Optional[str]]]
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            # Check expiration
+            expires, patient_id, last_updated, content = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+
+        return libjson.loads(content), patient_id, last_updated
+
+    def set(self, key: tuple, bundle: dict, generation: int = None):
+        """
+        Caches the participant's bundle. If the generation at the time it was
+        requested is passed and the cache has been invalidated since, it is
+        not stored.
+
+        :param key: The participant key
+        :type key: tuple
+        :param bundle: The participant's bundle
+        :type bundle: dict
+        :param generation: The generation when the bundle was requested
+        :type generation: int, defaults to None
+        """
+        resources = [e["resource"] for e in bundle.get("entry", []) if e.get("resource")]
+        patient_id = next((r["id"] for r in resources if r.get("resourceType") == "Patient"), None)
+        if not patient_id:
+            return
+
+        last_updated = max((r.get("meta", {}).get("lastUpdated", "") for r in resources), default="") or None
+        content = libjson.dumps(bundle).encode()
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+
+            self._entries[key] = (time.monotonic() + self.ttl, patient_id, last_updated, content)
+            self._entries.move_to_end(key)
+            self._patient_keys[patient_id].add(key)
+            for resource in resources:
+                resource_key = f"{resource['resourceType']}/{resource.get('id')}"
+                self._patient_resources[patient_id].add(resource_key)
+                self._resource_patients[resource_key].add(patient_id)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: tuple):
+        # Must be called while holding the lock
+        _, patient_id, _, _ = self._entries.pop(key)
+        keys = self._patient_keys[patient_id]
+        keys.discard(key)
+        if keys:
+            return
+
+        # Drop the Patient from the resource index once none of its bundles remain
+        del self._patient_keys[patient_id]
+        for resource_key in self._patient_resources.pop(patient_id, ()):
+            patients = self._resource_patients.get(resource_key)
+            if patients is not None:
+                patients.discard(patient_id)
+                if not patients:
+                    del self._resource_patients[resource_key]
+
+    def invalidate(self, patient_ids: list[str] = None, resources: list[tuple[str, Optional[str]]] = None):
+        """
+        Removes the bundles of the given Patients and of the Patients whose
+        bundles contain the given resources. A resource without an ID
+        removes every bundle.
+
+        :param patient_ids: The IDs of changed Patients
+        :type patient_ids: list[str], defaults to None
+        :param resources: The types and IDs of changed resources
+        :type resources: list[tuple[str, Optional[str]]], defaults to None
+        """
+        patient_ids = set(patient_ids or [])
+        with self._lock:
+            self._generation += 1
+            for resource_type, resource_id in resources or []:
+                if resource_id is None:
+                    self._clear()
+                    return
+                if resource_type == "Patient":
+                    patient_ids.add(resource_id)
+                patient_ids.update(self._resource_patients.get(f"{resource_type}/{resource_id}", ()))
+
+            for patient_id in patient_ids:
+                for key in list(self._patient_keys.get(patient_id, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """
+        Removes all cached bundles.
+        """
+        with self._lock:
+            self._generation += 1
+            self._clear()
+
+    def _clear(self):
+        # Must be called while holding the lock
+        self._entries.clear()
+        self._patient_keys.clear()
+        self._patient_resources.clear()
+        self._resource_patients.clear()
+
+
+# The resource type and page of a paged search that the current request is fetching
+_request_page = contextvars.ContextVar("ppm_fhir_request_page", default=(None, None))
+
+
+class RequestEvent(object):
+    """
+    Describes a single HTTP request made to the FHIR instance. Events are
+    passed to pre-request hooks before the request is sent, and again to
+    post-request hooks once it completes with the response details set.
+    """
+
+    __slots__ = ("method", "url", "resource_type", "page", "status", "latency", "size", "error")
+
+    def __init__(self, method: HttpMethod, url: str, resource_type: str = None, page: int = None):
+        """
+        :param method: The HTTP request type
+        :type method: HttpMethod
+        :param url: The URL of the request
+        :type url: str
+        :param resource_type: The resource type, if it cannot be determined from the URL
+        :type resource_type: str, defaults to None
+        :param page: The page number if fetching a page of search results
+        :type page: int, defaults to None
+        """
+        self.method = method.upper()
+        self.url = url
+        self.resource_type = RequestEvent.url_resource_type(url) or resource_type
+        self.page = page
+
+        # Set once the request completes
+        self.status = None
+        self.latency = None
+        self.size = None
+        self.error = None
+
+    @staticmethod
+    def url_resource_type(url: str) -> Optional[str]:
+        """
+        Returns the resource type a FHIR URL refers to, if any. Requests
+        to the base URL, e.g. batches and transactions, have no type.
+
+        :param url: The URL of the request
+        :type url: str
+        :return: The resource type
+        :rtype: Optional[str]
+        """
+        for segment in furl(url).path.segments:
+            if segment[:1].isupper() and segment.isalpha():
+                return segment
+
+        return None
+
+    def __repr__(self) -> str:
+        return (
+            f"RequestEvent({self.method} {self.resource_type or '/'}, page={self.page}, status={self.status}, "
+            f"latency={self.latency}, size={self.size})"
+        )
+
+
+class Instrumentation(object):
+    """
+    A registry of hooks that are called around every request `FHIR` makes.
+    Pre-request hooks receive the event before the request is sent, post-
+    request hooks receive it after, whether the request succeeded or not.
+    Exceptions raised by hooks are logged and never affect the request.
+    """
+
+    def __init__(self):
+        self._pre_hooks = []
+        self._post_hooks = []
+        self._lock = threading.Lock()
+
+    def add_pre_hook(self, hook: Callable[[RequestEvent], Any]):
+        """
+        Adds a hook to call before each request.
+
+        :param hook: The callable to pass each event to
+        :type hook: Callable[[RequestEvent], Any]
+        """
+        with self._lock:
+            self._pre_hooks = self._pre_hooks + [hook]
+
+    def add_post_hook(self, hook: Callable[[RequestEvent], Any]):
+        """
+        Adds a hook to call after each request.
+
+        :param hook: The callable to pass each event to
+        :type hook: Callable[[RequestEvent], Any]
+        """
+        with self._lock:
+            self._post_hooks = self._post_hooks + [hook]
+
+    def remove_hook(self, hook: Callable[[RequestEvent], Any]):
+        """
+        Removes a previously added hook.
+
+        :param hook: The hook to remove
+        :type hook: Callable[[RequestEvent], Any]
+        """
+        with self._lock:
+            self._pre_hooks = [h for h in self._pre_hooks if h is not hook]
+            self._post_hooks = [h for h in self._post_hooks if h is not hook]
+
+    def clear(self):
+        """
+        Removes all hooks.
+        """
+        with self._lock:
+            self._pre_hooks = []
+            self._post_hooks = []
+
+    @staticmethod
+    def _call(hooks: list[Callable[[RequestEvent], Any]], event: RequestEvent):
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                logger.exception(f"PPM/FHIR: Instrumentation hook error: {e}", exc_info=True, extra={"hook": hook})
+
+    def request(self, send: Callable[..., requests.Response], method: HttpMethod, url: str, **kwargs):
+        """
+        Makes the request with `send`, calling the hooks around it. If no
+        hooks are registered the request is made directly.
+
+        :param send: The callable that makes the request
+        :type send: Callable[..., requests.Response]
+        :param method: The HTTP request type
+        :type method: HttpMethod
+        :param url: The URL of the request
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        pre_hooks, post_hooks = self._pre_hooks, self._post_hooks
+        if not pre_hooks and not post_hooks:
+            return send(method, url=url, **kwargs)
+
+        resource_type, page = _request_page.get()
+        event = RequestEvent(method, url, resource_type=resource_type, page=page)
+        Instrumentation._call(pre_hooks, event)
+
+        start = time.perf_counter()
+        try:
+            response = send(method, url=url, **kwargs)
+            event.status = response.status_code
+            event.size = len(response.content or b"")
+            return response
+
+        except Exception as e:
+            event.error = e
+            raise
+
+        finally:
+            event.latency = time.perf_counter() - start
+            Instrumentation._call(post_hooks, event)
+
+
+class LatencyHistogram(object):
+    """
+    An in-process aggregator of request latencies and response sizes,
+    bucketed by method and resource type. Add it as a post-request hook:
+
+        FHIR.instrumentation.add_post_hook(LatencyHistogram())
+    """
+
+    # The upper bounds of the latency buckets, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: tuple[float, ...] = None):
+        """
+        :param buckets: The upper bounds of the latency buckets, in seconds
+        :type buckets: tuple[float, ...], defaults to None
+        """
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: RequestEvent):
+        self.observe(event)
+
+    def observe(self, event: RequestEvent):
+        """
+        Adds the event to the histogram.
+
+        :param event: The completed request event
+        :type event: RequestEvent
+        """
+        key = (event.method, event.resource_type)
+        bucket = bisect.bisect_left(self.buckets, event.latency)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    "count": 0,
+                    "errors": 0,
+                    "latency": 0.0,
+                    "bytes": 0,
+                    "buckets": [0] * (len(self.buckets) + 1),
+                }
+
+            series["count"] += 1
+            series["latency"] += event.latency
+            series["bytes"] += event.size or 0
+            series["buckets"][bucket] += 1
+            if event.error is not None or (event.status or 0) >= 400:
+                series["errors"] += 1
+
+    def percentile(self, percentile: float, method: str = None, resource_type: str = None) -> Optional[float]:
+        """
+        Returns the upper bound of the bucket the percentile of latency
+        falls in, for all requests or those matching the method and type.
+        Returns infinity if it falls beyond the largest bucket.
+
+        :param percentile: The percentile, between 0 and 100
+        :type percentile: float
+        :param method: The HTTP method to filter on
+        :type method: str, defaults to None
+        :param resource_type: The resource type to filter on
+        :type resource_type: str, defaults to None
+        :return: The latency in seconds, or None if there are no requests
+        :rtype: Optional[float]
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        with self._lock:
+            for (_method, _resource_type), series in self._series.items():
+                if method and _method != method.upper() or resource_type and _resource_type != resource_type:
+                    continue
+                counts = [a + b for a, b in zip(counts, series["buckets"])]
+
+        total = sum(counts)
+        if not total:
+            return None
+
+        # Find the first bucket that covers the percentile
+        threshold = total * percentile / 100.0
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if count and cumulative >= threshold:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+
+        return float("inf")
+
+    def snapshot(self) -> dict[tuple[str, Optional[str]], dict]:
+        """
+        Returns a copy of the aggregated series, keyed by method and
+        resource type.
+
+        :return: The count, error count, total latency and bytes, and bucket counts of each series
+        :rtype: dict[tuple[str, Optional[str]], dict]
+        """
+        with self._lock:
+            return {key: {**series, "buckets": list(series["buckets"])} for key, series in self._series.items()}
+
+    def reset(self):
+        """
+        Removes all aggregated requests.
+        """
+        with self._lock:
+            self._series.clear()
+
+
+class FHIRMetricsMiddleware(object):
+    """
+    A Django middleware that counts the FHIR requests made while handling
+    each request and logs them per view. Add it to `MIDDLEWARE` with:
+
+        "ppmutils.fhir.FHIRMetricsMiddleware"
+
+    The totals are also set on the request as `fhir_metrics`, and as the
+    `X-FHIR-Calls` response header if `FHIR_METRICS_HEADER` is enabled.
+    """
+
+    # The totals for the request being handled
+    _metrics = contextvars.ContextVar("ppm_fhir_metrics", default=None)
+    _hook_lock = threading.Lock()
+    _hooked = False
+
+    def __init__(self, get_response: Callable):
+        self.get_response = get_response
+
+        # Register the hook that updates the current request's totals once
+        with FHIRMetricsMiddleware._hook_lock:
+            if not FHIRMetricsMiddleware._hooked:
+                FHIR.instrumentation.add_post_hook(FHIRMetricsMiddleware.observe)
+                FHIRMetricsMiddleware._hooked = True
+
+    @staticmethod
+    def observe(event: RequestEvent):
+        """
+        Adds the completed FHIR request to the totals of the request
+        being handled, if any.
+
+        :param event: The completed request event
+        :type event: RequestEvent
+        """
+        metrics = FHIRMetricsMiddleware._metrics.get()
+        if metrics is not None:
+            with metrics["lock"]:
+                metrics["calls"] += 1
+                metrics["latency"] += event.latency
+                metrics["bytes"] += event.size or 0
+
+    def __call__(self, request):
+        metrics = {"calls": 0, "latency": 0.0, "bytes": 0, "lock": threading.Lock()}
+        token = FHIRMetricsMiddleware._metrics.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            FHIRMetricsMiddleware._metrics.reset(token)
+
+        # Report it
+        metrics.pop("lock")
+        request.fhir_metrics = metrics
+        if metrics["calls"]:
+            view = getattr(getattr(request, "resolver_match", None), "view_name", None) or request.path
+            logger.info(
+                f"PPM/FHIR: {view} made {metrics['calls']} FHIR requests in {metrics['latency']:.3f}s "
+                f"({metrics['bytes']} bytes)"
+            )
+        if _setting("FHIR_METRICS_HEADER", False):
+            response["X-FHIR-Calls"] = str(metrics["calls"])
+
+        return response
+
+
 class Backend(ABC):
+    """
+    The interface through which requests are made to a FHIR instance.
+    """
+
+    @classmethod
+    def instance(cls, url: str) -> Self:
+        """
+        This method inspects the current setting for FHIR URL and returns
+        an instance of the Backend class that is being used for FHIR.
+
+        :param url: The URL of the FHIR backend instance
+        :type url: str
+        :return: An instance of the concrete Backend class
+        :rtype: Backend
+        """
+        # Check for the in-memory server
+        if furl(url).scheme == LocalFHIR.SCHEME:
+            return LocalFHIR(url)
+
+        # Check for AWS
+        if "amazonaws.com" in url:
+            return AWSHealthlake()
+        elif "googleapis.com" in url:
+            return GCPHealthcareAPI()
+        elif "azurehealthcareapis.com" in url:
+            return AzureHealthcareAPI()
+        else:
+            return HAPIFHIR()
+
+    @abstractmethod
+    def request(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        Makes an HTTP request to the FHIR instance.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        pass
+
+    def close(self):
+        """
+        Releases any resources held by the backend.
+        """
+        pass
+
+
+class HTTPBackend(Backend):
+    """
+    A backend that sends requests over a pooled session, retrying transient
+    failures and limiting the rate of requests.
+    """
+
+    # Connection pool defaults, these can be overridden via Django settings
+    # `FHIR_POOL_CONNECTIONS`, `FHIR_POOL_MAXSIZE` and `FHIR_POOL_BLOCK`
+    POOL_CONNECTIONS = 10
+    POOL_MAXSIZE = 20
+    POOL_BLOCK = False
+
+    def __init__(
+        self,
+        pool_connections: int = None,
+        pool_maxsize: int = None,
+        pool_block: bool = None,
+        retry_policy: RetryPolicy = None,
+        rate_limiter: RateLimiter = None,
+    ):
+        """
+        Sets up the connection pool configuration for the backend. The
+        session itself is built lazily on first use and is then shared by
+        every request made through this backend.
+
+        :param pool_connections: The number of per-host pools to cache
+        :type pool_connections: int, defaults to None
+        :param pool_maxsize: The maximum number of connections kept per host
+        :type pool_maxsize: int, defaults to None
+        :param pool_block: Whether to block when a host's pool is exhausted
+        :type pool_block: bool, defaults to None
+        :param retry_policy: The policy for retrying failed requests
+        :type retry_policy: RetryPolicy, defaults to None
+        :param rate_limiter: The limiter for the rate of requests
+        :type rate_limiter: RateLimiter, defaults to None
+        """
+        self.pool_connections = (
+            pool_connections if pool_connections else _setting("FHIR_POOL_CONNECTIONS", self.POOL_CONNECTIONS)
+        )
+        self.pool_maxsize = pool_maxsize if pool_maxsize else _setting("FHIR_POOL_MAXSIZE", self.POOL_MAXSIZE)
+        self.pool_block = pool_block if pool_block is not None else _setting("FHIR_POOL_BLOCK", self.POOL_BLOCK)
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+
+        # The shared session is created on first access
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Returns the long-lived session for this backend. Connections are
+        kept alive and pooled per host so subsequent requests skip the
+        TCP and TLS handshakes.
+
+        :return: The pooled session
+        :rtype: requests.Session
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self.build_session()
+
+        return self._session
+
+    def build_session(self) -> requests.Session:
+        """
+        Builds the session used by this backend, mounting a pooled adapter
+        for both HTTP and HTTPS.
+
+        :return: A new session
+        :rtype: requests.Session
+        """
+        logger.debug(
+            f"PPM/FHIR: Creating session with pool connections: {self.pool_connections}, "
+            f"max size: {self.pool_maxsize}, block: {self.pool_block}"
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        return session
+
+    def close(self):
+        """
+        Closes the pooled session and all of its open connections. A new
+        session will be created if the backend is used again.
+        """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def request(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        Makes an HTTP request to the FHIR instance. Transient failures are
+        retried according to the backend's retry policy. If retries are
+        exhausted, the last response is returned or the last connection
+        error is raised.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        policy = self.retry_policy
+        retryable = policy.is_retryable(method, url, kwargs.get("headers"))
+        deadline = time.monotonic() + policy.deadline
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                # Wait for the rate limit, retries included
+                self.rate_limiter.acquire(method, url)
+
+                # Limit the attempt to the time left before the deadline
+                timeout = policy.timeout(deadline, kwargs.get("timeout"))
+                response = self.send(method, url, **{**kwargs, "timeout": timeout})
+
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not retryable or attempt >= policy.max_attempts:
+                    raise
+
+                # Back off and try again, unless we've run out of time
+                delay = policy.backoff(attempt)
+                if time.monotonic() + delay > deadline:
+                    raise
+
+                logger.warning(f"PPM/FHIR: {method.upper()} '{url}' failed with {e}, retrying in {delay:.2f}s")
+
+            else:
+                if not retryable or response.status_code not in policy.RETRY_STATUSES or attempt >= policy.max_attempts:
+                    return response
+
+                # Prefer the server's requested delay
+                delay = policy.retry_after(response)
+                if delay is None:
+                    delay = policy.backoff(attempt)
+                if time.monotonic() + delay > deadline:
+                    return response
+
+                logger.warning(
+                    f"PPM/FHIR: {method.upper()} '{url}' returned {response.status_code}, retrying in {delay:.2f}s"
+                )
+
+            policy.sleep(delay)
+
+    @abstractmethod
+    def send(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a single HTTP request to a FHIR instance.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        pass
+
+
+class LockedAWSSigV4(AWSSigV4):
+    """
+    An AWSSigV4 signer that can be shared between threads. The underlying
+    signer keeps the request date on the instance while signing, so
+    concurrent signing is serialized.
+    """
+
+    def __init__(self, service: str, **kwargs):
+        super().__init__(service, **kwargs)
+        self._lock = threading.Lock()
+
+    def __call__(self, r: requests.PreparedRequest) -> requests.PreparedRequest:
+        with self._lock:
+            return super().__call__(r)
+
+
+class AWSHealthlake(HTTPBackend):
+
+    SERVICE = "healthlake"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Boto3 sessions and signers are cached per region
+        self._boto_sessions = {}
+        self._signers = {}
+        self._signers_lock = threading.Lock()
+
+    @property
+    def region(self) -> str:
+        """
+        Returns the AWS region the Healthlake instance is in.
+
+        :return: The AWS region
+        :rtype: str
+        """
+        return os.environ.get("AWS_REGION", "us-east-1")
+
+    def signer(self, region: str) -> AWSSigV4:
+        """
+        Returns the cached SigV4 signer for the given region. Credentials
+        are resolved through boto3 once per region and the signer is only
+        rebuilt when boto3 hands back refreshed credentials, e.g. when
+        temporary role credentials near their expiry.
+
+        :param region: The AWS region to sign requests for
+        :type region: str
+        :return: The signer
+        :rtype: AWSSigV4
+        """
+        with self._signers_lock:
+
+            # Get the boto3 session for this region
+            session = self._boto_sessions.get(region)
+            if session is None:
+                logger.debug(f"PPM/FHIR/AWS: Creating boto3 session for region: {region}")
+                session = self._boto_sessions[region] = boto3.session.Session(region_name=region)
+
+            # Boto3 only refreshes temporary credentials when they are close to expiring
+            credentials = session.get_credentials().get_frozen_credentials()
+
+            # Rebuild the signer if credentials have changed
+            signer, signed_credentials = self._signers.get(region, (None, None))
+            if signer is None or signed_credentials != credentials:
+                logger.debug(f"PPM/FHIR/AWS: Creating SigV4 signer for region: {region}")
+                signer = LockedAWSSigV4(
+                    self.SERVICE,
+                    region=region,
+                    aws_access_key_id=credentials.access_key,
+                    aws_secret_access_key=credentials.secret_key,
+                    aws_session_token=credentials.token,
+                    session=session,
+                )
+                self._signers[region] = (signer, credentials)
+
+            return signer
+
+    def send(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        A generic method implementation for an HTTP GET to a Healthlake
+        FHIR instance.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        # Get the cached signer for the region
+        auth = self.signer(self.region)
+
+        # Make the request
+        return self.session.request(method=method, url=url, auth=auth, **kwargs)
+
+
+class GCPTokenProvider(object):
+    """
+    Provides OAuth2 bearer tokens for the GCP Healthcare API. Tokens are
+    held in memory and refreshed on a background thread once they are
+    within the refresh margin of expiring, so requests only block on a
+    refresh when there is no valid token at all. Only one refresh is ever
+    in flight at a time.
+    """
+
+    SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+    # The number of seconds before expiry at which a token is refreshed
+    REFRESH_MARGIN = 300
+
+    # The number of seconds to wait before retrying a failed background refresh
+    RETRY_INTERVAL = 30
+
+    def __init__(self, refresh_margin: int = None):
+        """
+        :param refresh_margin: The number of seconds before expiry to refresh
+        :type refresh_margin: int, defaults to None
+        """
+        if refresh_margin is None:
+            refresh_margin = _setting("FHIR_GCP_TOKEN_REFRESH_MARGIN", self.REFRESH_MARGIN)
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+
+        # Token and expiry are swapped together so readers never see a mix
+        self._state = (None, None)
+        self._credentials = None
+        self._retry_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def credentials(self) -> service_account.Credentials:
+        """
+        Returns the scoped service account credentials, loading them from
+        the environment on first use.
+
+        :return: The scoped credentials
+        :rtype: service_account.Credentials
+        """
+        if self._credentials is None:
+
+            # Check whether credentials are string or file
+            if os.environ[PPM_GCP_CREDENTIALS_KEY].startswith("/"):
+                logger.debug("PPM/FHIR: GCS credentials via file")
+                credentials = service_account.Credentials.from_service_account_file(os.environ[PPM_GCP_CREDENTIALS_KEY])
+            else:
+                # Gets credentials from the environment.
+                logger.debug("PPM/FHIR: GCS credentials via environment variable")
+                credentials = service_account.Credentials.from_service_account_info(
+                    libjson.loads(base64.b64decode(os.environ[PPM_GCP_CREDENTIALS_KEY].encode()).decode())
+                )
+
+            # Set scopes
+            self._credentials = credentials.with_scopes(self.SCOPES)
+
+        return self._credentials
+
+    @property
+    def token(self) -> str:
+        """
+        Returns a valid bearer token. If the current token is close to
+        expiring, a background refresh is started and the current token is
+        returned. If there is no valid token, this blocks until one is
+        fetched.
+
+        :return: The bearer token
+        :rtype: str
+        """
+        token, expiry = self._state
+        now = datetime.utcnow()
+
+        # Use the current token if it's valid
+        if token is not None and now < expiry:
+            if now >= expiry - self.refresh_margin and (self._retry_at is None or now >= self._retry_at):
+                self._refresh_in_background()
+
+            return token
+
+        # Wait for a refresh, unless another thread already completed one
+        with self._lock:
+            token, expiry = self._state
+            if token is None or datetime.utcnow() >= expiry:
+                token, expiry = self._refresh()
+
+            return token
+
+    def invalidate(self):
+        """
+        Discards the current token so the next request fetches a new one.
+        """
+        self._state = (None, None)
+
+    def _refresh(self) -> tuple[str, datetime]:
+        """
+        Fetches a new token. Must be called while holding the lock.
+
+        :return: The new token and its expiry
+        :rtype: tuple[str, datetime]
+        """
+        logger.debug("PPM/FHIR/GCP: Refreshing credentials")
+        credentials = self.credentials
+        credentials.refresh(google_requests.Request())
+
+        # Save the token and expiry
+        self._state = (credentials.token, credentials.expiry)
+        self._retry_at = None
+        logger.debug(f"PPM/FHIR/GCP: New token expiry: {credentials.expiry.isoformat()}")
+
+        return self._state
+
+    def _refresh_in_background(self):
+        """
+        Starts a refresh on a background thread if one is not already
+        in progress.
+        """
+        # If the lock is held, a refresh is already in flight
+        if not self._lock.acquire(blocking=False):
+            return
+
+        try:
+            threading.Thread(target=self._background_refresh, name="ppm-fhir-gcp-token", daemon=True).start()
+        except Exception:
+            self._lock.release()
+            raise
+
+    def _background_refresh(self):
+        """
+        Refreshes the token and releases the lock acquired by the thread
+        that started the refresh.
+        """
+        try:
+            self._refresh()
+
+        except Exception as e:
+            logger.exception(
+                f"PPM/FHIR/GCP: Token refresh error: {e}",
+                exc_info=True,
+                extra={
+                    "expiry": self._state[1],
+                },
+            )
+
+            # Back off before trying again; the current token is still valid
+            self._retry_at = datetime.utcnow() + timedelta(seconds=self.RETRY_INTERVAL)
+
+        finally:
+            self._lock.release()
+
+
+class GCPHealthcareAPI(HTTPBackend):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Set the token provider
+        self.token_provider = GCPTokenProvider()
+
+    @property
+    def token(self) -> str:
+        """
+        Returns the current bearer token for the GCP Healthcare API.
+
+        :return: The bearer token
+        :rtype: str
+        """
+        return self.token_provider.token
+
+    def reset_token(self):
+        """
+        Clears the cached token so the next request fetches a new one.
+        """
+        self.token_provider.invalidate()
+
+    def headers(self, headers: dict = None) -> dict:
+        """
+        Returns the headers to send with a request, including the bearer
+        token. Headers passed by the caller take precedence.
+
+        :param headers: The headers passed with the request
+        :type headers: dict, defaults to None
+        :return: The headers to use for the request
+        :rtype: dict
+        """
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/fhir+json",
+            **(headers or {}),
+        }
+
+    def send(self, method: HttpMethod, url: str, headers: dict = None, **kwargs) -> requests.Response:
+        """
+        A generic method implementation for an HTTP GET to a GCP Healthcare API
+        FHIR instance.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :param headers: The headers to include in the request
+        :type headers: dict, defaults to None
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        # Make the request
+        response = self.session.request(method=method, url=url, headers=self.headers(headers), **kwargs)
+
+        # Check for a token reset
+        if response is not None and response.status_code in [401, 403]:
+
+            # Reset and try again
+            self.reset_token()
+
+            response = self.session.request(method=method, url=url, headers=self.headers(headers), **kwargs)
+
+        return response
+
+
+class AzureHealthcareAPI(HTTPBackend):
+    def send(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        A generic method implementation for an HTTP GET to a Azure Healthcare
+        APIs FHIR instance.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        raise NotImplementedError("Azure Healthcare APIs not yet supported")
+
+
+class HAPIFHIR(HTTPBackend):
+    def send(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        A generic method implementation for an HTTP GET to a HAPI-FHIR instance.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        # Make the request
+        return self.session.request(method=method, url=url, **kwargs)
+
+
+class LocalFHIR(HTTPBackend):
+    """
+    An in-memory stand-in for a FHIR server, selected for FHIR URLs using
+    the `memory://` scheme. It supports the interactions this library
+    makes: reads, creates, updates, JSON patches and deletes, searches via
+    GET and POST `_search` with the search parameters, modifiers and
+    chains used here, `_include`, `_revinclude` and their `:iterate`
+    forms, `_count` paging with `next` links, `_sort`, `_summary=count`
+    and batch/transaction Bundles. This allows exercising the client at
+    scale without a network or a live server.
+
+    Resources can be loaded in bulk with `load`. Everything is kept in
+    process memory and is lost when the backend is discarded.
+    """
+
+    SCHEME = "memory"
+
+    # Paging defaults
+    DEFAULT_COUNT = 100
+    MAX_COUNT = 1000
+
+    # The number of search result sets kept for paging
+    MAX_SEARCHES = 1000
+
+    # Search parameters whose name differs from the element they search
+    SEARCH_PARAMETERS = {
+        "Communication": {"patient": ["subject"]},
+        "Consent": {"date": ["dateTime"]},
+        "Composition": {"entry": ["section.entry"], "patient": ["subject"]},
+        "Contract": {"signer": ["signer.party"], "patient": ["subject"]},
+        "DocumentReference": {"related": ["context.related"], "patient": ["subject"]},
+        "Flag": {"patient": ["subject"]},
+        "List": {"item": ["entry.item"], "patient": ["subject"]},
+        "Patient": {"birthdate": ["birthDate"], "family": ["name.family"], "given": ["name.given"]},
+        "QuestionnaireResponse": {"patient": ["subject"]},
+        "ResearchSubject": {"patient": ["individual"]},
+    }
+
+    # Elements holding canonical references rather than Reference objects
+    CANONICAL_ELEMENTS = {
+        "QuestionnaireResponse": ["questionnaire"],
+    }
+
+    # Search parameters that are references, these are resolved using the reference index
+    REFERENCE_PARAMETERS = {
+        "entry",
+        "individual",
+        "item",
+        "patient",
+        "questionnaire",
+        "recipient",
+        "related",
+        "signer",
+        "source",
+        "study",
+        "subject",
+    }
+
+    # Search parameters that are dates, these are matched with comparator prefixes
+    DATE_PARAMETERS = {"authored", "birthdate", "date", "issued", "sent", "received"}
+
+    # Search parameters that are strings, these are matched case-insensitively by prefix
+    STRING_PARAMETERS = {"address", "description", "family", "given", "name", "text", "title"}
+
+    # Parameters that control the search rather than filter it
+    CONTROL_PARAMETERS = {"_count", "_sort", "_summary", "_format", "_elements", "_total"}
+
+    def __init__(self, url: str = None, *args, **kwargs):
+        """
+        :param url: The base URL of the FHIR server
+        :type url: str, defaults to None
+        """
+        super().__init__(*args, **kwargs)
+        self.base_url = furl(url or f"{self.SCHEME}://fhir")
+
+        # Resources by type and ID
+        self._resources = collections.defaultdict(dict)
+
+        # Indexes of referencing resources by referenced ID and of resources by identifier
+        self._references = collections.defaultdict(set)
+        self._identifiers = collections.defaultdict(set)
+
+        # Search results retained for paging
+        self._searches = collections.OrderedDict()
+
+        self._lock = threading.RLock()
+
+    #
+    # STORAGE
+    #
+
+    def load(self, resources: Union[list[dict], dict]) -> int:
+        """
+        Stores the passed resources, or the resources in a passed Bundle,
+        as-is. Resources without an ID are assigned one.
+
+        :param resources: A list of resources or a Bundle
+        :type resources: Union[list[dict], dict]
+        :return: The number of resources loaded
+        :rtype: int
+        """
+        if type(resources) is dict and resources.get("resourceType") == "Bundle":
+            resources = [e["resource"] for e in resources.get("entry", []) if e.get("resource")]
+
+        count = 0
+        with self._lock:
+            for resource in resources:
+                self._store(libjson.loads(libjson.dumps(resource)), version=False)
+                count += 1
+
+        return count
+
+    def clear(self):
+        """
+        Removes all resources.
+        """
+        with self._lock:
+            self._resources.clear()
+            self._references.clear()
+            self._identifiers.clear()
+            self._searches.clear()
+
+    def resource(self, resource_type: str, resource_id: str) -> Optional[dict]:
+        """
+        Returns a copy of the stored resource, if it exists.
+
+        :param resource_type: The FHIR resource type
+        :type resource_type: str
+        :param resource_id: The FHIR resource ID
+        :type resource_id: str
+        :return: The resource
+        :rtype: Optional[dict]
+        """
+        with self._lock:
+            resource = self._resources[resource_type].get(resource_id)
+            return libjson.loads(libjson.dumps(resource)) if resource else None
+
+    def _store(self, resource: dict, version: bool = True) -> dict:
+        """
+        Stores the resource, replacing any existing version and updating
+        indexes. Must be called while holding the lock.
+
+        :param resource: The resource to store, which is not copied
+        :type resource: dict
+        :param version: Whether to set a new version on the resource
+        :type version: bool, defaults to True
+        :return: The stored resource
+        :rtype: dict
+        """
+        resource_type = resource["resourceType"]
+        resource.setdefault("id", str(uuid.uuid4()))
+
+        # Remove the prior version from indexes
+        existing = self._resources[resource_type].get(resource["id"])
+        if existing is not None:
+            self._unindex(existing)
+
+        # Set version details
+        meta = resource.setdefault("meta", {})
+        if version or "versionId" not in meta:
+            prior = int(existing.get("meta", {}).get("versionId", 0)) if existing else 0
+            meta["versionId"] = str(prior + 1)
+        if version or "lastUpdated" not in meta:
+            meta["lastUpdated"] = datetime.now(timezone.utc).isoformat()
+
+        self._resources[resource_type][resource["id"]] = resource
+        self._index(resource)
+
+        return resource
+
+    def _remove(self, resource_type: str, resource_id: str) -> bool:
+        """
+        Removes the resource. Must be called while holding the lock.
+
+        :param resource_type: The FHIR resource type
+        :type resource_type: str
+        :param resource_id: The FHIR resource ID
+        :type resource_id: str
+        :return: Whether the resource existed
+        :rtype: bool
+        """
+        resource = self._resources[resource_type].pop(resource_id, None)
+        if resource is not None:
+            self._unindex(resource)
+
+        return resource is not None
+
+    def _index_keys(self, resource: dict) -> tuple[set, set]:
+        """
+        Returns the index keys for the resource's references and
+        identifiers.
+
+        :param resource: The resource
+        :type resource: dict
+        :return: The referenced IDs and the identifier system/value pairs
+        :rtype: tuple[set, set]
+        """
+        references = {
+            parsed[1] for parsed in map(LocalFHIR._parse_reference, LocalFHIR._all_references(resource)) if parsed
+        }
+        for path in self.CANONICAL_ELEMENTS.get(resource["resourceType"], []):
+            for value in LocalFHIR._values(resource, path):
+                parsed = LocalFHIR._parse_reference(value) if type(value) is str else None
+                if parsed:
+                    references.add(parsed[1])
+
+        identifiers = {(i.get("system"), i.get("value")) for i in resource.get("identifier", []) if type(i) is dict}
+
+        return references, identifiers
+
+    def _index(self, resource: dict):
+        key = (resource["resourceType"], resource["id"])
+        references, identifiers = self._index_keys(resource)
+        for reference in references:
+            self._references[reference].add(key)
+        for identifier in identifiers:
+            self._identifiers[identifier].add(key)
+
+    def _unindex(self, resource: dict):
+        key = (resource["resourceType"], resource["id"])
+        references, identifiers = self._index_keys(resource)
+        for reference in references:
+            self._references[reference].discard(key)
+        for identifier in identifiers:
+            self._identifiers[identifier].discard(key)
+
+    #
+    # HELPERS
+    #
+
+    @staticmethod
+    def _values(element: Any, path: str) -> list:
+        """
+        Returns the values at the dotted path of the element, flattening
+        any lists along the way.
+
+        :param element: The resource or element
+        :type element: Any
+        :param path: The dotted path of the values
+        :type path: str
+        :return: The values found
+        :rtype: list
+        """
+        values = [element]
+        for name in path.split("."):
+            found = []
+            for value in values:
+                child = value.get(name) if type(value) is dict else None
+                if type(child) is list:
+                    found.extend(child)
+                elif child is not None:
+                    found.append(child)
+            values = found
+
+        return values
+
+    @staticmethod
+    def _all_references(element: Any) -> Generator[str, None, None]:
+        """
+        Yields every reference string in the element.
+
+        :param element: The resource or element
+        :type element: Any
+        :return: A generator of references
+        :rtype: Generator[str, None, None]
+        """
+        if type(element) is dict:
+            for key, value in element.items():
+                if key == "reference" and type(value) is str:
+                    yield value
+                elif type(value) in (dict, list):
+                    yield from LocalFHIR._all_references(value)
+        elif type(element) is list:
+            for value in element:
+                yield from LocalFHIR._all_references(value)
+
+    @staticmethod
+    def _parse_reference(reference: str) -> Optional[tuple[Optional[str], str]]:
+        """
+        Parses a relative, absolute or canonical reference into its
+        resource type and ID.
+
+        :param reference: The reference
+        :type reference: str
+        :return: The resource type, if any, and ID
+        :rtype: Optional[tuple[Optional[str], str]]
+        """
+        if not reference or reference.startswith("#") or reference.startswith("urn:"):
+            return None
+
+        # Remove canonical versions and history
+        segments = reference.split("|", 1)[0].split("/_history/", 1)[0].rstrip("/").split("/")
+        if len(segments) >= 2 and segments[-2][:1].isupper():
+            return segments[-2], segments[-1]
+
+        return None, segments[-1]
+
+    @staticmethod
+    def _match_token(system: Optional[str], code: Optional[str], value: str) -> bool:
+        """
+        Returns whether the coded value matches the token search value.
+
+        :param system: The system of the coded value
+        :type system: Optional[str]
+        :param code: The code of the coded value
+        :type code: Optional[str]
+        :param value: The search value, as `[system|]code`
+        :type value: str
+        :return: Whether it matches
+        :rtype: bool
+        """
+        if "|" not in value:
+            return code == value
+
+        search_system, search_code = value.split("|", 1)
+        if search_system and system != search_system:
+            return False
+        if not search_system and system:
+            return False
+
+        return not search_code or code == search_code
+
+    @staticmethod
+    def _match_reference(reference: str, value: str, resource_type: str = None) -> bool:
+        """
+        Returns whether the reference matches the search value.
+
+        :param reference: The reference
+        :type reference: str
+        :param value: The search value, as `[Type/]id` or a URL
+        :type value: str
+        :param resource_type: The resource type required by a modifier
+        :type resource_type: str, defaults to None
+        :return: Whether it matches
+        :rtype: bool
+        """
+        parsed, searched = LocalFHIR._parse_reference(reference), LocalFHIR._parse_reference(value)
+        if not parsed or not searched or parsed[1] != searched[1]:
+            return False
+
+        # Compare types where known
+        target_type = resource_type or searched[0]
+        return not target_type or not parsed[0] or parsed[0] == target_type
+
+    @staticmethod
+    def _match_value(element: Any, value: str, resource_type: str = None) -> bool:
+        """
+        Returns whether the element matches the search value, inferring the
+        type of search from the element.
+
+        :param element: The element to test
+        :type element: Any
+        :param value: The search value
+        :type value: str
+        :param resource_type: The resource type required by a modifier
+        :type resource_type: str, defaults to None
+        :return: Whether it matches
+        :rtype: bool
+        """
+        if type(element) is dict:
+            if "reference" in element:
+                return LocalFHIR._match_reference(element["reference"], value, resource_type)
+            if "coding" in element:
+                return any(LocalFHIR._match_value(c, value) for c in element["coding"])
+            if "code" in element:
+                return LocalFHIR._match_token(element.get("system"), element.get("code"), value)
+            if "value" in element:
+                return LocalFHIR._match_token(element.get("system"), str(element.get("value")), value)
+            return False
+
+        if type(element) is bool:
+            return str(element).lower() == value.lower()
+
+        # Plain strings may be codes, strings or canonical references
+        element = str(element)
+        if element == value or LocalFHIR._match_token(None, element, value):
+            return True
+
+        return "/" in value and LocalFHIR._match_reference(element, value, resource_type)
+
+    @staticmethod
+    def _match_date(element: str, value: str) -> bool:
+        """
+        Returns whether the date or instant matches the search value, which
+        may be prefixed with a comparator such as `gt`. Values given as a
+        year, month or day cover that whole period.
+
+        :param element: The date or instant
+        :type element: str
+        :param value: The search value
+        :type value: str
+        :return: Whether it matches
+        :rtype: bool
+        """
+        prefix = value[:2] if value[:2] in ("eq", "ne", "gt", "lt", "ge", "le", "sa", "eb") else "eq"
+        if value[:2] == prefix:
+            value = value[2:]
+
+        # Determine the period covered by the value
+        match = re.match(r"^(\d{4})(?:-(\d{2}))?(?:-(\d{2}))?$", value)
+        if match:
+            year, month, day = int(match.group(1)), int(match.group(2) or 1), int(match.group(3) or 1)
+            start = datetime(year, month, day, tzinfo=timezone.utc)
+            if match.group(3):
+                end = start + timedelta(days=1)
+            elif match.group(2):
+                end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+            else:
+                end = datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+        else:
+            start = parse(value)
+            if start.tzinfo is None:
+                start = start.replace(tzinfo=timezone.utc)
+            end = start + timedelta(microseconds=1)
+
+        # Compare as instants, assuming UTC if no zone is given
+        instant = parse(element)
+        if instant.tzinfo is None:
+            instant = instant.replace(tzinfo=timezone.utc)
+
+        return {
+            "eq": start <= instant < end,
+            "ne": not start <= instant < end,
+            "gt": instant >= end,
+            "sa": instant >= end,
+            "lt": instant < start,
+            "eb": instant < start,
+            "ge": instant >= start,
+            "le": instant < end,
+        }[prefix]
+
+    @staticmethod
+    def _match_string(element: Any, value: str, modifier: str = None) -> bool:
+        """
+        Returns whether the string, or any of the strings of a complex
+        element such as a HumanName or Address, matches the search value.
+        Strings match case-insensitively by prefix unless the `exact` or
+        `contains` modifier is passed.
+
+        :param element: The element to test
+        :type element: Any
+        :param value: The search value
+        :type value: str
+        :param modifier: The search parameter's modifier
+        :type modifier: str, defaults to None
+        :return: Whether it matches
+        :rtype: bool
+        """
+        if type(element) is dict:
+            return any(
+                LocalFHIR._match_string(v, value, modifier)
+                for k, v in element.items()
+                if k not in ("id", "use", "type", "extension") and type(v) in (str, list)
+            )
+        if type(element) is list:
+            return any(LocalFHIR._match_string(e, value, modifier) for e in element)
+        if type(element) is not str:
+            return False
+
+        if modifier == "exact":
+            return element == value
+        if modifier == "contains":
+            return value.casefold() in element.casefold()
+
+        return element.casefold().startswith(value.casefold())
+
+    def _resolve(self, reference: str, resource_type: str = None) -> Optional[dict]:
+        """
+        Returns the stored resource for the reference, if any. Must be
+        called while holding the lock.
+
+        :param reference: The reference
+        :type reference: str
+        :param resource_type: The expected resource type
+        :type resource_type: str, defaults to None
+        :return: The resource
+        :rtype: Optional[dict]
+        """
+        parsed = LocalFHIR._parse_reference(reference)
+        if not parsed:
+            return None
+
+        types = [parsed[0] or resource_type] if parsed[0] or resource_type else list(self._resources)
+        for _type in types:
+            if resource_type and _type != resource_type:
+                continue
+            resource = self._resources[_type].get(parsed[1])
+            if resource is not None:
+                return resource
+
+        return None
+
+    def _paths(self, resource_type: str, parameter: str) -> list[str]:
+        return self.SEARCH_PARAMETERS.get(resource_type, {}).get(parameter, [parameter])
+
+    #
+    # SEARCH
+    #
+
+    @staticmethod
+    def _parse_parameter(key: str) -> tuple[str, Optional[str], Optional[str]]:
+        """
+        Splits a search parameter key into its name, modifier and chain,
+        e.g. `subject:Patient.identifier`.
+
+        :param key: The search parameter key
+        :type key: str
+        :return: The name, modifier and chained parameter
+        :rtype: tuple[str, Optional[str], Optional[str]]
+        """
+        match = re.match(r"^([^:.]+)(?::([^.]+))?(?:\.(.+))?$", key)
+        return match.group(1), match.group(2), match.group(3)
+
+    def _match(self, resource: dict, key: str, values: list[str]) -> bool:
+        """
+        Returns whether the resource matches the search parameter. Values
+        are alternatives. Must be called while holding the lock.
+
+        :param resource: The resource
+        :type resource: dict
+        :param key: The search parameter key, including modifiers and chains
+        :type key: str
+        :param values: The values to match, any of which may match
+        :type values: list[str]
+        :return: Whether it matches
+        :rtype: bool
+        """
+        parameter, modifier, chain = LocalFHIR._parse_parameter(key)
+        resource_type = modifier if modifier and modifier[:1].isupper() else None
+
+        # Check IDs
+        if parameter == "_id":
+            return resource["id"] in values
+
+        # Check the last update
+        if parameter == "_lastUpdated":
+            last_updated = resource.get("meta", {}).get("lastUpdated")
+            return bool(last_updated) and any(LocalFHIR._match_date(last_updated, v) for v in values)
+
+        elements = [
+            e for path in self._paths(resource["resourceType"], parameter) for e in self._values(resource, path)
+        ]
+
+        # Check presence
+        if modifier == "missing":
+            return (not elements) == (values[0] == "true")
+
+        # Check the referenced resources
+        if chain:
+            for element in elements:
+                reference = element.get("reference") if type(element) is dict else element
+                target = self._resolve(reference, resource_type) if type(reference) is str else None
+                if target is not None and self._match(target, chain, values):
+                    return True
+
+            return False
+
+        # Check dates and strings by their own rules
+        if parameter in self.DATE_PARAMETERS:
+            return any(type(e) is str and LocalFHIR._match_date(e, v) for e in elements for v in values)
+        if parameter in self.STRING_PARAMETERS:
+            return any(LocalFHIR._match_string(e, v, modifier) for e in elements for v in values)
+
+        matched = any(self._match_value(e, v, resource_type) for e in elements for v in values)
+        return not matched if modifier == "not" else matched
+
+    def _candidates(self, resource_type: str, parameters: list[tuple[str, list[str]]]) -> Optional[set]:
+        """
+        Uses indexes to narrow the resources that could match the search.
+        Returns `None` if the search cannot be narrowed. Must be called while
+        holding the lock.
+
+        :param resource_type: The resource type searched
+        :type resource_type: str
+        :param parameters: The search parameters and their values
+        :type parameters: list[tuple[str, list[str]]]
+        :return: The IDs of candidate resources
+        :rtype: Optional[set]
+        """
+        candidates = None
+        for key, values in parameters:
+            parameter, modifier, chain = LocalFHIR._parse_parameter(key)
+            ids = None
+
+            if parameter == "_id":
+                ids = set(values)
+
+            elif parameter == "identifier" and not modifier and all("|" in v and v.split("|", 1)[1] for v in values):
+                ids = {
+                    _id
+                    for v in values
+                    for _type, _id in self._identifiers.get(tuple(v.split("|", 1)), ())
+                    if _type == resource_type
+                }
+
+            elif chain == "identifier" and all("|" in v and v.split("|", 1)[1] for v in values):
+
+                # Find the referenced resources and then those referencing them
+                targets = {_id for v in values for _, _id in self._identifiers.get(tuple(v.split("|", 1)), ())}
+                ids = {_id for t in targets for _type, _id in self._references.get(t, ()) if _type == resource_type}
+
+            elif parameter in self.REFERENCE_PARAMETERS and not chain and (not modifier or modifier[:1].isupper()):
+
+                # Reference searches can use the reverse index
+                targets = [LocalFHIR._parse_reference(v) for v in values]
+                if all(targets):
+                    ids = {
+                        _id for t in targets for _type, _id in self._references.get(t[1], ()) if _type == resource_type
+                    }
+
+            if ids is not None:
+                candidates = ids if candidates is None else candidates & ids
+
+        return candidates
+
+    def _search(self, resource_type: str, parameters: list[tuple[str, list[str]]]) -> list[dict]:
+        """
+        Returns the resources of the type matching all search parameters.
+        Must be called while holding the lock.
+
+        :param resource_type: The resource type searched
+        :type resource_type: str
+        :param parameters: The search parameters and their values
+        :type parameters: list[tuple[str, list[str]]]
+        :return: The matching resources
+        :rtype: list[dict]
+        """
+        resources = self._resources[resource_type]
+        candidates = self._candidates(resource_type, parameters)
+        if candidates is not None:
+            resources = {_id: resources[_id] for _id in candidates if _id in resources}
+
+        return [r for r in resources.values() if all(self._match(r, key, values) for key, values in parameters)]
+
+    def _include(self, resources: list[dict], includes: list[str], reverse: bool) -> list[dict]:
+        """
+        Returns the resources included by the passed `_include` or
+        `_revinclude` values. Must be called while holding the lock.
+
+        :param resources: The resources to include for
+        :type resources: list[dict]
+        :param includes: The values of the include parameter
+        :type includes: list[str]
+        :param reverse: Whether these are reverse includes
+        :type reverse: bool
+        :return: The included resources
+        :rtype: list[dict]
+        """
+        included = []
+        for include in includes:
+            source_type, _, rest = include.partition(":")
+            parameter, _, target_type = rest.partition(":")
+
+            for resource in resources:
+
+                # Find resources of the source type referencing this one
+                if reverse:
+                    for _type, _id in list(self._references.get(resource["id"], ())):
+                        source = self._resources[_type].get(_id) if _type == source_type or source_type == "*" else None
+                        if source is None:
+                            continue
+
+                        reference = f"{resource['resourceType']}/{resource['id']}"
+                        paths = self._paths(_type, parameter) if parameter else None
+                        elements = (
+                            [e for path in paths for e in self._values(source, path)]
+                            if paths
+                            else [{"reference": r} for r in self._all_references(source)]
+                        )
+                        if any(self._match_value(e, reference) for e in elements):
+                            included.append(source)
+
+                # Find resources referenced by this one
+                elif source_type == "*" or source_type == resource["resourceType"]:
+                    if source_type == "*" or not parameter or parameter == "*":
+                        references = list(self._all_references(resource))
+                    else:
+                        references = [
+                            e.get("reference") if type(e) is dict else e
+                            for path in self._paths(resource["resourceType"], parameter)
+                            for e in self._values(resource, path)
+                        ]
+
+                    for reference in references:
+                        target = self._resolve(reference, target_type or None) if type(reference) is str else None
+                        if target is not None:
+                            included.append(target)
+
+        return included
+
+    def _includes(self, matches: list[dict], query: dict[str, list[str]]) -> list[dict]:
+        """
+        Returns the resources to include alongside the matches, applying
+        iterated includes until no more resources are found. Must be called
+        while holding the lock.
+
+        :param matches: The matching resources
+        :type matches: list[dict]
+        :param query: The search parameters
+        :type query: dict[str, list[str]]
+        :return: The included resources
+        :rtype: list[dict]
+        """
+        seen = {(r["resourceType"], r["id"]) for r in matches}
+        included = []
+
+        def add(resources: list[dict]) -> list[dict]:
+            added = []
+            for resource in resources:
+                key = (resource["resourceType"], resource["id"])
+                if key not in seen:
+                    seen.add(key)
+                    added.append(resource)
+            included.extend(added)
+            return added
+
+        include, revinclude = query.get("_include", []), query.get("_revinclude", [])
+        include_iterate = query.get("_include:iterate", []) + query.get("_include:recurse", [])
+        revinclude_iterate = query.get("_revinclude:iterate", []) + query.get("_revinclude:recurse", [])
+
+        # Apply includes to matches
+        current = add(self._include(matches, include + include_iterate, False))
+        current += add(self._include(matches, revinclude + revinclude_iterate, True))
+
+        # Apply iterated includes to included resources
+        while current and (include_iterate or revinclude_iterate):
+            added = add(self._include(current, include_iterate, False))
+            added += add(self._include(current, revinclude_iterate, True))
+            current = added
+
+        return included
+
+    def _sort(self, resources: list[dict], sort: str) -> list[dict]:
+        """
+        Sorts resources by the comma-separated `_sort` parameter value.
+
+        :param resources: The resources
+        :type resources: list[dict]
+        :param sort: The sort parameter value
+        :type sort: str
+        :return: The sorted resources
+        :rtype: list[dict]
+        """
+        for key in reversed(sort.split(",")):
+            descending = key.startswith("-")
+            key = key.lstrip("-")
+
+            def value(resource: dict) -> str:
+                if key == "_lastUpdated":
+                    return resource.get("meta", {}).get("lastUpdated", "")
+                if key == "_id":
+                    return resource["id"]
+                values = self._values(resource, key)
+                return str(values[0]) if values else ""
+
+            resources = sorted(resources, key=value, reverse=descending)
+
+        return resources
+
+    def _searchset(self, url: str, resource_type: Optional[str], query: dict[str, list[str]]) -> dict:
+        """
+        Runs the search, or fetches a page of a prior search, and returns
+        the page as a searchset Bundle. Must be called while holding the
+        lock.
+
+        :param url: The URL of the request
+        :type url: str
+        :param resource_type: The resource type searched
+        :type resource_type: Optional[str]
+        :param query: The search parameters
+        :type query: dict[str, list[str]]
+        :return: The Bundle
+        :rtype: dict
+        """
+        count = min(int(query.get("_count", [self.DEFAULT_COUNT])[0]), self.MAX_COUNT)
+
+        # Check for a page of a prior search
+        if "_getpages" in query:
+            search_id = query["_getpages"][0]
+            if search_id not in self._searches:
+                raise LocalFHIR.Error(410, "not-found", f"Search '{search_id}' has expired")
+            offset = int(query.get("_getpagesoffset", ["0"])[0])
+            keys, query = self._searches[search_id]
+        else:
+            parameters = [
+                (key, [v for value in values for v in value.split(",")])
+                for key, values in query.items()
+                if key not in self.CONTROL_PARAMETERS and not key.startswith(("_include", "_revinclude"))
+            ]
+            matches = self._search(resource_type, parameters)
+            if "_sort" in query:
+                matches = self._sort(matches, query["_sort"][0])
+
+            # Keep the result set for paging
+            keys = [(r["resourceType"], r["id"]) for r in matches]
+            search_id = str(uuid.uuid4())
+            self._searches[search_id] = (keys, query)
+            while len(self._searches) > self.MAX_SEARCHES:
+                self._searches.popitem(last=False)
+            offset = 0
+
+        bundle = {
+            "resourceType": "Bundle",
+            "id": str(uuid.uuid4()),
+            "meta": {"lastUpdated": datetime.now(timezone.utc).isoformat()},
+            "type": "searchset",
+            "total": len(keys),
+            "link": [{"relation": "self", "url": url}],
+        }
+        if query.get("_summary") == ["count"]:
+            return bundle
+
+        # Get the page of matches and their includes
+        page = [self._resources[t].get(i) for t, i in keys[offset : offset + count]]
+        page = [r for r in page if r is not None]
+        entries = [(r, "match") for r in page] + [(r, "include") for r in self._includes(page, query)]
+        bundle["entry"] = [
+            {"fullUrl": self._full_url(r), "resource": r, "search": {"mode": mode}} for r, mode in entries
+        ]
+
+        # Link the next page
+        if offset + count < len(keys):
+            next_url = self.base_url.copy().set(
+                query={"_getpages": search_id, "_getpagesoffset": offset + count, "_count": count}
+            )
+            bundle["link"].append({"relation": "next", "url": next_url.url})
+
+        return bundle
+
+    #
+    # INTERACTIONS
+    #
+
+    class Error(Exception):
+        """
+        Raised when an interaction fails, carrying the HTTP status and the
+        OperationOutcome to return.
+        """
+
+        def __init__(self, status: int, code: str, diagnostics: str):
+            super().__init__(diagnostics)
+            self.status = status
+            self.outcome = {
+                "resourceType": "OperationOutcome",
+                "issue": [{"severity": "error", "code": code, "diagnostics": diagnostics}],
+            }
+
+    def _full_url(self, resource: dict) -> str:
+        return self.base_url.copy().add(path=[resource["resourceType"], resource["id"]]).url
+
+    @staticmethod
+    def _etag(resource: dict) -> str:
+        return f'W/"{resource["meta"]["versionId"]}"'
+
+    def _created(self, status: int, resource: dict) -> tuple[int, dict, dict]:
+        """
+        Returns the result of a create or update of the resource.
+        """
+        location = f"{self._full_url(resource)}/_history/{resource['meta']['versionId']}"
+        headers = {"Location": location, "ETag": self._etag(resource), "Last-Modified": resource["meta"]["lastUpdated"]}
+        return status, resource, headers
+
+    def _create(self, resource: dict, resource_id: str = None, if_none_exist: str = None) -> tuple[int, dict, dict]:
+        """
+        Creates the resource, unless the `If-None-Exist` search matches an
+        existing resource. Must be called while holding the lock.
+
+        :param resource: The resource to create
+        :type resource: dict
+        :param resource_id: The ID to assign, defaults to a new UUID
+        :type resource_id: str, defaults to None
+        :param if_none_exist: The conditional create search, if any
+        :type if_none_exist: str, defaults to None
+        :return: The status, resource and headers
+        :rtype: tuple[int, dict, dict]
+        """
+        if not resource or not resource.get("resourceType"):
+            raise LocalFHIR.Error(400, "invalid", "A resource is required")
+
+        # Check for an existing resource
+        if if_none_exist:
+            existing = self._conditional(resource["resourceType"], if_none_exist)
+            if existing is not None:
+                return self._created(200, existing)
+
+        resource = libjson.loads(libjson.dumps(resource))
+        resource["id"] = resource_id or str(uuid.uuid4())
+        resource.pop("meta", None)
+
+        return self._created(201, self._store(resource))
+
+    def _conditional(self, resource_type: str, search: str) -> Optional[dict]:
+        """
+        Returns the single resource matching a conditional search, if any.
+        Must be called while holding the lock.
+
+        :param resource_type: The resource type searched
+        :type resource_type: str
+        :param search: The search query string
+        :type search: str
+        :raises LocalFHIR.Error: If more than one resource matches
+        :return: The matching resource
+        :rtype: Optional[dict]
+        """
+        query = LocalFHIR._query(search.lstrip("?"))
+        matches = self._search(resource_type, [(k, [x for v in vs for x in v.split(",")]) for k, vs in query.items()])
+        if len(matches) > 1:
+            raise LocalFHIR.Error(412, "multiple-matches", f"Multiple {resource_type} resources match: {search}")
+
+        return matches[0] if matches else None
+
+    def _update(self, resource_type: str, resource_id: str, resource: dict) -> tuple[int, dict, dict]:
+        """
+        Updates, or creates, the resource. Must be called while holding the
+        lock.
+
+        :param resource_type: The FHIR resource type
+        :type resource_type: str
+        :param resource_id: The FHIR resource ID
+        :type resource_id: str
+        :param resource: The resource
+        :type resource: dict
+        :return: The status, resource and headers
+        :rtype: tuple[int, dict, dict]
+        """
+        if not resource or resource.get("resourceType") != resource_type:
+            raise LocalFHIR.Error(400, "invalid", f"A {resource_type} resource is required")
+        if resource.get("id", resource_id) != resource_id:
+            raise LocalFHIR.Error(400, "invalid", f"Resource ID does not match URL: {resource.get('id')}")
+
+        existed = resource_id in self._resources[resource_type]
+        resource = libjson.loads(libjson.dumps(resource))
+        resource["id"] = resource_id
+        resource.pop("meta", None)
+
+        return self._created(200 if existed else 201, self._store(resource))
+
+    def _read(self, resource_type: str, resource_id: str) -> dict:
+        """
+        Returns the resource. Must be called while holding the lock.
+
+        :param resource_type: The FHIR resource type
+        :type resource_type: str
+        :param resource_id: The FHIR resource ID
+        :type resource_id: str
+        :raises LocalFHIR.Error: If the resource does not exist
+        :return: The resource
+        :rtype: dict
+        """
+        resource = self._resources[resource_type].get(resource_id)
+        if resource is None:
+            raise LocalFHIR.Error(404, "not-found", f"Resource {resource_type}/{resource_id} is not known")
+
+        return resource
+
+    @staticmethod
+    def _pointer(path: str) -> list[str]:
+        return [t.replace("~1", "/").replace("~0", "~") for t in path.split("/")[1:]] if path else []
+
+    @staticmethod
+    def _json_patch(document: dict, operations: list[dict]) -> dict:
+        """
+        Applies the JSON Patch operations to a copy of the document.
+
+        :param document: The document to patch
+        :type document: dict
+        :param operations: The JSON Patch operations
+        :type operations: list[dict]
+        :raises LocalFHIR.Error: If an operation cannot be applied
+        :return: The patched document
+        :rtype: dict
+        """
+        document = libjson.loads(libjson.dumps(document))
+
+        def parent(tokens: list[str]) -> Any:
+            element = document
+            for token in tokens[:-1]:
+                element = element[int(token)] if type(element) is list else element[token]
+            return element
+
+        def get(tokens: list[str]) -> Any:
+            element = parent(tokens)
+            return element[int(tokens[-1])] if type(element) is list else element[tokens[-1]]
+
+        def add(tokens: list[str], value: Any):
+            element = parent(tokens)
+            if type(element) is list:
+                element.append(value) if tokens[-1] == "-" else element.insert(int(tokens[-1]), value)
+            else:
+                element[tokens[-1]] = value
+
+        def remove(tokens: list[str]) -> Any:
+            element = parent(tokens)
+            return element.pop(int(tokens[-1]) if type(element) is list else tokens[-1])
+
+        try:
+            for operation in operations:
+                op, tokens = operation["op"], LocalFHIR._pointer(operation["path"])
+                if not tokens:
+                    raise LocalFHIR.Error(422, "processing", "Patching the resource root is not supported")
+
+                if op == "add":
+                    add(tokens, operation["value"])
+                elif op == "remove":
+                    remove(tokens)
+                elif op == "replace":
+                    get(tokens)
+                    element = parent(tokens)
+                    element[int(tokens[-1]) if type(element) is list else tokens[-1]] = operation["value"]
+                elif op == "move":
+                    add(tokens, remove(LocalFHIR._pointer(operation["from"])))
+                elif op == "copy":
+                    add(tokens, libjson.loads(libjson.dumps(get(LocalFHIR._pointer(operation["from"])))))
+                elif op == "test":
+                    if get(tokens) != operation["value"]:
+                        raise LocalFHIR.Error(422, "processing", f"Test failed: {operation['path']}")
+                else:
+                    raise LocalFHIR.Error(400, "not-supported", f"Unsupported patch operation: {op}")
+
+        except (KeyError, IndexError, ValueError, TypeError) as e:
+            raise LocalFHIR.Error(422, "processing", f"Invalid patch: {e}")
+
+        return document
+
+    def _patch(self, resource_type: str, resource_id: str, patch: Any) -> tuple[int, dict, dict]:
+        """
+        Applies a JSON Patch to the resource. Must be called while holding
+        the lock.
+
+        :param resource_type: The FHIR resource type
+        :type resource_type: str
+        :param resource_id: The FHIR resource ID
+        :type resource_id: str
+        :param patch: The JSON Patch operations
+        :type patch: Any
+        :return: The status, resource and headers
+        :rtype: tuple[int, dict, dict]
+        """
+        if type(patch) is dict and patch.get("resourceType") == "Binary":
+            patch = libjson.loads(base64.b64decode(patch["data"]))
+        if type(patch) is not list:
+            raise LocalFHIR.Error(400, "not-supported", "Only JSON Patch is supported")
+
+        resource = LocalFHIR._json_patch(self._read(resource_type, resource_id), patch)
+        if resource.get("resourceType") != resource_type or resource.get("id") != resource_id:
+            raise LocalFHIR.Error(422, "processing", "Patch may not change the resource type or ID")
+
+        return self._created(200, self._store(resource))
+
+    def _delete(self, resource_type: str, resource_id: str = None, search: str = None) -> tuple[int, dict, dict]:
+        """
+        Deletes the resource, or every resource matching the search. Must be
+        called while holding the lock.
+
+        :param resource_type: The FHIR resource type
+        :type resource_type: str
+        :param resource_id: The FHIR resource ID
+        :type resource_id: str, defaults to None
+        :param search: The conditional delete search
+        :type search: str, defaults to None
+        :return: The status, outcome and headers
+        :rtype: tuple[int, dict, dict]
+        """
+        if resource_id:
+            self._remove(resource_type, resource_id)
+        elif search:
+            query = LocalFHIR._query(search)
+            parameters = [(k, [x for v in vs for x in v.split(",")]) for k, vs in query.items()]
+            for resource in self._search(resource_type, parameters):
+                self._remove(resource_type, resource["id"])
+        else:
+            raise LocalFHIR.Error(400, "invalid", "A resource ID or search is required to delete")
+
+        outcome = {
+            "resourceType": "OperationOutcome",
+            "issue": [{"severity": "information", "code": "informational", "diagnostics": "Deleted"}],
+        }
+        return 200, outcome, {}
+
+    def _reindex(self):
+        """
+        Rebuilds all indexes. Must be called while holding the lock.
+        """
+        self._references.clear()
+        self._identifiers.clear()
+        for resources in self._resources.values():
+            for resource in resources.values():
+                self._index(resource)
+
+    def _bundle(self, bundle: dict) -> tuple[int, dict, dict]:
+        """
+        Processes a batch or transaction Bundle. Entries are processed in
+        the order required by the specification: deletes, creates, updates
+        and then reads. A failed entry fails and rolls back an entire
+        transaction whereas batch entries fail independently. Must be
+        called while holding the lock.
+
+        :param bundle: The Bundle
+        :type bundle: dict
+        :return: The status, response Bundle and headers
+        :rtype: tuple[int, dict, dict]
+        """
+        bundle_type = bundle.get("type")
+        if bundle_type not in ("batch", "transaction"):
+            raise LocalFHIR.Error(400, "invalid", f"Unsupported Bundle type: {bundle_type}")
+        transaction = bundle_type == "transaction"
+
+        entries = libjson.loads(libjson.dumps(bundle.get("entry", [])))
+        snapshot = {resource_type: dict(resources) for resource_type, resources in self._resources.items()}
+        try:
+            # Assign IDs to created resources so temporary references can be replaced
+            ids, references = {}, {}
+            for index, entry in enumerate(entries):
+                request, resource = entry.get("request", {}), entry.get("resource")
+                if request.get("method", "").upper() == "POST" and resource and resource.get("resourceType"):
+
+                    # Conditional creates resolve to the existing resource, if any
+                    existing = None
+                    if request.get("ifNoneExist"):
+                        existing = self._conditional(resource["resourceType"], request["ifNoneExist"])
+
+                    ids[index] = existing["id"] if existing else str(uuid.uuid4())
+                    if transaction and entry.get("fullUrl"):
+                        references[entry["fullUrl"]] = f"{resource['resourceType']}/{ids[index]}"
+
+            def replace(element: Any):
+                if type(element) is dict:
+                    for key, value in element.items():
+                        if key == "reference" and value in references:
+                            element[key] = references[value]
+                        else:
+                            replace(value)
+                elif type(element) is list:
+                    for value in element:
+                        replace(value)
+
+            if references:
+                replace([e.get("resource") for e in entries])
+
+            # Process entries in order of method
+            order = {"DELETE": 0, "POST": 1, "PUT": 2, "PATCH": 2, "GET": 3, "HEAD": 3}
+            methods = [e.get("request", {}).get("method", "").upper() for e in entries]
+            results = [None] * len(entries)
+            for index in sorted(range(len(entries)), key=lambda i: order.get(methods[i], 4)):
+                entry = entries[index]
+                request = entry.get("request", {})
+                try:
+                    url = furl(request.get("url", ""))
+                    status, body, headers = self._handle(
+                        request.get("method", "").upper(),
+                        [s for s in url.path.segments if s],
+                        LocalFHIR._query(str(url.query)),
+                        entry.get("resource"),
+                        {"If-None-Exist": request["ifNoneExist"]} if request.get("ifNoneExist") else {},
+                        url=request.get("url"),
+                        resource_id=ids.get(index),
+                    )
+
+                    response = {"status": f"{status} {http.HTTPStatus(status).phrase}"}
+                    if headers.get("Location"):
+                        response["location"] = headers["Location"].split(str(self.base_url).rstrip("/") + "/", 1)[-1]
+                        response["etag"] = headers["ETag"]
+                        response["lastModified"] = headers["Last-Modified"]
+
+                    results[index] = {"response": response}
+                    if body is not None and body.get("resourceType") != "OperationOutcome":
+                        results[index]["resource"] = body
+
+                except LocalFHIR.Error as e:
+                    if transaction:
+                        raise
+                    results[index] = {
+                        "response": {"status": f"{e.status} {http.HTTPStatus(e.status).phrase}", "outcome": e.outcome}
+                    }
+
+        except Exception:
+            # Roll back the transaction
+            self._resources = collections.defaultdict(dict, snapshot)
+            self._reindex()
+            raise
+
+        return 200, {"resourceType": "Bundle", "type": f"{bundle_type}-response", "entry": results}, {}
+
+    #
+    # HTTP
+    #
+
+    @staticmethod
+    def _query(query: Any) -> dict[str, list[str]]:
+        """
+        Normalizes a query string, dict or list of pairs into a dict of
+        parameter names to lists of values.
+
+        :param query: The query
+        :type query: Any
+        :return: The normalized query
+        :rtype: dict[str, list[str]]
+        """
+        normalized = collections.defaultdict(list)
+        if not query:
+            return normalized
+
+        if type(query) in (str, bytes):
+            items = urllib.parse.parse_qsl(query.decode() if type(query) is bytes else query, keep_blank_values=True)
+        elif type(query) is dict:
+            items = query.items()
+        else:
+            items = query
+
+        for key, value in items:
+            for _value in value if type(value) in (list, tuple) else [value]:
+                normalized[key].append(str(_value))
+
+        return normalized
+
+    def _handle(
+        self,
+        method: str,
+        segments: list[str],
+        query: dict[str, list[str]],
+        body: Any,
+        headers: dict,
+        url: str = None,
+        resource_id: str = None,
+    ) -> tuple[int, Optional[dict], dict]:
+        """
+        Routes the request to the interaction. Must be called while holding
+        the lock.
+
+        :return: The status, body and headers of the response
+        :rtype: tuple[int, Optional[dict], dict]
+        """
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        resource_type = segments[0] if segments else None
+        if resource_type and not resource_type[:1].isupper():
+            raise LocalFHIR.Error(404, "not-supported", f"Unknown path: {'/'.join(segments)}")
+
+        if not segments:
+            if method == "POST" and type(body) is dict and body.get("resourceType") == "Bundle":
+                return self._bundle(body)
+            if method == "GET" and "_getpages" in query:
+                return 200, self._searchset(url, None, query), {}
+
+        elif len(segments) == 1:
+            if method == "GET":
+                return 200, self._searchset(url, resource_type, query), {}
+            if method == "POST":
+                return self._create(body, resource_id=resource_id, if_none_exist=headers.get("if-none-exist"))
+            if method == "DELETE":
+                return self._delete(resource_type, search=urllib.parse.urlencode(query, doseq=True))
+
+        elif segments[1] == "_search" and len(segments) == 2 and method == "POST":
+            for key, values in LocalFHIR._query(body).items():
+                query[key].extend(values)
+            return 200, self._searchset(url, resource_type, query), {}
+
+        elif len(segments) == 2 or (len(segments) == 4 and segments[2] == "_history"):
+            resource_id = segments[1]
+            if method in ("GET", "HEAD"):
+                resource = self._read(resource_type, resource_id)
+                if len(segments) == 4 and segments[3] != resource["meta"]["versionId"]:
+                    raise LocalFHIR.Error(404, "not-found", f"Version {segments[3]} is not known")
+                if headers.get("if-none-match") in (self._etag(resource), f'"{resource["meta"]["versionId"]}"'):
+                    return 304, None, {"ETag": self._etag(resource)}
+                return 200, resource, {"ETag": self._etag(resource), "Last-Modified": resource["meta"]["lastUpdated"]}
+            if method == "PUT":
+                return self._update(resource_type, resource_id, body)
+            if method == "PATCH":
+                return self._patch(resource_type, resource_id, body)
+            if method == "DELETE":
+                return self._delete(resource_type, resource_id)
+
+        raise LocalFHIR.Error(400, "not-supported", f"Unsupported interaction: {method} {'/'.join(segments)}")
+
+    def send(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        Handles the request against the in-memory store and returns the
+        response the equivalent FHIR server would.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        url_builder = furl(url)
+        base_segments = [s for s in self.base_url.path.segments if s]
+        segments = [s for s in url_builder.path.segments if s][len(base_segments) :]
+
+        # Merge the URL query with passed parameters
+        query = LocalFHIR._query(url_builder.query.params.allitems())
+        for key, values in LocalFHIR._query(kwargs.get("params")).items():
+            query[key].extend(values)
+
+        # Parse the body
+        body = kwargs.get("json")
+        if body is None and kwargs.get("data") is not None:
+            data = kwargs["data"]
+            if type(data) is dict:
+                body = data
+            else:
+                try:
+                    body = libjson.loads(data)
+                except ValueError:
+                    body = data
+
+        # Handle it
+        with self._lock:
+            try:
+                status, content, headers = self._handle(
+                    method.upper(), segments, query, body, kwargs.get("headers"), url=url_builder.url
+                )
+                content = libjson.dumps(content).encode() if content is not None else b""
+            except LocalFHIR.Error as e:
+                status, content, headers = e.status, libjson.dumps(e.outcome).encode(), {}
+
+        # Build the response
+        response = requests.Response()
+        response.status_code = status
+        response.reason = http.HTTPStatus(status).phrase
+        response.url = url_builder.url
+        response.encoding = "utf-8"
+        response.headers = requests.structures.CaseInsensitiveDict(
+            {"Content-Type": "application/fhir+json;charset=utf-8", **headers}
+        )
+        response._content = content
+        response.request = requests.Request(method.upper(), url_builder.url).prepare()
+
+        return response
+
+
+class RecordingBackend(Backend):
+    """
+    Wraps another Backend and records every request made through it, and
+    the response returned, to a gzipped JSON-lines archive. The archive
+    can then be replayed with `ReplayBackend`, e.g.:
+
+        FHIR.set_backend(RecordingBackend(FHIR.backend(), "session.jsonl.gz"))
+
+    Requests are still retried and rate-limited by the wrapped backend, only
+    the final response for each request is recorded. Records are buffered
+    until the recorder is flushed or closed, which it is when used as a
+    context manager:
+
+        with RecordingBackend(FHIR.backend(), "session.jsonl.gz") as recorder:
+            FHIR.set_backend(recorder)
+            ...
+    """
+
+    # Request headers that are never written to the archive
+    REDACTED_HEADERS = frozenset({"authorization", "cookie", "x-amz-security-token"})
+
+    # Response headers that no longer apply once the content is decoded
+    DROPPED_HEADERS = frozenset({"content-encoding", "content-length", "transfer-encoding", "set-cookie"})
+
+    def __init__(self, backend: Backend, path: str):
+        """
+        Sets up the recorder for the given backend.
+
+        :param backend: The backend to send requests through
+        :type backend: Backend
+        :param path: The path of the archive to append records to
+        :type path: str
+        """
+        self.backend = backend
+        self.path = path
+
+        # The archive is opened on the first record
+        self._archive = None
+        self._ordinals = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def key(method: HttpMethod, url: str, params: Any = None) -> str:
+        """
+        Returns the key identifying a request. Only the path and sorted query
+        are used so an archive can be replayed against any host.
+
+        :param method: The HTTP request type
+        :type method: HttpMethod
+        :param url: The URL of the request
+        :type url: str
+        :param params: The query parameters passed with the request
+        :type params: Any, defaults to None
+        :return: The key for the request
+        :rtype: str
+        """
+        url_builder = furl(url)
+        query = list(url_builder.query.params.allitems())
+        if isinstance(params, dict):
+            for name, value in params.items():
+                query.extend((name, v) for v in (value if isinstance(value, (list, tuple)) else [value]))
+        elif params:
+            query.extend(params)
+
+        path = "/" + "/".join(s for s in url_builder.path.segments if s)
+        query = urllib.parse.urlencode(sorted((str(k), str(v)) for k, v in query))
+        return f"{method.upper()} {path}{'?' + query if query else ''}"
+
+    @staticmethod
+    def body_hash(json: Any = None, data: Any = None) -> Optional[str]:
+        """
+        Returns a hash of the body of a request, if any.
+
+        :param json: The JSON body of the request
+        :type json: Any, defaults to None
+        :param data: The raw body of the request
+        :type data: Any, defaults to None
+        :return: The SHA-256 hex digest of the body
+        :rtype: Optional[str]
+        """
+        body = json if json is not None else data
+        if body is None:
+            return None
+        if isinstance(body, str):
+            body = body.encode()
+        elif not isinstance(body, bytes):
+            body = libjson.dumps(body, sort_keys=True, default=str).encode()
+
+        return hashlib.sha256(body).hexdigest()
+
+    def record(self, method: HttpMethod, url: str, kwargs: dict, response: requests.Response, elapsed: float):
+        """
+        Appends a request and its response to the archive.
+
+        :param method: The HTTP request type
+        :type method: HttpMethod
+        :param url: The URL of the request
+        :type url: str
+        :param kwargs: The keyword arguments the request was made with
+        :type kwargs: dict
+        :param response: The response returned
+        :type response: requests.Response
+        :param elapsed: The seconds the request took
+        :type elapsed: float
+        """
+        key = RecordingBackend.key(method, url, kwargs.get("params"))
+        body = RecordingBackend.body_hash(kwargs.get("json"), kwargs.get("data"))
+        content = response.content or b""
+        try:
+            content, encoding = content.decode("utf-8"), None
+        except UnicodeDecodeError:
+            content, encoding = base64.b64encode(content).decode(), "base64"
+
+        with self._lock:
+            ordinal = self._ordinals[(key, body)]
+            self._ordinals[(key, body)] += 1
+
+            record = {
+                "key": key,
+                "body": body,
+                "ordinal": ordinal,
+                "url": url,
+                "headers": {
+                    k: v
+                    for k, v in (kwargs.get("headers") or {}).items()
+                    if k.lower() not in RecordingBackend.REDACTED_HEADERS
+                },
+                "elapsed": round(elapsed, 6),
+                "response": {
+                    "status": response.status_code,
+                    "url": response.url,
+                    "headers": {
+                        k: v for k, v in response.headers.items() if k.lower() not in RecordingBackend.DROPPED_HEADERS
+                    },
+                    "content": content,
+                    "encoding": encoding,
+                },
+            }
+
+            if self._archive is None:
+                self._archive = gzip.open(self.path, "at", encoding="utf-8")
+            self._archive.write(libjson.dumps(record, separators=(",", ":")) + "\n")
+
+    def request(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        Makes the request through the wrapped backend and records it.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        start = time.monotonic()
+        response = self.backend.request(method, url, **kwargs)
+        self.record(method, url, kwargs, response, time.monotonic() - start)
+
+        return response
+
+    def send(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a single request through the wrapped backend without recording it.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        return self.backend.send(method, url, **kwargs)
+
+    def flush(self):
+        """
+        Flushes recorded requests to disk.
+        """
+        with self._lock:
+            if self._archive is not None:
+                self._archive.flush()
+
+    def close(self):
+        """
+        Closes the archive and the wrapped backend.
+        """
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+
+        self.backend.close()
+
+
+class ReplayBackend(Backend):
+    """
+    Serves responses from an archive written by `RecordingBackend` instead
+    of making requests. Requests are matched on method, path, query, body
+    and the order in which identical requests were made, so replaying the
+    same sequence of calls always returns the same responses. Replayed
+    requests are not retried or rate-limited.
+    """
+
+    class MissingRecording(LookupError):
+        """
+        Raised when a request has no recorded response.
+        """
+
+        pass
+
+    def __init__(
+        self,
+        path: str,
+        latency: Union[float, Callable[[dict], float]] = None,
+        match_body: bool = True,
+    ):
+        """
+        Loads the archive to replay.
+
+        :param path: The path of the archive
+        :type path: str
+        :param latency: Seconds to delay each response, or a callable returning the delay for a record
+        :type latency: Union[float, Callable[[dict], float]], defaults to None
+        :param match_body: Whether request bodies must match the recorded ones
+        :type match_body: bool, defaults to True
+        """
+        self.path = path
+        self.latency = latency
+        self.match_body = match_body
+
+        # Index records by request and ordinal
+        self._records = collections.defaultdict(list)
+        with gzip.open(path, "rt", encoding="utf-8") as archive:
+            for line in archive:
+                if line.strip():
+                    record = libjson.loads(line)
+                    self._records[self._record_key(record["key"], record["body"])].append(record)
+
+        self._ordinals = collections.Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def recorded_latency(scale: float = 1.0) -> Callable[[dict], float]:
+        """
+        Returns a latency function that delays each response by the time
+        the original request took, multiplied by `scale`.
+
+        :param scale: The multiplier for the recorded time
+        :type scale: float, defaults to 1.0
+        :return: The latency function
+        :rtype: Callable[[dict], float]
+        """
+        return lambda record: record["elapsed"] * scale
+
+    def _record_key(self, key: str, body: Optional[str]) -> tuple:
+        return (key, body) if self.match_body else (key,)
+
+    def __len__(self) -> int:
+        return sum(len(records) for records in self._records.values())
+
+    def rewind(self):
+        """
+        Resets the ordinals so the archive can be replayed again from the start.
+        """
+        with self._lock:
+            self._ordinals.clear()
+
+    def sleep(self, seconds: float):
+        """
+        Sleeps for the simulated latency.
+
+        :param seconds: The number of seconds to sleep
+        :type seconds: float
+        """
+        time.sleep(seconds)
+
+    def lookup(self, method: HttpMethod, url: str, **kwargs) -> dict:
+        """
+        Returns the record for the request. Once the recorded responses for
+        a repeated request are used up, the last one is returned again.
+
+        :param method: The HTTP request type
+        :type method: HttpMethod
+        :param url: The URL of the request
+        :type url: str
+        :raises ReplayBackend.MissingRecording: If the request was not recorded
+        :return: The record
+        :rtype: dict
+        """
+        key = RecordingBackend.key(method, url, kwargs.get("params"))
+        body = RecordingBackend.body_hash(kwargs.get("json"), kwargs.get("data"))
+        record_key = self._record_key(key, body)
+
+        records = self._records.get(record_key)
+        if not records:
+            raise ReplayBackend.MissingRecording(f"No recorded response for: {key}")
+
+        with self._lock:
+            ordinal = self._ordinals[record_key]
+            self._ordinals[record_key] += 1
+
+        return records[min(ordinal, len(records) - 1)]
+
+    def request(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        Returns the recorded response for the request.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        return self.send(method, url, **kwargs)
+
+    def send(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        Builds the recorded response for the request, after the simulated latency.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        record = self.lookup(method, url, **kwargs)
+
+        # Simulate the network
+        latency = self.latency(record) if callable(self.latency) else self.latency
+        if latency:
+            self.sleep(latency)
+
+        # Build the response
+        recorded = record["response"]
+        content = recorded["content"]
+        content = base64.b64decode(content) if recorded.get("encoding") == "base64" else content.encode("utf-8")
+
+        response = requests.Response()
+        response.status_code = recorded["status"]
+        response.reason = http.HTTPStatus(recorded["status"]).phrase
+        response.url = recorded["url"]
+        response.encoding = "utf-8"
+        response.headers = requests.structures.CaseInsensitiveDict(recorded["headers"])
+        response._content = content
+        response.request = requests.Request(method.upper(), url).prepare()
+
+        return response
+
+
+class BundleView(dict):
+    """
+    A Bundle as a dict along with indexes of the resources it contains by
+    resource type, by `ResourceType/id` and by the references made to each
+    of them. Methods of `FHIR` that search bundles use the indexes when
+    passed a view rather than walking the bundle on every call.
+
+    Indexes are built once when the view is created, save for the reference
+    index which is built on first use, so the bundle must not be modified
+    afterwards. Resources are also instantiated as fhirclient models on
+    demand, at most once each, so flattening steps can share them.
+    """
+
+    def __init__(self, bundle: Union[Bundle, dict]):
+        """
+        :param bundle: The bundle to index
+        :type bundle: Union[Bundle, dict]
+        """
+        if isinstance(bundle, Resource):
+            bundle = bundle.as_json()
+        super().__init__(bundle or {})
+
+        # Index resources in the order they appear in the bundle
+        if self.get("resourceType") == "Bundle":
+            self.resources = [e["resource"] for e in self.get("entry", []) if e.get("resource")]
+        else:
+            self.resources = FHIR.find_resources(dict(self)) if bundle else []
+        self._types = {}
+        self._ids = {}
+        for resource in self.resources:
+            self._types.setdefault(resource.get("resourceType"), []).append(resource)
+            if resource.get("id"):
+                self._ids.setdefault(f"{resource.get('resourceType')}/{resource['id']}", resource)
+
+        self._referrers = None
+        self._models = {}
+
     @classmethod
-    def instance(cls, url: str) -> Self:
+    def of(cls, bundle: Union[Bundle, dict]) -> "BundleView":
+        """
+        Returns the passed bundle if it is already a view, otherwise a new
+        view of it.
+
+        :param bundle: The bundle
+        :type bundle: Union[Bundle, dict]
+        :return: A view of the bundle
+        :rtype: BundleView
+        """
+        return bundle if isinstance(bundle, cls) else cls(bundle)
+
+    @staticmethod
+    def reference(reference: str) -> Optional[str]:
+        """
+        Returns the passed reference as `ResourceType/id`, dropping any base
+        URL and version. Returns None for contained and malformed references.
+
+        :param reference: The reference
+        :type reference: str
+        :return: The `ResourceType/id` reference
+        :rtype: Optional[str]
+        """
+        parts = reference.split("/_history/")[0].rstrip("/").split("/")
+        if len(parts) < 2 or not parts[-2] or not parts[-1]:
+            return None
+
+        return "/".join(parts[-2:])
+
+    @staticmethod
+    def _references(obj: Any):
+        """
+        Yields each reference made anywhere within the passed object.
+
+        :param obj: The resource or element to search
+        :type obj: Any
+        """
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                if key == "reference" and isinstance(value, str):
+                    reference = BundleView.reference(value)
+                    if reference:
+                        yield reference
+                else:
+                    yield from BundleView._references(value)
+
+        elif isinstance(obj, list):
+            for value in obj:
+                yield from BundleView._references(value)
+
+    def find(self, resource_types: list[str] = None, filter: Callable[[dict], bool] = None) -> list[dict]:
+        """
+        Returns the resources in the bundle matching the passed resource
+        types and filter, if passed, in the order they appear.
+
+        :param resource_types: A list of FHIR resource types to filter on
+        :type resource_types: list[str], defaults to None
+        :param filter: A lambda method to filter the found resources
+        :type filter: Callable[[dict], bool], defaults to None
+        :return: A list of FHIR resources
+        :rtype: list[dict]
+        """
+        if not resource_types:
+            resources = list(self.resources)
+        elif len(resource_types) == 1:
+            resources = list(self._types.get(next(iter(resource_types)), []))
+        else:
+            resources = [r for r in self.resources if r.get("resourceType") in resource_types]
+
+        # If a filter is passed, run the list of resources through
+        if filter:
+            resources = [r for r in resources if filter(r)]
+
+        return resources
+
+    def resource(self, resource_type: str, resource_id: str = None) -> Optional[dict]:
+        """
+        Returns the resource in the bundle for the passed type and ID, or
+        for a reference if only that is passed.
+
+        :param resource_type: The resource type, or a reference
+        :type resource_type: str
+        :param resource_id: The resource ID
+        :type resource_id: str, defaults to None
+        :return: The resource, if in the bundle
+        :rtype: Optional[dict]
+        """
+        if resource_id:
+            return self._ids.get(f"{resource_type}/{resource_id}")
+
+        return self._ids.get(BundleView.reference(resource_type))
+
+    def referencing(self, reference: str, resource_types: list[str] = None) -> list[dict]:
         """
-        This method inspects the current setting for FHIR URL and returns
-        an instance of the Backend class that is being used for FHIR.
+        Returns the resources in the bundle that reference the passed
+        resource, e.g. everything pointing at `Patient/x`.
 
-        :param url: The URL of the FHIR backend instance
-        :type url: str
-        :return: An instance of the concrete Backend class
-        :rtype: Backend
+        :param reference: The reference to the resource
+        :type reference: str
+        :param resource_types: A list of FHIR resource types to filter on
+        :type resource_types: list[str], defaults to None
+        :return: A list of FHIR resources
+        :rtype: list[dict]
         """
-        # Check for AWS
-        if "amazonaws.com" in url:
-            return AWSHealthlake()
-        elif "googleapis.com" in url:
-            return GCPHealthcareAPI()
-        elif "azurehealthcareapis.com" in url:
-            return AzureHealthcareAPI()
-        else:
-            return HAPIFHIR()
+        # Index references on first use
+        if self._referrers is None:
+            referrers = {}
+            for resource in self.resources:
+                for target in set(BundleView._references(resource)):
+                    referrers.setdefault(target, []).append(resource)
 
-    @abstractmethod
-    def request(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+            self._referrers = referrers
+
+        resources = self._referrers.get(BundleView.reference(reference), [])
+        if resource_types:
+            return [r for r in resources if r.get("resourceType") in resource_types]
+
+        return list(resources)
+
+    def model(self, resource: Optional[dict]) -> Optional[Resource]:
         """
-        A generic method implementation for an HTTP request to a FHIR instance.
+        Returns the passed resource from the bundle as a fhirclient model,
+        instantiating it strictly on first use.
 
-        :param method: The HTTP request type to make
-        :type method: HttpMethod
-        :param url: The URL to make the request to
-        :type url: str
-        :return: The response object from the request
-        :rtype: requests.Response
+        :param resource: The resource
+        :type resource: Optional[dict]
+        :raises FHIRValidationError: If the resource is invalid
+        :return: The model, if a resource is passed
+        :rtype: Optional[Resource]
         """
-        pass
+        if resource is None:
+            return None
 
+        # Key on identity as resources are not hashable
+        model = self._models.get(id(resource))
+        if model is None:
+            model = self._models[id(resource)] = FHIRElementFactory.instantiate(resource["resourceType"], resource)
 
-class AWSHealthlake(Backend):
-    def request(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        return model
+
+    def models(self, resource_types: list[str] = None, filter: Callable[[dict], bool] = None) -> list[Resource]:
         """
-        A generic method implementation for an HTTP GET to a Healthlake
-        FHIR instance.
+        Returns the resources in the bundle matching the passed resource
+        types and filter as fhirclient models.
 
-        :param method: The HTTP request type to make
-        :type method: HttpMethod
-        :param url: The URL to make the request to
-        :type url: str
-        :return: The response object from the request
-        :rtype: requests.Response
+        :param resource_types: A list of FHIR resource types to filter on
+        :type resource_types: list[str], defaults to None
+        :param filter: A lambda method to filter the found resources
+        :type filter: Callable[[dict], bool], defaults to None
+        :return: A list of models
+        :rtype: list[Resource]
+        """
+        return [self.model(r) for r in self.find(resource_types, filter=filter)]
+
+
+class FlattenedParticipant(collections.abc.Mapping):
+    """
+    A participant record from `FHIR.flatten_participant` whose sections are
+    only flattened once one of their keys is first accessed. Iterating over
+    the record, or converting it to a dict, flattens every section.
+    """
+
+    # The keys set by each section, any others are set by the study's section
+    SECTION_KEYS = {
+        "enrollment": [
+            "enrollment",
+            "date_enrollment_updated",
+            "datetime_enrollment_updated",
+            "enrollment_accepted_date",
+            "enrollment_terminated_date",
+        ],
+        "composition": ["composition"],
+        "questionnaires": ["questionnaires", "questionnaire"],
+        "points_of_care": ["points_of_care"],
+        "devices": ["devices"],
+        "research_studies": ["research_studies"],
+    }
+
+    def __init__(self, values: dict, sections: dict[str, Callable[[], dict]], extra: dict = None):
+        """
+        :param values: The values flattened so far
+        :type values: dict
+        :param sections: Callables returning the values of each section
+        :type sections: dict[str, Callable[[], dict]]
+        :param extra: Properties to log with any errors
+        :type extra: dict, defaults to None
+        """
+        self._values = dict(values)
+        self._sections = dict(sections)
+        self._results = {}
+        self._extra = extra or {}
+
+    def _flatten(self, name: str) -> dict:
+        """
+        Returns the values of the section, flattening it on first use.
+
+        :param name: The name of the section
+        :type name: str
+        :return: The values of the section
+        :rtype: dict
         """
-        # Get region
-        region = os.environ.get("AWS_REGION", "us-east-1")
-        session = boto3.session.Session(region_name=region)
-        auth = AWSSigV4("healthlake", session=session)
+        if name not in self._results and name in self._sections:
+            try:
+                self._results[name] = self._sections[name]()
 
-        # Make the request
-        return requests.request(method=method, url=url, auth=auth, **kwargs)
+            except Exception as e:
+                logger.exception("FHIR error: {}".format(e), exc_info=True, extra=self._extra)
+                self._results[name] = {}
 
+        return self._results.get(name, {})
 
-class GCPHealthcareAPI(Backend):
+    def __getitem__(self, key: str) -> Any:
+        if key in self._values:
+            return self._values[key]
 
-    _SETTINGS_CACHE_KEY = "_GOOGLE_OAUTH2_CACHED_TOKEN"
-    _SETTINGS_CACHE_TOKEN_KEY = "token"
-    _SETTINGS_CACHE_EXPIRY_KEY = "expiry"
+        # Find the section setting it
+        name = next((n for n, keys in self.SECTION_KEYS.items() if key in keys), "study")
+        return self._flatten(name)[key]
 
-    @property
-    def session(self) -> requests.Session:
+    def __iter__(self):
+        keys = dict.fromkeys(self._values)
+        for name in self._sections:
+            keys.update(dict.fromkeys(self._flatten(name)))
 
-        # Check cache for token
-        cache = getattr(settings, self._SETTINGS_CACHE_KEY, {})
-        token = cache.get(self._SETTINGS_CACHE_TOKEN_KEY)
-        expiry = cache.get(self._SETTINGS_CACHE_EXPIRY_KEY)
-        if expiry:
-            expiry = parse(expiry)
-            logger.debug(f"PPM/FHIR/GCP: Token expires in: {int((expiry - datetime.utcnow()).total_seconds())}")
+        return iter(keys)
 
-        if token is None or expiry is None or datetime.utcnow() >= expiry:
+    def __len__(self) -> int:
+        return len(list(iter(self)))
 
-            # Check whether credentials are string or file
-            if os.environ[PPM_GCP_CREDENTIALS_KEY].startswith("/"):
-                logger.debug("PPM/FHIR: GCS credentials via file")
-                credentials = service_account.Credentials.from_service_account_file(os.environ[PPM_GCP_CREDENTIALS_KEY])
-            else:
-                # Gets credentials from the environment.
-                logger.debug("PPM/FHIR: GCS credentials via environment variable")
-                credentials = service_account.Credentials.from_service_account_info(
-                    libjson.loads(base64.b64decode(os.environ[PPM_GCP_CREDENTIALS_KEY].encode()).decode())
-                )
+    def __repr__(self) -> str:
+        return f"FlattenedParticipant({self._values}, sections={list(self._sections)})"
 
-            # Set scopes
-            scoped_credentials = credentials.with_scopes(["https://www.googleapis.com/auth/cloud-platform"])
 
-            # Get token
-            logger.debug("PPM/FHIR/GCP: Refreshing credentials")
-            scoped_credentials.refresh(google_requests.Request())
+class QuestionnaireIndex(object):
+    """
+    An index of a Questionnaire's items by linkId along with the path of
+    items leading to each, the enableWhen conditions applying to each and
+    the repeating group containing each, if any. An index is kept for each
+    Questionnaire model and shared by models of the same `version` and
+    `meta.versionId`, so each version's item tree is only walked once.
 
-            # Set local variables
-            token = scoped_credentials.token
-            expiry = scoped_credentials.expiry.isoformat()
+    Each item's enableWhen conditions are compiled along with its
+    enableBehavior, and items are ordered so each follows its parent and the
+    questions its conditions depend on. Every item of a response can then be
+    checked in one pass over its answers, ignoring answers to questions that
+    are themselves disabled.
+    """
 
-            # Save token and expiry in settings
-            setattr(
-                settings,
-                self._SETTINGS_CACHE_KEY,
-                {
-                    self._SETTINGS_CACHE_TOKEN_KEY: token,
-                    self._SETTINGS_CACHE_EXPIRY_KEY: expiry,
-                },
-            )
-            logger.debug(f"PPM/FHIR/GCP: New token expiry: {expiry}")
+    # The default number of versioned indexes to keep
+    MAX_SIZE = 128
 
-        # Create a session
-        session = requests.Session()
-        session.headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/fhir+json",
-        }
+    # The enableWhen operators, other than `exists` and `!=`, and their comparisons
+    OPERATORS = {
+        "=": lambda answer, value: answer == value,
+        ">": lambda answer, value: answer > value,
+        "<": lambda answer, value: answer < value,
+        ">=": lambda answer, value: answer >= value,
+        "<=": lambda answer, value: answer <= value,
+    }
 
-        return session
+    _indexes = collections.OrderedDict()
+    _models = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
 
-    def request(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+    def __init__(self, questionnaire: Questionnaire):
         """
-        A generic method implementation for an HTTP GET to a GCP Healthcare API
-        FHIR instance.
+        :param questionnaire: The Questionnaire to index
+        :type questionnaire: Questionnaire
+        """
+        self.items = {}
+        self.paths = {}
+        self.enable_whens = {}
+        self.repeating_groups = {}
+        self.rules = {}
+        self.dependents = {}
+        self._index(questionnaire.item, [])
+        self.order = self._order()
+
+    def _index(self, items: list[QuestionnaireItem], parents: list[QuestionnaireItem]):
+        """
+        Indexes the passed items and their subitems depth first, the first
+        item found for a linkId wins.
+
+        :param items: The items to index
+        :type items: list[QuestionnaireItem]
+        :param parents: The items leading to these items
+        :type parents: list[QuestionnaireItem]
+        """
+        for item in items or []:
+            path = parents + [item]
+            if item.linkId not in self.items:
+                self.items[item.linkId] = item
+                self.paths[item.linkId] = path
+                self.enable_whens[item.linkId] = [e for i in path for e in i.enableWhen or []]
+                self.repeating_groups[item.linkId] = next((i for i in path if i.type == "group" and i.repeats), None)
+
+                # Compile its own conditions
+                if item.enableWhen:
+                    conditions = [QuestionnaireIndex._compile(e) for e in item.enableWhen]
+                    self.rules[item.linkId] = (item.enableBehavior or "all", conditions)
+                    for enable_when in item.enableWhen:
+                        self.dependents.setdefault(enable_when.question, []).append(item.linkId)
+
+            self._index(item.item, path)
+
+    def _order(self) -> list[str]:
+        """
+        Returns the linkIds ordered so that each follows its parent and the
+        questions its conditions depend on. Items in a dependency cycle are
+        placed last in the order they appear.
+
+        :return: The ordered linkIds
+        :rtype: list[str]
+        """
+        # Count what each item waits on and what waits on each item
+        waiting = {link_id: 0 for link_id in self.items}
+        followers = {link_id: [] for link_id in self.items}
+        for link_id, path in self.paths.items():
+            if len(path) > 1 and path[-2].linkId in followers:
+                followers[path[-2].linkId].append(link_id)
+                waiting[link_id] += 1
+        for question, dependents in self.dependents.items():
+            if question in followers:
+                for dependent in dependents:
+                    followers[question].append(dependent)
+                    waiting[dependent] += 1
+
+        # Take items once nothing is left to wait on
+        ready = collections.deque(link_id for link_id, count in waiting.items() if not count)
+        order = []
+        while ready:
+            link_id = ready.popleft()
+            order.append(link_id)
+            for follower in followers[link_id]:
+                waiting[follower] -= 1
+                if not waiting[follower]:
+                    ready.append(follower)
+
+        # Add any left in a cycle
+        ordered = set(order)
+        return order + [link_id for link_id in self.items if link_id not in ordered]
+
+    @staticmethod
+    def _compile(enable_when: QuestionnaireItemEnableWhen) -> tuple[str, str, Any]:
+        """
+        Returns the question, operator and answer value of the passed
+        condition. The answer value is None if its type is not handled.
+
+        :param enable_when: The condition
+        :type enable_when: QuestionnaireItemEnableWhen
+        :return: The question, operator and answer value
+        :rtype: tuple[str, str, Any]
+        """
+        # The operator is not available on FHIR R3 and below
+        operator = getattr(enable_when, "operator", None) or "="
+        if operator not in ("exists", "!=") and operator not in QuestionnaireIndex.OPERATORS:
+            logger.error(f"PPM/FHIR: Unhandled enableWhen operation type: {enable_when.as_json()}")
+            return enable_when.question, operator, None
+
+        # Check for answer type
+        if enable_when.answerString is not None:
+            value = enable_when.answerString
+        elif enable_when.answerBoolean is not None:
+            value = enable_when.answerBoolean
+        elif enable_when.answerDate is not None:
+            value = enable_when.answerDate.isostring
+        elif enable_when.answerDateTime is not None:
+            value = enable_when.answerDateTime.isostring
+        elif enable_when.answerTime is not None:
+            value = enable_when.answerTime.isostring
+        elif enable_when.answerInteger is not None:
+            value = enable_when.answerInteger
+        elif enable_when.answerDecimal is not None:
+            value = enable_when.answerDecimal
+        elif enable_when.answerCoding is not None:
+            value = (enable_when.answerCoding.system, enable_when.answerCoding.code)
+        else:
+            logger.error(f"PPM/FHIR: Unhandled enableWhen answer type: {enable_when.as_json()}")
+            value = None
 
-        :param method: The HTTP request type to make
-        :type method: HttpMethod
-        :param url: The URL to make the request to
-        :type url: str
-        :return: The response object from the request
-        :rtype: requests.Response
+        return enable_when.question, operator, value
+
+    @staticmethod
+    def _evaluate(condition: tuple[str, str, Any], answers: dict[str, list], enabled: dict[str, bool]) -> bool:
         """
-        # Make the request
-        response = self.session.request(method=method, url=url, **kwargs)
+        Returns whether the compiled condition is met by the answers. The
+        answers of disabled questions are treated as absent.
+
+        :param condition: The compiled condition
+        :type condition: tuple[str, str, Any]
+        :param answers: The answers of the response by linkId
+        :type answers: dict[str, list]
+        :param enabled: Whether each item evaluated so far is enabled
+        :type enabled: dict[str, bool]
+        :return: Whether the condition is met
+        :rtype: bool
+        """
+        question, operator, value = condition
+        answer = (answers.get(question) or []) if enabled.get(question, True) else []
 
-        # Check for a session reset
-        if response and response.status_code in [401, 403]:
+        # Check for an answer
+        if operator == "exists":
+            return bool(answer) == bool(value)
 
-            # Reset and try again
-            self._session = None
+        # Check that any of the answers compare, or that none are equal
+        if value is None or not answer:
+            return False
 
-            response = self.session.request(method=method, url=url, **kwargs)
+        # Codings match on code, and on system only when the condition names one
+        if type(value) is tuple and value[0] is None:
+            value, answer = value[1], [a[1] if type(a) is tuple else a for a in answer]
 
-        return response
+        try:
+            if operator == "!=":
+                return not any(a == value for a in answer)
 
+            return any(QuestionnaireIndex.OPERATORS[operator](a, value) for a in answer)
 
-class AzureHealthcareAPI(Backend):
-    def request(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        except TypeError:
+            return False
+
+    @staticmethod
+    def answers(questionnaire_response: QuestionnaireResponse) -> dict[str, list]:
         """
-        A generic method implementation for an HTTP GET to a Azure Healthcare
-        APIs FHIR instance.
+        Returns the answer values of the passed response by linkId, taking
+        the first item found for each linkId.
 
-        :param method: The HTTP request type to make
-        :type method: HttpMethod
-        :param url: The URL to make the request to
-        :type url: str
-        :return: The response object from the request
-        :rtype: requests.Response
+        :param questionnaire_response: The response
+        :type questionnaire_response: QuestionnaireResponse
+        :return: The answer values by linkId
+        :rtype: dict[str, list]
+        """
+        answers = {}
+
+        def collect(items: list[QuestionnaireResponseItem]):
+            for item in items or []:
+                if item.linkId not in answers:
+                    answers[item.linkId] = []
+                    for answer in item.answer or []:
+                        if answer.valueString is not None:
+                            answers[item.linkId].append(answer.valueString)
+                        elif answer.valueBoolean is not None:
+                            answers[item.linkId].append(answer.valueBoolean)
+                        elif answer.valueInteger is not None:
+                            answers[item.linkId].append(answer.valueInteger)
+                        elif answer.valueDecimal is not None:
+                            answers[item.linkId].append(answer.valueDecimal)
+                        elif answer.valueDate is not None:
+                            answers[item.linkId].append(answer.valueDate.isostring)
+                        elif answer.valueDateTime is not None:
+                            answers[item.linkId].append(answer.valueDateTime.isostring)
+                        elif answer.valueTime is not None:
+                            answers[item.linkId].append(answer.valueTime.isostring)
+                        elif answer.valueCoding is not None:
+                            answers[item.linkId].append((answer.valueCoding.system, answer.valueCoding.code))
+                        else:
+                            logger.error(f"PPM/FHIR: Unhandled answer type: {answer.as_json()}")
+
+                collect(item.item)
+
+        collect(questionnaire_response.item)
+        return answers
+
+    def enabled(self, questionnaire_response: QuestionnaireResponse) -> dict[str, bool]:
         """
-        raise NotImplementedError("Azure Healthcare APIs not yet supported")
+        Returns whether each item is enabled by the passed response, keyed
+        by linkId. An item is enabled if its own conditions are met
+        according to its enableBehavior and its parent is enabled. Items
+        are evaluated in dependency order so conditions on a disabled
+        question see no answer.
 
+        :param questionnaire_response: The response
+        :type questionnaire_response: QuestionnaireResponse
+        :return: Whether each item is enabled
+        :rtype: dict[str, bool]
+        """
+        answers = QuestionnaireIndex.answers(questionnaire_response)
 
-class HAPIFHIR(Backend):
-    def request(self, method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        # Evaluate parents and questions before the items depending on them
+        enabled = {}
+        for link_id in self.order:
+            path = self.paths[link_id]
+            if len(path) > 1 and not enabled.get(path[-2].linkId, True):
+                enabled[link_id] = False
+                continue
+
+            # Check its own conditions
+            behavior, conditions = self.rules.get(link_id, ("all", []))
+            results = (QuestionnaireIndex._evaluate(c, answers, enabled) for c in conditions)
+            enabled[link_id] = any(results) if behavior == "any" else all(results)
+
+        return {link_id: enabled[link_id] for link_id in self.paths}
+
+    @staticmethod
+    def key(questionnaire: Questionnaire) -> Optional[tuple]:
         """
-        A generic method implementation for an HTTP GET to a HAPI-FHIR instance.
+        Returns the key to share an index of the Questionnaire by, if it is
+        versioned.
 
-        :param method: The HTTP request type to make
-        :type method: HttpMethod
-        :param url: The URL to make the request to
-        :type url: str
-        :return: The response object from the request
-        :rtype: requests.Response
+        :param questionnaire: The Questionnaire
+        :type questionnaire: Questionnaire
+        :return: The key, if versioned
+        :rtype: Optional[tuple]
         """
-        # Make the request
-        return requests.request(method=method, url=url, **kwargs)
+        version_id = questionnaire.meta.versionId if questionnaire.meta else None
+        if not questionnaire.id or not (questionnaire.version or version_id):
+            return None
+
+        return questionnaire.id, questionnaire.version, version_id
+
+    @classmethod
+    def of(cls, questionnaire: Questionnaire) -> "QuestionnaireIndex":
+        """
+        Returns the index of the passed Questionnaire, building it if it
+        has not been indexed yet.
+
+        :param questionnaire: The Questionnaire
+        :type questionnaire: Questionnaire
+        :return: The index
+        :rtype: QuestionnaireIndex
+        """
+        key = cls.key(questionnaire)
+        with cls._lock:
+            index = cls._models.get(questionnaire)
+            if index is None and key in cls._indexes:
+                index = cls._indexes[key]
+                cls._indexes.move_to_end(key)
+                cls._models[questionnaire] = index
+
+        if index is not None:
+            return index
+
+        # Build it and keep it
+        index = cls(questionnaire)
+        with cls._lock:
+            cls._models[questionnaire] = index
+            if key:
+                cls._indexes[key] = index
+                while len(cls._indexes) > _setting("FHIR_QUESTIONNAIRE_INDEX_CACHE_SIZE", cls.MAX_SIZE):
+                    cls._indexes.popitem(last=False)
+
+        return index
+
+    @classmethod
+    def clear(cls):
+        """
+        Drops all indexes.
+        """
+        with cls._lock:
+            cls._indexes.clear()
+            cls._models.clear()
+
+    def item(self, link_id: str) -> Optional[QuestionnaireItem]:
+        """
+        Returns the item for the passed linkId.
+
+        :param link_id: The linkId of the item
+        :type link_id: str
+        :return: The item, if found
+        :rtype: Optional[QuestionnaireItem]
+        """
+        return self.items.get(link_id)
+
+    def path(self, link_id: str) -> list[QuestionnaireItem]:
+        """
+        Returns the items from the top-most level down to the item for the
+        passed linkId.
+
+        :param link_id: The linkId of the item
+        :type link_id: str
+        :return: The items forming a path to the item
+        :rtype: list[QuestionnaireItem]
+        """
+        return list(self.paths.get(link_id, []))
+
+    def conditions(self, link_id: str) -> list[QuestionnaireItemEnableWhen]:
+        """
+        Returns the enableWhen conditions of the item for the passed linkId
+        and those of its antecedents.
+
+        :param link_id: The linkId of the item
+        :type link_id: str
+        :return: The conditions
+        :rtype: list[QuestionnaireItemEnableWhen]
+        """
+        return list(self.enable_whens.get(link_id, []))
+
+    def repeating_group(self, link_id: str) -> Optional[QuestionnaireItem]:
+        """
+        Returns the repeating group containing the item for the passed linkId.
+
+        :param link_id: The linkId of the item
+        :type link_id: str
+        :return: The group, if any
+        :rtype: Optional[QuestionnaireItem]
+        """
+        return self.repeating_groups.get(link_id)
 
 
 class FHIR:
@@ -350,26 +4403,338 @@ class FHIR:
         "List:item",
     ]
 
+    # The sections of a flattened participant that can be requested
+    PARTICIPANT_FIELDS = [
+        "enrollment",
+        "composition",
+        "questionnaires",
+        "points_of_care",
+        "devices",
+        "research_studies",
+        "study",
+    ]
+
     #
     # META
     #
 
     _backend = None
+    _backend_lock = threading.Lock()
+
+    # Set to override the `FHIR_COALESCE_GETS` setting
+    COALESCE_GETS = None
+    _coalescer = RequestCoalescer()
+
+    # Resource types that rarely change and are read conditionally
+    CONDITIONAL_READ_TYPES = ["Questionnaire", "ResearchStudy", "Organization"]
+    _conditional_reads = ConditionalReadCache()
+
+    # Hooks called around every request
+    instrumentation = Instrumentation()
+
+    # Set with `set_resource_cache` to override the `FHIR_RESOURCE_CACHE` setting
+    _resource_cache = None
+    _resource_cache_lock = threading.Lock()
+
+    # Set with `set_reference_cache` to override the `FHIR_REFERENCE_CACHE` setting
+    _reference_cache = None
+    _reference_cache_lock = threading.Lock()
+
+    # Set with `set_participant_cache` to override the `FHIR_PARTICIPANT_CACHE` setting
+    _participant_cache = None
+    _participant_cache_lock = threading.Lock()
 
     @classmethod
-    def backend(cls):
+    def backend(cls) -> Backend:
+        """
+        Returns the process-wide Backend instance for the configured FHIR
+        URL. The instance, and therefore its connection pool, is shared by
+        every `FHIR` call and across threads.
 
+        :return: The Backend instance
+        :rtype: Backend
+        """
         if cls._backend is None:
+            with cls._backend_lock:
+                if cls._backend is None:
 
-            # Get the backend class instance
-            cls._backend = Backend.instance(url=PPM.fhir_url())
+                    # Get the backend class instance
+                    cls._backend = Backend.instance(url=PPM.fhir_url())
 
         return cls._backend
 
+    @classmethod
+    def set_backend(cls, backend: Optional[Backend]):
+        """
+        Sets the Backend instance used for all `FHIR` calls, e.g. a
+        `LocalFHIR` instance for testing. Passing `None` resets it to the
+        backend for the configured FHIR URL.
+
+        :param backend: The Backend instance to use
+        :type backend: Optional[Backend]
+        """
+        with cls._backend_lock:
+            cls._backend = backend
+
+    @classmethod
+    def resource_cache(cls) -> Optional[ResourceCache]:
+        """
+        Returns the cache of resources read from FHIR, if enabled. The
+        `FHIR_RESOURCE_CACHE` setting enables a process-local cache if
+        `True`, or one stored in the Django cache if "django".
+
+        :return: The resource cache, if enabled
+        :rtype: Optional[ResourceCache]
+        """
+        if cls._resource_cache is None:
+            with cls._resource_cache_lock:
+                if cls._resource_cache is None:
+                    setting = _setting("FHIR_RESOURCE_CACHE", False)
+                    if setting == "django":
+                        cls._resource_cache = DjangoResourceCache()
+                    elif setting:
+                        cls._resource_cache = ResourceCache()
+                    else:
+                        cls._resource_cache = False
+
+        return cls._resource_cache or None
+
+    @classmethod
+    def set_resource_cache(cls, cache: Union[ResourceCache, bool, None]):
+        """
+        Sets the cache of resources read from FHIR. Passing `False`
+        disables caching and passing `None` resets it to the
+        `FHIR_RESOURCE_CACHE` setting.
+
+        :param cache: The resource cache to use
+        :type cache: Union[ResourceCache, bool, None]
+        """
+        with cls._resource_cache_lock:
+            cls._resource_cache = cache
+
+    @classmethod
+    def reference_cache(cls) -> Optional[ReferenceCache]:
+        """
+        Returns the cache of the rarely changing resources in
+        `CONDITIONAL_READ_TYPES` that are shared by participants, if
+        enabled with the `FHIR_REFERENCE_CACHE` setting.
+
+        :return: The reference cache, if enabled
+        :rtype: Optional[ReferenceCache]
+        """
+        if cls._reference_cache is None:
+            with cls._reference_cache_lock:
+                if cls._reference_cache is None:
+                    cls._reference_cache = (
+                        ReferenceCache(resource_types=cls.CONDITIONAL_READ_TYPES)
+                        if _setting("FHIR_REFERENCE_CACHE", False)
+                        else False
+                    )
+
+        return cls._reference_cache or None
+
+    @classmethod
+    def set_reference_cache(cls, cache: Union[ReferenceCache, bool, None]):
+        """
+        Sets the cache of rarely changing resources. Passing `False`
+        disables caching and passing `None` resets it to the
+        `FHIR_REFERENCE_CACHE` setting.
+
+        :param cache: The reference cache to use
+        :type cache: Union[ReferenceCache, bool, None]
+        """
+        with cls._reference_cache_lock:
+            cls._reference_cache = cache
+
+    @classmethod
+    def _resource_caches(cls) -> list[ResourceCache]:
+        """
+        Returns the enabled caches of resources keyed by type and ID.
+
+        :return: The resource and reference caches, if enabled
+        :rtype: list[ResourceCache]
+        """
+        return [cache for cache in (cls.resource_cache(), cls.reference_cache()) if cache]
+
+    @classmethod
+    def preload_reference_resources(cls, resource_types: list[str] = None) -> int:
+        """
+        Fetches every resource of the reference cache's types so they are
+        warm before the first participant is fetched, e.g. at startup.
+
+        :param resource_types: The resource types to load, defaults to all of the cache's types
+        :type resource_types: list[str], defaults to None
+        :return: The number of resources loaded
+        :rtype: int
+        """
+        cache = cls.reference_cache()
+        if not cache:
+            logger.warning("PPM/FHIR: Reference cache is not enabled, nothing to preload")
+            return 0
+
+        # Searching caches the results
+        count = 0
+        for resource_type in resource_types or cache.resource_types:
+            count += sum(1 for _ in cls.iter_resources(resource_type))
+
+        logger.debug(f"PPM/FHIR: Preloaded {count} reference resources")
+        return count
+
+    @classmethod
+    def participant_cache(cls) -> Optional[ParticipantCache]:
+        """
+        Returns the cache of participant bundles returned by
+        `get_participant`, if enabled with the `FHIR_PARTICIPANT_CACHE`
+        setting.
+
+        :return: The participant cache, if enabled
+        :rtype: Optional[ParticipantCache]
+        """
+        if cls._participant_cache is None:
+            with cls._participant_cache_lock:
+                if cls._participant_cache is None:
+                    cls._participant_cache = ParticipantCache() if _setting("FHIR_PARTICIPANT_CACHE", False) else False
+
+        return cls._participant_cache or None
+
+    @classmethod
+    def set_participant_cache(cls, cache: Union[ParticipantCache, bool, None]):
+        """
+        Sets the cache of participant bundles. Passing `False` disables
+        caching and passing `None` resets it to the `FHIR_PARTICIPANT_CACHE`
+        setting.
+
+        :param cache: The participant cache to use
+        :type cache: Union[ParticipantCache, bool, None]
+        """
+        with cls._participant_cache_lock:
+            cls._participant_cache = cache
+
+    @classmethod
+    def coalesce_gets(cls) -> bool:
+        """
+        Returns whether identical concurrent GETs should share a single
+        request. This is disabled by default.
+
+        :return: Whether GETs are coalesced
+        :rtype: bool
+        """
+        return cls.COALESCE_GETS if cls.COALESCE_GETS is not None else bool(_setting("FHIR_COALESCE_GETS", False))
+
     #
     # FHIR HTTP
     #
 
+    @staticmethod
+    def _request(method: HttpMethod, url: str, **kwargs) -> requests.Response:
+        """
+        Makes a request through the backend, calling any instrumentation
+        hooks around it.
+
+        :param method: The HTTP request type to make
+        :type method: HttpMethod
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response object from the request
+        :rtype: requests.Response
+        """
+        try:
+            return FHIR.instrumentation.request(FHIR.backend().request, method, url, **kwargs)
+
+        finally:
+            # Drop cached resources the request may have changed, whether it succeeded or not
+            caches, participants = FHIR._resource_caches(), FHIR.participant_cache()
+            if (caches or participants) and method.lower() not in ("get", "head"):
+                body = kwargs.get("json") if kwargs.get("json") is not None else kwargs.get("data")
+                targets = FHIR._write_targets(method, url, body)
+                for cache in caches:
+                    for resource_type, resource_id in targets:
+                        cache.invalidate(resource_type, resource_id)
+
+                # Participants are also changed by resources created for them
+                patient_ids = FHIR._referenced_patients(body) if participants else None
+                if participants and (targets or patient_ids):
+                    participants.invalidate(patient_ids, targets)
+
+    @staticmethod
+    def _referenced_patients(body: Any) -> set[str]:
+        """
+        Returns the IDs of the Patients referenced by the resources in the
+        body of a request, including those in a bundle's entries.
+
+        :param body: The body of the request
+        :type body: Any
+        :return: The referenced Patient IDs
+        :rtype: set[str]
+        """
+        if body is None:
+            return set()
+        if not isinstance(body, (str, bytes)):
+            body = libjson.dumps(body)
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", errors="ignore")
+
+        return set(re.findall(r'"reference":\s*"(?:[^"]*/)?Patient/([^"/]+)"', body))
+
+    @staticmethod
+    def _write_targets(
+        method: HttpMethod, url: str, body: Any = None, relative: bool = False
+    ) -> list[tuple[str, Optional[str]]]:
+        """
+        Returns the resources a request to FHIR may change as pairs of
+        resource type and ID. The ID is `None` if the request may change
+        any resource of that type, e.g. a conditional update. Reads,
+        searches and creates change no existing resources. Batch and
+        transaction bundles are inspected for the resources their entries
+        change.
+
+        :param method: The HTTP request type
+        :type method: HttpMethod
+        :param url: The URL of the request
+        :type url: str
+        :param body: The body of the request
+        :type body: Any, defaults to None
+        :param relative: Whether the URL is relative to the FHIR URL, as in bundle entries
+        :type relative: bool, defaults to False
+        :return: The types and IDs of changed resources
+        :rtype: list[tuple[str, Optional[str]]]
+        """
+        method = method.upper()
+        if method in ("GET", "HEAD"):
+            return []
+
+        segments = [s for s in furl(url).path.segments if s]
+        if not relative:
+            segments = segments[len([s for s in furl(PPM.fhir_url()).path.segments if s]) :]
+
+        # Check for a batch or transaction
+        if not segments:
+            if isinstance(body, (str, bytes)):
+                try:
+                    body = libjson.loads(body)
+                except ValueError:
+                    return []
+            if not isinstance(body, dict) or body.get("resourceType") != "Bundle":
+                return []
+
+            targets = []
+            for entry in body.get("entry", []):
+                request = entry.get("request", {})
+                if request.get("url"):
+                    targets.extend(FHIR._write_targets(request.get("method", ""), request["url"], relative=True))
+
+            return targets
+
+        # Creates and searches change nothing that could be cached
+        if method == "POST" and (len(segments) == 1 or segments[-1] == "_search"):
+            return []
+
+        resource_type = segments[0]
+        if len(segments) > 1 and not segments[1].startswith("$"):
+            return [(resource_type, segments[1])]
+
+        return [(resource_type, None)]
+
     @staticmethod
     def get(url: str, params: dict = None, headers: dict = None, fail: bool = False) -> Optional[requests.Response]:
         """
@@ -391,12 +4756,20 @@ class FHIR:
         content = response = None
         try:
             # Make the request
-            response = FHIR.backend().request(
+            request = functools.partial(
+                FHIR._request,
                 "get",
                 url=url,
                 params=params,
                 headers=headers,
             )
+
+            # Share the response with identical requests in flight, each caller parses its own copy of the body
+            if FHIR.coalesce_gets():
+                key = (url, libjson.dumps(params, sort_keys=True, default=str), libjson.dumps(headers, sort_keys=True))
+                response = FHIR._coalescer.do(key, request)
+            else:
+                response = request()
             content = response.content
             logger.debug(f"PPM/FHIR: HTTP GET Response {response.status_code}")
 
@@ -466,7 +4839,7 @@ class FHIR:
         content = response = None
         try:
             # Make the request
-            response = FHIR.backend().request(
+            response = FHIR._request(
                 "post",
                 url=url,
                 json=json,
@@ -543,7 +4916,7 @@ class FHIR:
         content = response = None
         try:
             # Make the request
-            response = FHIR.backend().request(
+            response = FHIR._request(
                 "patch",
                 url=url,
                 data=data,
@@ -620,7 +4993,7 @@ class FHIR:
         content = response = None
         try:
             # Make the request
-            response = FHIR.backend().request(
+            response = FHIR._request(
                 "put",
                 url=url,
                 data=data,
@@ -693,7 +5066,7 @@ class FHIR:
         content = response = None
         try:
             # Make the request
-            response = FHIR.backend().request(
+            response = FHIR._request(
                 "delete",
                 url=url,
                 params=params,
@@ -746,7 +5119,9 @@ class FHIR:
     #
 
     @staticmethod
-    def fhir_get(path: list[str], query: dict = None, content: bool = True) -> Union[requests.Response, Optional[dict]]:
+    def fhir_get(
+        path: list[str], query: dict = None, content: bool = True, conditional: bool = False
+    ) -> Union[requests.Response, Optional[dict]]:
         """
         A generic method implementation for an HTTP GET to a Healthlake
         FHIR instance.
@@ -758,6 +5133,10 @@ class FHIR:
         :param content: Determines whether to return parsed
         response data or the response itself, defaults to True
         :typ content: bool, optional
+        :param conditional: Whether to make a conditional read and reuse the
+        previously fetched content if it has not changed, only applies when
+        returning content
+        :type conditional: bool, defaults to False
         :return: The response content or None if request failed
         :rtype: Union[requests.Response, Optional[dict]]
         """
@@ -767,10 +5146,50 @@ class FHIR:
         url = furl(PPM.fhir_url())
         url.path.segments.extend(path)
 
+        # Check for a conditional read
+        if conditional and content:
+            return FHIR._conditional_get(url.url, query)
+
         # Make the request
         response = FHIR.get(url.url, params=query, fail=True)
         return response if not content else response.json() if response else None
 
+    @staticmethod
+    def _conditional_get(url: str, query: dict = None) -> Optional[dict]:
+        """
+        Makes a GET with `If-None-Match` set to the entity tag of the
+        content last returned for the same request, if any. If the server
+        responds with `304 Not Modified`, the stored content is returned.
+
+        :param url: The URL to GET
+        :type url: str
+        :param query: The query to include in the URL of the request
+        :type query: dict, defaults to None
+        :return: The response content or None if request failed
+        :rtype: Optional[dict]
+        """
+        key = (url, libjson.dumps(query, sort_keys=True, default=str))
+        cached = FHIR._conditional_reads.get(key)
+
+        # Make the request
+        headers = {"If-None-Match": cached[0]} if cached else None
+        response = FHIR.get(url, params=query, headers=headers, fail=True)
+        if not response:
+            return None
+
+        # Use the stored content if unchanged
+        if response.status_code == 304 and cached:
+            logger.debug(f"PPM/FHIR: Not modified: {url}")
+            return libjson.loads(cached[1])
+
+        # Store the content if it can be validated later
+        resource = response.json()
+        etag = ConditionalReadCache.etag(response, resource)
+        if etag:
+            FHIR._conditional_reads.set(key, etag, response.content)
+
+        return resource
+
     @staticmethod
     def fhir_post(
         resource: dict, path: list[str] = None, content: bool = True
@@ -1019,13 +5438,54 @@ class FHIR:
         """
         logger.debug(f"PPM/FHIR: Read resource: {resource_type}/{resource_id}")
 
-        # Check if resource exists
-        response = FHIR.fhir_get([resource_type, resource_id])
+        # Check the caches
+        caches = [(cache, cache.generation) for cache in FHIR._resource_caches()]
+        for cache, _ in caches:
+            resource = cache.get(resource_type, resource_id)
+            if resource is not None:
+                return resource
+
+        # Check if resource exists, rarely changing resources are revalidated rather than fetched
+        response = FHIR.fhir_get([resource_type, resource_id], conditional=resource_type in FHIR.CONDITIONAL_READ_TYPES)
         if not response:
             logger.debug(f"PPM/FHIR: Resource: {resource_type}/" f"{resource_id} does not exist")
+        else:
+            for cache, generation in caches:
+                cache.set(response, generation)
 
         return response
 
+    @staticmethod
+    def _read_resources(resource_type: str, resource_ids: list[str]) -> list[dict]:
+        """
+        Returns the resources of the given type and IDs that exist. Cached
+        resources are returned from the resource caches and the rest are
+        fetched in a single search.
+
+        :param resource_type: The FHIR resource type
+        :type resource_type: str
+        :param resource_ids: The IDs of the resources
+        :type resource_ids: list[str]
+        :return: The resources
+        :rtype: list[dict]
+        """
+        resources = []
+        missing_resource_ids = list(dict.fromkeys(resource_ids))
+
+        # Check the caches
+        for cache in FHIR._resource_caches():
+            cached = [r for r in (cache.get(resource_type, i) for i in missing_resource_ids) if r is not None]
+            resources.extend(cached)
+
+            found_resource_ids = {r["id"] for r in cached}
+            missing_resource_ids = [i for i in missing_resource_ids if i not in found_resource_ids]
+
+        # Fetch the rest, which caches them
+        if missing_resource_ids:
+            resources.extend(FHIR._query_resources(resource_type, query={"_id": ",".join(missing_resource_ids)}))
+
+        return resources
+
     @staticmethod
     def fhir_update(resource_type: str, resource_id: str, resource: dict) -> Optional[dict]:
         """
@@ -1078,19 +5538,17 @@ class FHIR:
         return FHIR.fhir_post(bundle)
 
     @staticmethod
-    def fhir_search(path: list[str], query: dict = None) -> dict:
+    def _search_url(path: list[str], query: dict = None) -> tuple[str, dict]:
         """
-        A generic method implementation for an FHIR search.
+        Builds the URL and the body for a POST search.
 
         :param path: The additional path components to search from
         :type path: list[str]
-        :param query: The query to include in the URL of the request
+        :param query: The query to include in the body of the request
         :type query: dict, defaults to None
-        :return: The FHIR Bundle object from the search
-        :rtype: dict
+        :return: The URL and body of the search
+        :rtype: tuple[str, dict]
         """
-        logger.debug(f"PPM/FHIR: Search '{path}'/'{query}'")
-
         # Set the URL
         url = furl(PPM.fhir_url())
         url.path.segments.extend(path)
@@ -1102,25 +5560,51 @@ class FHIR:
         elif "_count" not in query:
             query["_count"] = "100"
 
-        # Ensure we iterate all pages
-        total_bundle = None
-        while url is not None:
+        return url.url, query
 
-            # Make the request
-            bundle = FHIR.post(url, data=query, fail=True)
-            if not total_bundle:
-                total_bundle = bundle
-            else:
-                total_bundle["entry"].extend(bundle.get("entry", []))
+    @staticmethod
+    def iter_search_resources(path: list[str], query: dict = None) -> Generator[dict, None, None]:
+        """
+        Yields each resource returned by a POST `_search`, one page at a
+        time. This is the streaming equivalent of `fhir_search`.
+
+        :param path: The additional path components to search from
+        :type path: list[str]
+        :param query: The query to include in the body of the request
+        :type query: dict, defaults to None
+        :return: A generator of FHIR resource dicts
+        :rtype: Generator[dict, None, None]
+        """
+        logger.debug(f"PPM/FHIR: Iterate search '{path}'/'{query}'")
 
-            # Check for a page.
-            url = next((link["url"] for link in bundle.get("link", []) if link["relation"] == "next"), None)
+        url, query = FHIR._search_url(path, query)
+        for bundle in FHIR._iter_pages(url, data=query):
+            for entry in bundle.get("entry", []):
+                if entry.get("resource"):
+                    yield entry["resource"]
 
-            # Swap domain if necessary
-            if furl(url).host != furl(PPM.fhir_url()).host:
+    @staticmethod
+    def fhir_search(path: list[str], query: dict = None) -> dict:
+        """
+        A generic method implementation for an FHIR search.
 
-                # Set it
-                url = furl(url).set(host=furl(PPM.fhir_url()).host).url
+        :param path: The additional path components to search from
+        :type path: list[str]
+        :param query: The query to include in the URL of the request
+        :type query: dict, defaults to None
+        :return: The FHIR Bundle object from the search
+        :rtype: dict
+        """
+        logger.debug(f"PPM/FHIR: Search '{path}'/'{query}'")
+
+        # Ensure we iterate all pages; the first is a POST and the rest follow `next` links
+        url, query = FHIR._search_url(path, query)
+        total_bundle = None
+        for bundle in FHIR._iter_pages(url, data=query):
+            if total_bundle is None:
+                total_bundle = bundle
+            else:
+                total_bundle.setdefault("entry", []).extend(bundle.get("entry", []))
 
         # Update count
         total_bundle["total"] = len(total_bundle.get("entry", []))
@@ -1176,6 +5660,10 @@ class FHIR:
             logger.warning('FHIR: Attempt to extract resource from nothing: "{}"'.format(resource))
             return []
 
+        # Use the indexes of a bundle view
+        if isinstance(resource, BundleView):
+            return resource.find(resource_types, filter=filter)
+
         # Check type
         resources = []
         if isinstance(resource, Resource):
@@ -1354,6 +5842,10 @@ class FHIR:
             logger.warning('FHIR: Attempt to extract resource from nothing: "{}"'.format(obj))
             return []
 
+        # Use the indexes of a bundle view
+        if isinstance(obj, BundleView):
+            return obj.find([resource_type] if resource_type else None)
+
         # Check type
         if isinstance(obj, Resource):
 
@@ -1494,34 +5986,25 @@ class FHIR:
         return None
 
     @staticmethod
-    def _get_list(bundle: Bundle, resource_type: str) -> Optional[FHIRList]:
+    def _get_list(bundle: Union[dict, Bundle], resource_type: str) -> Optional[dict]:
         """
         Finds and returns the list resource for the passed resource type
         :param bundle: The FHIR resource bundle
-        :type bundle: Bundle
+        :type bundle: Union[dict, Bundle]
         :param resource_type: The resource type of the list's contained resources
         :type resource_type: str
         :return: The List resource if exists
-        :rtype: List, defaults to None
+        :rtype: dict, defaults to None
         """
+        # Index the bundle
+        bundle = BundleView.of(bundle)
 
-        # Check the bundle type
-        if type(bundle) is dict:
-            bundle = Bundle(bundle)
-
-        # Quit early for an empty bundle
-        if not bundle.entry:
-            return None
-
-        for list in [entry.resource for entry in bundle.entry if entry.resource.resource_type == "List"]:
-
-            # Compare the type
-            for item in [entry.item for entry in list.entry]:
+        for resource in bundle.find(["List"]):
 
-                # Check for a reference
-                if item.reference and resource_type == item.reference.split("/")[0]:
-
-                    return list
+            # Check for a reference to the type
+            for entry in resource.get("entry", []):
+                if entry.get("item", {}).get("reference", "").split("/")[0] == resource_type:
+                    return resource
 
         return None
 
@@ -2735,21 +7218,166 @@ class FHIR:
     # READ
     #
 
+    # The number of result pages fetched ahead of the caller while paging
+    PAGE_READ_AHEAD = 2
+
     @staticmethod
-    def _query_bundle(resource_type: str, query: dict[str, Any] = None) -> Bundle:
+    def _next_page_url(bundle: dict, base_url: furl) -> Optional[str]:
         """
-        This method will fetch all resources for a given type, including paged
-        results. It will then return a Bundle resources containing the
-        actual results of the search.
+        Returns the URL of the next page of results for the passed Bundle,
+        if any. The URL's scheme, host and port are swapped for those of the
+        passed base URL since some FHIR servers return links with their
+        internal hostname.
 
-        # TODO: Set this method to use `FHIR.fhir_search` to move query to body of request instead of URL
+        :param bundle: The current page of results
+        :type bundle: dict
+        :param base_url: The URL of the FHIR server being queried
+        :type base_url: furl
+        :return: The URL of the next page, if any
+        :rtype: Optional[str]
+        """
+        url = next((link["url"] for link in bundle.get("link", []) if link.get("relation") == "next"), None)
+        if url is not None:
+
+            # Swap domain if necessary
+            url_builder = furl(url)
+            if url_builder.netloc != base_url.netloc:
+                url = url_builder.set(scheme=base_url.scheme, host=base_url.host, port=base_url.port).url
+
+        return url
+
+    @staticmethod
+    def _fetch_page(url: str, data: dict = None, page: int = None, resource_type: str = None) -> dict:
+        """
+        Fetches and parses a single page of search results. If data is
+        passed, the search is made via POST with the data as the body,
+        otherwise a GET is made.
+
+        :param url: The URL of the page
+        :type url: str
+        :param data: The search parameters to POST, if any
+        :type data: dict, defaults to None
+        :param page: The number of the page, reported to instrumentation
+        :type page: int, defaults to None
+        :param resource_type: The resource type searched, reported to instrumentation
+        :type resource_type: str, defaults to None
+        :raises requests.HTTPError: If the request fails
+        :return: The page of results
+        :rtype: dict
+        """
+        caches = [(cache, cache.generation) for cache in FHIR._resource_caches()]
+
+        token = _request_page.set((resource_type, page))
+        try:
+            response = FHIR.post(url, data=data) if data is not None else FHIR.get(url)
+        finally:
+            _request_page.reset(token)
+        if response is None:
+            raise requests.HTTPError(f"PPM/FHIR: Request for page failed: {url}")
+
+        response.raise_for_status()
+        bundle = response.json()
+
+        # Cache the resources
+        for cache, generation in caches:
+            cache.set_bundle(bundle, generation)
+
+        return bundle
+
+    @staticmethod
+    def _iter_pages(url: str, data: dict = None, read_ahead: int = None) -> Generator[dict, None, None]:
+        """
+        Yields each page of results for a search, following `next` links
+        until all pages are returned. The first page is fetched inline.
+        If there are more pages, they are fetched and parsed on a
+        background thread while the caller works on the current page,
+        with at most `read_ahead` pages held in memory. Errors raised while
+        fetching are re-raised to the caller.
+
+        :param url: The URL of the search
+        :type url: str
+        :param data: The search parameters to POST for the first page, if any
+        :type data: dict, defaults to None
+        :param read_ahead: The maximum number of pages to fetch ahead
+        :type read_ahead: int, defaults to None
+        :return: A generator of Bundle pages
+        :rtype: Generator[dict, None, None]
+        """
+        base_url = furl(PPM.fhir_url())
+
+        # Fetch the first page
+        resource_type = RequestEvent.url_resource_type(url)
+        bundle = FHIR._fetch_page(url, data=data, page=1, resource_type=resource_type)
+        url = FHIR._next_page_url(bundle, base_url)
+        if url is None:
+            yield bundle
+            return
+
+        # Subsequent pages are fetched in the background
+        pages = queue.Queue(maxsize=read_ahead or FHIR.PAGE_READ_AHEAD)
+        stop = threading.Event()
+
+        def put(item: tuple) -> bool:
+            # Wait for room in the queue unless the caller has stopped
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+
+            return False
+
+        def produce(url: str):
+            try:
+                number = 1
+                while url is not None and not stop.is_set():
+
+                    # Fetch the page and get the next page's URL
+                    number += 1
+                    page = FHIR._fetch_page(url, page=number, resource_type=resource_type)
+                    url = FHIR._next_page_url(page, base_url)
+                    if not put((page, None)):
+                        return
+
+                put((None, None))
+
+            except Exception as e:
+                put((None, e))
+
+        # Run in a copy of the caller's context so instrumentation attributes requests to it
+        producer = threading.Thread(
+            target=contextvars.copy_context().run, args=(produce, url), name="ppm-fhir-pages", daemon=True
+        )
+        producer.start()
+
+        try:
+            yield bundle
+
+            while True:
+                page, error = pages.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    break
+
+                yield page
+
+        finally:
+            stop.set()
+
+    @staticmethod
+    def _query_url(resource_type: str, query: dict[str, Any] = None) -> str:
+        """
+        Builds the URL for a search of the given resource type with the
+        passed query. List values are added as repeated parameters.
 
         :param resource_type: FHIR resource type
         :type resource_type: str
         :param query: A dict of key value pairs for searching resources
         :type query: dict
-        :return: A Bundle resource containing the results of the search
-        :rtype: Bundle
+        :return: The URL of the search
+        :rtype: str
         """
         # Build the URL.
         url_builder = furl(PPM.fhir_url())
@@ -2768,38 +7396,54 @@ class FHIR:
                     url_builder.query.params.add(key, value)
 
         # Prepare the final URL
-        url = url_builder.url
-
-        # Collect them.
-        total_bundle = None
+        return url_builder.url
 
-        # The url will be set to none on the second iteration if all resources
-        # were returned, or it will be set to the next page of resources if more exist.
-        while url is not None:
-
-            # Make the request.
-            response = FHIR.get(url)
-            response.raise_for_status()
+    @staticmethod
+    def iter_resources(resource_type: str, query: dict[str, Any] = None) -> Generator[dict, None, None]:
+        """
+        Yields each resource returned by a search of the given type, one
+        page at a time. Unlike `_query_bundle`, results are never collected
+        in memory, so this should be preferred when scanning large sets of
+        resources, e.g. for exports or migrations. Included resources are
+        yielded along with matches.
 
-            # Parse the JSON.
-            bundle = response.json()
-            if total_bundle is None:
-                total_bundle = bundle
-            elif bundle.get("total", 0) > 0:
-                total_bundle["entry"].extend(bundle.get("entry"))
+        :param resource_type: FHIR resource type
+        :type resource_type: str
+        :param query: A dict of key value pairs for searching resources
+        :type query: dict
+        :return: A generator of FHIR resource dicts
+        :rtype: Generator[dict, None, None]
+        """
+        logger.debug(f"PPM/FHIR: Iterate resources: {resource_type}")
 
-            # Check for a page.
-            url = None
+        for bundle in FHIR._iter_pages(FHIR._query_url(resource_type, query)):
+            for entry in bundle.get("entry", []):
+                if entry.get("resource"):
+                    yield entry["resource"]
 
-            for link in bundle.get("link", []):
-                if link["relation"] == "next":
-                    url = link["url"]
+    @staticmethod
+    def _query_bundle(resource_type: str, query: dict[str, Any] = None) -> Bundle:
+        """
+        This method will fetch all resources for a given type, including paged
+        results. It will then return a Bundle resources containing the
+        actual results of the search.
 
-                    # Swap domain if necessary
-                    if furl(url).host != furl(PPM.fhir_url()).host:
+        # TODO: Set this method to use `FHIR.fhir_search` to move query to body of request instead of URL
 
-                        # Set it
-                        url = furl(url).set(host=furl(PPM.fhir_url()).host).url
+        :param resource_type: FHIR resource type
+        :type resource_type: str
+        :param query: A dict of key value pairs for searching resources
+        :type query: dict
+        :return: A Bundle resource containing the results of the search
+        :rtype: Bundle
+        """
+        # Collect them.
+        total_bundle = None
+        for bundle in FHIR._iter_pages(FHIR._query_url(resource_type, query)):
+            if total_bundle is None:
+                total_bundle = bundle
+            elif bundle.get("entry"):
+                total_bundle.setdefault("entry", []).extend(bundle.get("entry", []))
 
         return Bundle(total_bundle)
 
@@ -2819,11 +7463,8 @@ class FHIR:
         """
         logger.debug("Query resource: {}".format(resource_type))
 
-        # Query for the bundle
-        bundle = FHIR._query_bundle(resource_type, query).as_json()
-
-        # Extract resources, if any
-        return [entry["resource"] for entry in bundle.get("entry", []) if entry.get("resource")]
+        # Collect resources, if any
+        return list(FHIR.iter_resources(resource_type, query))
 
     @staticmethod
     def query_participants(
@@ -3043,6 +7684,93 @@ class FHIR:
         # Call the query_participants method
         return FHIR.query_participants(studies, enrollments, active, testing)
 
+    @staticmethod
+    def _get_cached_participant(key: tuple) -> Optional[dict]:
+        """
+        Returns the participant's cached bundle if it exists and, if the
+        participant cache probes, FHIR reports no changes since it was
+        cached.
+
+        :param key: The participant key
+        :type key: tuple
+        :return: The bundle, if any
+        :rtype: Optional[dict]
+        """
+        participants = FHIR.participant_cache()
+        cached = participants.get(key)
+        if cached is None:
+            return None
+
+        bundle, patient_id, last_updated = cached
+        if participants.probe and FHIR._participant_changed(patient_id, last_updated):
+            logger.debug(f"PPM/FHIR: Participant changed: Patient/{patient_id}")
+            participants.invalidate([patient_id])
+            return None
+
+        logger.debug(f"PPM/FHIR: Using cached participant: Patient/{patient_id}")
+        return bundle
+
+    @staticmethod
+    def _participant_changed(patient_id: str, last_updated: Optional[str]) -> bool:
+        """
+        Checks whether the Patient, or any resource that would be
+        reverse-included with it, was created or updated after the passed
+        time. This is done with a single batch of `_summary=count` searches.
+        Deletions are not detected. Any error is treated as a change.
+
+        :param patient_id: The Patient ID
+        :type patient_id: str
+        :param last_updated: The latest `lastUpdated` of the cached resources
+        :type last_updated: Optional[str]
+        :return: Whether the participant has changed
+        :rtype: bool
+        """
+        if not last_updated:
+            return True
+
+        # Build a count search for each resource type
+        searches = [("Patient", {"_id": patient_id})]
+        for revinclude in FHIR.PARTICIPANT_PATIENT_REVINCLUDES:
+            resource_type, parameter = revinclude.split(":", 1)
+            searches.append((resource_type, {parameter: f"Patient/{patient_id}"}))
+
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [
+                {
+                    "request": {
+                        "method": "GET",
+                        "url": f"{resource_type}?"
+                        + urllib.parse.urlencode({**query, "_lastUpdated": f"gt{last_updated}", "_summary": "count"}),
+                    }
+                }
+                for resource_type, query in searches
+            ],
+        }
+
+        try:
+            response = FHIR.fhir_transaction(bundle)
+            if not response:
+                return True
+
+            entries = response.get("entry", [])
+            if len(entries) != len(searches):
+                return True
+
+            for entry in entries:
+                if not entry.get("response", {}).get("status", "").startswith("2"):
+                    return True
+                if entry.get("resource", {}).get("total", 1):
+                    return True
+
+            return False
+
+        except Exception as e:
+            logger.exception(f"PPM/FHIR: Participant probe error: {e}", exc_info=True, extra={"patient": patient_id})
+
+        return True
+
     @staticmethod
     def get_participant(
         patient: Union[Patient, dict, str],
@@ -3082,29 +7810,43 @@ class FHIR:
             url.query.params.add(key, value)
 
         # Make the call
+        caches = [(cache, cache.generation) for cache in FHIR._resource_caches()]
+        participants = FHIR.participant_cache()
+        participant_key = ParticipantCache.key(FHIR._patient_query(patient)) if participants else None
+        participant_generation = participants.generation if participants else None
         content = response = None
         try:
-            # Make the FHIR request.
-            response = FHIR.get(url.url)
-            content = response.content
+            # Use the cached bundle if the participant has not changed
+            bundle = FHIR._get_cached_participant(participant_key) if participants else None
+            if bundle is None:
 
-            # Check for entries
-            bundle = response.json()
+                # Make the FHIR request.
+                response = FHIR.get(url.url)
+                content = response.content
 
-            if not bundle.get("entry") or not FHIR._find_resources(bundle, "Patient"):
-                logger.debug(f"PPM/FHIR: Empty and/or no Patient for {patient}")
-                return {}
+                # Check for entries
+                bundle = response.json()
 
-            # Make the request
-            secondary_bundle = FHIR._get_participant_missing_resources(bundle)
-            if secondary_bundle and secondary_bundle.get("entry"):
-                logger.debug(f"PPM/FHIR: Fetched {len(secondary_bundle['entry'])} missing resources")
+                if not bundle.get("entry") or not FHIR._find_resources(bundle, "Patient"):
+                    logger.debug(f"PPM/FHIR: Empty and/or no Patient for {patient}")
+                    return {}
+
+                # Make the request
+                secondary_bundle = FHIR._get_participant_missing_resources(bundle)
+                if secondary_bundle and secondary_bundle.get("entry"):
+                    logger.debug(f"PPM/FHIR: Fetched {len(secondary_bundle['entry'])} missing resources")
+
+                    # Add secondary resources to primary bundle
+                    bundle["entry"].extend(secondary_bundle["entry"])
 
-                # Add secondary resources to primary bundle
-                bundle["entry"].extend(secondary_bundle["entry"])
+                    # Update bundle count
+                    bundle["total"] = len(bundle["entry"])
 
-                # Update bundle count
-                bundle["total"] = len(bundle["entry"])
+                # Cache the resources and the bundle
+                for cache, generation in caches:
+                    cache.set_bundle(bundle, generation)
+                if participants:
+                    participants.set(participant_key, bundle, participant_generation)
 
             if flatten_return:
                 return FHIR.flatten_participant(
@@ -3177,27 +7919,39 @@ class FHIR:
             "entry": [],
         }
 
+        # Shared resources are used from the cache when possible
+        reference_cache = FHIR.reference_cache()
+        generation = reference_cache.generation if reference_cache else None
+        cached_entries = []
+
+        # Index the current bundle once and check each reference only once
+        bundle = BundleView.of(bundle)
+        references = []
+        checked = set()
+
         # Iterate secondary resources
         for resource_type, link in secondary_resources.items():
 
             # Get referenced IDs from resources in current bundle
-            references = [
-                f"{resource_type}/{resource_id}"
-                for e in bundle["entry"]
-                if e.get("resource", {}).get("resourceType") == link["resource"]
-                for resource_id in link["get_ids"](e["resource"])
-            ]
+            for resource in bundle.find([link["resource"]]):
+                for resource_id in link["get_ids"](resource):
 
-            # Iterate references to missing resources
-            for reference in references:
-
-                # Split the reference
-                resource_type, resource_id = tuple(reference.split("/", 1))
+                    # Skip duplicates and those in the current bundle
+                    reference = f"{resource_type}/{resource_id}"
+                    if reference in checked:
+                        continue
+                    checked.add(reference)
+                    if bundle.resource(resource_type, resource_id):
+                        continue
 
-                # Check current bundle
-                if not FHIR.find_resource(bundle, resource_type=resource_type, filter=lambda r: r["id"] == resource_id):
+                    # Check the cache
+                    cached = reference_cache.get(resource_type, resource_id) if reference_cache else None
+                    if cached is not None:
+                        cached_entries.append({"resource": cached, "response": {"status": "200 OK"}})
+                        continue
 
                     # Make entry for bundle
+                    references.append(reference)
                     secondary_bundle["entry"].append(
                         {
                             "request": {
@@ -3215,10 +7969,21 @@ class FHIR:
             if not secondary_bundle or not secondary_bundle.get("entry"):
                 logger.warning(f"PPM/FHIR: Could not find missing resources: {references}")
             else:
+                # Cache them for other participants
+                if reference_cache:
+                    reference_cache.set_bundle(secondary_bundle, generation)
+
+                secondary_bundle["entry"].extend(cached_entries)
                 return secondary_bundle
-        else:
+
+        elif not cached_entries:
             logger.debug("PPM/FHIR: No missing resources")
 
+        # Return whatever was cached
+        if cached_entries:
+            logger.debug(f"PPM/FHIR: Using {len(cached_entries)} cached missing resources")
+            return {"resourceType": "Bundle", "type": "batch-response", "entry": cached_entries}
+
         return None
 
     @staticmethod
@@ -3517,7 +8282,7 @@ class FHIR:
         :rtype: dict, defaults to None
         """
         # Get the devices
-        device = next(iter(FHIR._query_resources("Device", query={"_id": id})), None)
+        device = next(iter(FHIR._read_resources("Device", [id])), None)
 
         # Check if the resource should be flattened
         if device and flatten_return:
@@ -5678,6 +10443,7 @@ class FHIR:
         """
 
         # Find Research subjects
+        bundle = BundleView.of(bundle)
         subjects = FHIR.find_research_subjects(bundle, ppm, flatten_result=False)
         if not subjects:
             logger.debug("No Research Subjects, no Research Studies")
@@ -5687,12 +10453,13 @@ class FHIR:
         research_study_ids = [subject["study"]["reference"].split("/")[1] for subject in subjects]
 
         # Check bundle first
-        research_studies = [e for e in bundle["entry"] if e.get("resource", {}).get("id") in research_study_ids]
+        research_studies = [
+            {"resource": r} for r in bundle.find(["ResearchStudy"]) if r.get("id") in set(research_study_ids)
+        ]
 
         # Make the query for any missing ResearchStudy resources
-        missing_research_study_ids = [
-            i for i in research_study_ids if i not in [r["resource"]["id"] for r in research_studies]
-        ]
+        found_research_study_ids = {r["resource"]["id"] for r in research_studies}
+        missing_research_study_ids = [i for i in research_study_ids if i not in found_research_study_ids]
         if missing_research_study_ids:
             logger.debug(f"PPM/FHIR: Bundle missing ResearchStudy/" f"({', '.join(missing_research_study_ids)})")
 
@@ -5811,11 +10578,19 @@ class FHIR:
 
     @staticmethod
     def flatten_participant(
-        bundle: Union[dict, Bundle], study: str = None, questionnaires: dict[str, dict] = None
-    ) -> dict:
+        bundle: Union[dict, Bundle],
+        study: str = None,
+        questionnaires: dict[str, dict] = None,
+        fields: list[str] = None,
+        lazy: bool = False,
+    ) -> Union[dict, "FlattenedParticipant"]:
         """
         Accepts a Bundle containing everything related to a Patient resource
         and flattens the data into something easier to build templates/views with.
+        The Patient, their study and study resource IDs are always flattened
+        while the remaining sections, as named in `FHIR.PARTICIPANT_FIELDS`,
+        can be limited to those passed in `fields`. If `lazy` is passed,
+        sections are only flattened once one of their keys is accessed.
 
         :param bundle: The bundle of all a participant's resources
         :type bundle: Union[dict, Bundle]
@@ -5824,16 +10599,25 @@ class FHIR:
         :type study: str, defaults to None
         :param questionnaires: The survey/questionnaires for the study
         :type questionnaires: dict[str, dict], defaults to None
+        :param fields: The sections to flatten, defaults to all of them
+        :type fields: list[str], defaults to None
+        :param lazy: Whether to flatten sections on first access or not
+        :type lazy: bool, defaults to False
+        :raises ValueError: If an unknown section is passed in `fields`
         :return: A flattened dictionary of the participant's entire
         FHIR data record
-        :rtype: dict
+        :rtype: Union[dict, FlattenedParticipant]
         """
-        # Check type
-        if type(bundle) is Bundle:
-            bundle = bundle.as_json()
+        # Check fields
+        if fields is not None and set(fields) - set(FHIR.PARTICIPANT_FIELDS):
+            raise ValueError(f"Unknown participant fields: {', '.join(set(fields) - set(FHIR.PARTICIPANT_FIELDS))}")
+
+        # Index the bundle once for all of the lookups below
+        bundle = BundleView.of(bundle)
 
         # Build a dictionary
         participant = {}
+        sections = {}
 
         # Set aside common properties
         ppm_id = None
@@ -5844,7 +10628,7 @@ class FHIR:
             participant = FHIR.flatten_patient(bundle)
             if not participant:
                 logger.debug("No Patient in bundle")
-                return {}
+                return FlattenedParticipant({}, {}) if lazy else {}
 
             # Get props
             ppm_id = participant["fhir_id"]
@@ -5888,139 +10672,198 @@ class FHIR:
             # Validate it
             study = PPM.Study.enum(study).value
 
+            # Check for accepted and a start date
+            participant["project"] = participant["study"] = study
+            participant["date_registered"] = FHIR._format_date(studies[0]["start"], "%m/%d/%Y")
+            participant["datetime_registered"] = studies[0]["start"]
+
             ####################################################################
-            # Enrollment
+            # Sections
             ####################################################################
 
-            # Check for accepted and a start date
-            participant["project"] = participant["study"] = study
-            participant["date_registered"] = FHIR._format_date(studies[0]["start"], "%m/%d/%Y")
-            participant["datetime_registered"] = studies[0]["start"]
+            # Pick out the requested sections
+            sections = FHIR._flatten_participant_sections(bundle, study, ppm_id, questionnaires)
+            if fields is not None:
+                sections = {name: section for name, section in sections.items() if name in fields}
+
+            # Flatten them now unless deferred
+            if not lazy:
+                for section in sections.values():
+                    participant.update(section())
+
+        except Exception as e:
+            logger.exception(
+                "FHIR error: {}".format(e),
+                exc_info=True,
+                extra={"study": study, "ppm_id": ppm_id, "email": email},
+            )
+            sections = {}
+
+        if lazy:
+            return FlattenedParticipant(participant, sections, extra={"study": study, "ppm_id": ppm_id, "email": email})
+
+        return participant
 
-            # Get the enrollment properties
-            enrollment = FHIR.flatten_enrollment(bundle)
+    @staticmethod
+    def _flatten_participant_sections(
+        bundle: BundleView, study: str, ppm_id: str, questionnaires: dict = None
+    ) -> dict[str, Callable[[], dict]]:
+        """
+        Returns a callable for each section of a participant's flattened
+        record, keyed by the section's name, that returns the values the
+        section adds to the record.
 
-            # Set status and dates
-            participant["enrollment"] = enrollment["enrollment"]
-            participant["date_enrollment_updated"] = FHIR._format_date(enrollment["updated"], "%m/%d/%Y")
-            participant["datetime_enrollment_updated"] = enrollment["updated"]
-            if enrollment.get("start"):
+        :param bundle: The participant's entire FHIR record
+        :type bundle: BundleView
+        :param study: The study for which the record is constructed
+        :type study: str
+        :param ppm_id: The PPM ID of the participant
+        :type ppm_id: str
+        :param questionnaires: The survey/questionnaires for the study
+        :type questionnaires: dict, defaults to None
+        :return: The sections in the order they are flattened
+        :rtype: dict[str, Callable[[], dict]]
+        """
+        sections = {
+            "enrollment": lambda: FHIR._flatten_participant_enrollment(bundle),
+            "composition": lambda: {"composition": FHIR.flatten_consent_composition(bundle)},
+            "questionnaires": lambda: FHIR._flatten_participant_questionnaires(bundle, study, ppm_id, questionnaires),
+            "points_of_care": lambda: {"points_of_care": FHIR.flatten_list(bundle, "Organization")},
+            "devices": lambda: {"devices": FHIR.flatten_ppm_devices(bundle)},
+            "research_studies": lambda: FHIR._flatten_participant_research_studies(bundle),
+        }
 
-                # Convert time zone to assumed ET
-                participant["enrollment_accepted_date"] = FHIR._format_date(enrollment["start"], "%m/%d/%Y")
+        # Get study specific resources
+        if hasattr(FHIR, f"_flatten_{study}_participant"):
 
-            else:
-                participant["enrollment_accepted_date"] = ""
+            def flatten_study():
+                # Run it
+                values, study_values = getattr(FHIR, f"_flatten_{study}_participant")(
+                    bundle=bundle,
+                    ppm_id=ppm_id,
+                    questionnaires=questionnaires,
+                )
 
-            # Check for completed/terminated
-            if enrollment.get("end"):
+                # Set them
+                return {**values, study: study_values}
 
-                # Convert time zone to assumed ET
-                participant["enrollment_terminated_date"] = FHIR._format_date(enrollment["end"], "%m/%d/%Y")
-            #
-            # else:
-            #     participant['enrollment_terminated_date'] = ''
+            sections["study"] = flatten_study
 
-            ####################################################################
-            # Consent
-            ####################################################################
+        return sections
 
-            # Flatten consent composition
-            participant["composition"] = FHIR.flatten_consent_composition(bundle)
+    @staticmethod
+    def _flatten_participant_enrollment(bundle: BundleView) -> dict:
+        """
+        Flattens the enrollment section of a participant's record.
 
-            ####################################################################
-            # Questionnaires
-            ####################################################################
+        :param bundle: The participant's entire FHIR record
+        :type bundle: BundleView
+        :return: The enrollment values of the record
+        :rtype: dict
+        """
+        values = {}
 
-            # Collect flattened questionnaires
-            participant["questionnaires"] = {}
+        # Get the enrollment properties
+        enrollment = FHIR.flatten_enrollment(bundle)
 
-            # If not specified, use the value hard-coded in the PPM module
-            if not questionnaires:
-                eligibility_questionnaire_id = PPM.Questionnaire.questionnaire_for_study(study=study)
-                logger.warning(
-                    f"PPM/{study}/{ppm_id}: Using deprecated PPM.Questionnaire eligibility questionnaires: "
-                    f" {eligibility_questionnaire_id}"
-                )
-            else:
-                # Get needed questionnaire IDs
-                eligibility_questionnaire_id = next(
-                    (q["questionnaire_id"] for q in questionnaires if q.get("eligibility_for") == study),
-                    PPM.Questionnaire.questionnaire_for_study(study=study),
-                )
+        # Set status and dates
+        values["enrollment"] = enrollment["enrollment"]
+        values["date_enrollment_updated"] = FHIR._format_date(enrollment["updated"], "%m/%d/%Y")
+        values["datetime_enrollment_updated"] = enrollment["updated"]
+        if enrollment.get("start"):
 
-            # Handle eligibility questionnaire
-            logger.debug(f"PPM/{study}/{ppm_id}: Eligibility questionnaire: {eligibility_questionnaire_id}")
-            questionnaire = FHIR.flatten_questionnaire_response(bundle, eligibility_questionnaire_id)
-            participant["questionnaire"] = participant["questionnaires"][eligibility_questionnaire_id] = questionnaire
+            # Convert time zone to assumed ET
+            values["enrollment_accepted_date"] = FHIR._format_date(enrollment["start"], "%m/%d/%Y")
 
-            # If not specified, use hard-coded questionnaire IDs from PPM module
-            if not questionnaires:
-                questionnaire_ids = [q.value for q in PPM.Questionnaire.extra_questionnaires_for_study(study=study)]
-                logger.warning(
-                    f"PPM/{study}/{ppm_id}: Using deprecated PPM.Questionnaire questionnaires: " f" {questionnaire_ids}"
-                )
-            else:
-                questionnaire_ids = [q["questionnaire_id"] for q in questionnaires if q.get("questionnaire_id")]
+        else:
+            values["enrollment_accepted_date"] = ""
 
-            # Parse remaining questionnaires
-            logger.debug(f"PPM/{study}/{ppm_id}: Study questionnaires: {questionnaire_ids}")
-            for questionnaire_id in questionnaire_ids:
+        # Check for completed/terminated
+        if enrollment.get("end"):
 
-                # Parse it and add it
-                participant["questionnaires"][questionnaire_id] = FHIR.flatten_questionnaire_response(
-                    bundle, questionnaire_id
-                )
+            # Convert time zone to assumed ET
+            values["enrollment_terminated_date"] = FHIR._format_date(enrollment["end"], "%m/%d/%Y")
+        #
+        # else:
+        #     values['enrollment_terminated_date'] = ''
 
-            ####################################################################
-            # Points of care
-            ####################################################################
+        return values
 
-            # Flatten points of care
-            participant["points_of_care"] = FHIR.flatten_list(bundle, "Organization")
+    @staticmethod
+    def _flatten_participant_questionnaires(
+        bundle: BundleView, study: str, ppm_id: str, questionnaires: dict = None
+    ) -> dict:
+        """
+        Flattens the questionnaires section of a participant's record.
 
-            ####################################################################
-            # Devices
-            ####################################################################
+        :param bundle: The participant's entire FHIR record
+        :type bundle: BundleView
+        :param study: The study for which the record is constructed
+        :type study: str
+        :param ppm_id: The PPM ID of the participant
+        :type ppm_id: str
+        :param questionnaires: The survey/questionnaires for the study
+        :type questionnaires: dict, defaults to None
+        :return: The questionnaire values of the record
+        :rtype: dict
+        """
+        # Collect flattened questionnaires
+        values = {"questionnaires": {}}
 
-            # Flatten consent composition
-            participant["devices"] = FHIR.flatten_ppm_devices(bundle)
+        # If not specified, use the value hard-coded in the PPM module
+        if not questionnaires:
+            eligibility_questionnaire_id = PPM.Questionnaire.questionnaire_for_study(study=study)
+            logger.warning(
+                f"PPM/{study}/{ppm_id}: Using deprecated PPM.Questionnaire eligibility questionnaires: "
+                f" {eligibility_questionnaire_id}"
+            )
+        else:
+            # Get needed questionnaire IDs
+            eligibility_questionnaire_id = next(
+                (q["questionnaire_id"] for q in questionnaires if q.get("eligibility_for") == study),
+                PPM.Questionnaire.questionnaire_for_study(study=study),
+            )
 
-            ####################################################################
-            # Research Studies
-            ####################################################################
+        # Handle eligibility questionnaire
+        logger.debug(f"PPM/{study}/{ppm_id}: Eligibility questionnaire: {eligibility_questionnaire_id}")
+        questionnaire = FHIR.flatten_questionnaire_response(bundle, eligibility_questionnaire_id)
+        values["questionnaire"] = values["questionnaires"][eligibility_questionnaire_id] = questionnaire
 
-            # Check for research studies
-            research_studies = FHIR.find_research_studies(bundle, ppm=False)
-            if research_studies:
-                participant["research_studies"] = research_studies
+        # If not specified, use hard-coded questionnaire IDs from PPM module
+        if not questionnaires:
+            questionnaire_ids = [q.value for q in PPM.Questionnaire.extra_questionnaires_for_study(study=study)]
+            logger.warning(
+                f"PPM/{study}/{ppm_id}: Using deprecated PPM.Questionnaire questionnaires: " f" {questionnaire_ids}"
+            )
+        else:
+            questionnaire_ids = [q["questionnaire_id"] for q in questionnaires if q.get("questionnaire_id")]
 
-            ####################################################################
-            # Study-sepcific Resources
-            ####################################################################
+        # Parse remaining questionnaires
+        logger.debug(f"PPM/{study}/{ppm_id}: Study questionnaires: {questionnaire_ids}")
+        for questionnaire_id in questionnaire_ids:
 
-            # Get study specific resources
-            if hasattr(FHIR, f"_flatten_{study}_participant"):
+            # Parse it and add it
+            values["questionnaires"][questionnaire_id] = FHIR.flatten_questionnaire_response(bundle, questionnaire_id)
 
-                # Run it
-                values, study_values = getattr(FHIR, f"_flatten_{study}_participant")(
-                    bundle=bundle,
-                    ppm_id=ppm_id,
-                    questionnaires=questionnaires,
-                )
+        return values
 
-                # Set them
-                participant.update(values)
-                participant[study] = study_values
+    @staticmethod
+    def _flatten_participant_research_studies(bundle: BundleView) -> dict:
+        """
+        Flattens the non-PPM research studies section of a participant's
+        record, which is only set if they are in any.
 
-        except Exception as e:
-            logger.exception(
-                "FHIR error: {}".format(e),
-                exc_info=True,
-                extra={"study": study, "ppm_id": ppm_id, "email": email},
-            )
+        :param bundle: The participant's entire FHIR record
+        :type bundle: BundleView
+        :return: The research study values of the record
+        :rtype: dict
+        """
+        # Check for research studies
+        research_studies = FHIR.find_research_studies(bundle, ppm=False)
+        if research_studies:
+            return {"research_studies": research_studies}
 
-        return participant
+        return {}
 
     @staticmethod
     def _flatten_study_resource_ids(bundle: dict) -> dict:
@@ -6573,21 +11416,17 @@ class FHIR:
         """
         logger.debug(f"PPM/FHIR: Flattening {questionnaire_id}")
 
-        # Check bundle type
-        if type(bundle) is dict:
-            bundle = Bundle(bundle)
+        # Index the bundle
+        bundle = BundleView.of(bundle)
 
         # Pick out the questionnaire and its response
-        questionnaire = next(
-            (entry.resource for entry in bundle.entry if entry.resource.id == questionnaire_id),
-            None,
-        )
+        questionnaire = bundle.model(bundle.resource("Questionnaire", questionnaire_id))
         questionnaire_response = next(
-            (
-                entry.resource
-                for entry in bundle.entry
-                if entry.resource.resource_type == "QuestionnaireResponse"
-                and entry.resource.questionnaire.endswith(f"Questionnaire/{questionnaire_id}")
+            iter(
+                bundle.models(
+                    ["QuestionnaireResponse"],
+                    filter=lambda r: r.get("questionnaire", "").endswith(f"Questionnaire/{questionnaire_id}"),
+                )
             ),
             None,
         )
@@ -6600,10 +11439,11 @@ class FHIR:
         # If no items, return empty
         if questionnaire_response.item:
 
-            # Get questions and answers
+            # Get questions and answers, checking which are enabled once
+            enabled = QuestionnaireIndex.of(questionnaire).enabled(questionnaire_response)
             questions = FHIR.questionnaire_questions(questionnaire, questionnaire.item)
             answers = FHIR.questionnaire_response_answers(
-                questionnaire, questionnaire_response, questionnaire_response.item
+                questionnaire, questionnaire_response, questionnaire_response.item, enabled
             )
 
             # Process sub-questions first
@@ -6681,7 +11521,7 @@ class FHIR:
                 if not answer:
 
                     # Check if group or in a repeating group
-                    item = FHIR.find_questionnaire_item(questionnaire.item, linkId)
+                    item = QuestionnaireIndex.of(questionnaire).item(linkId)
 
                     # Skip repeating groups, those are handled below
                     if FHIR.get_questionnaire_repeating_group(questionnaire, linkId):
@@ -6697,7 +11537,9 @@ class FHIR:
                     # Check if dependent and enabled
                     elif FHIR.question_is_conditionally_enabled(
                         questionnaire, linkId
-                    ) and not FHIR.questionnaire_response_is_enabled(questionnaire, questionnaire_response, linkId):
+                    ) and not FHIR.questionnaire_response_is_enabled(
+                        questionnaire, questionnaire_response, linkId, enabled
+                    ):
 
                         # If it's a sub-question, hide it
                         if re.match(r"question\-[\d]+\-[\d]+", linkId):
@@ -6712,7 +11554,9 @@ class FHIR:
                         answer = [mark_safe('<span class="label label-warning">N/A</span>')]
 
                         # Check if dependent and was enabled (or should have an answer but doesn't)
-                        if FHIR.questionnaire_response_is_required(questionnaire, questionnaire_response, linkId):
+                        if FHIR.questionnaire_response_is_required(
+                            questionnaire, questionnaire_response, linkId, enabled
+                        ):
                             logger.error(
                                 f"FHIR Questionnaire: No answer found for {linkId}",
                                 extra={
@@ -6737,7 +11581,7 @@ class FHIR:
 
                     # Parse answers
                     group_answers = FHIR.questionnaire_response_answers(
-                        questionnaire, questionnaire_response, group_answer.item
+                        questionnaire, questionnaire_response, group_answer.item, enabled
                     )
 
                     # Set a header
@@ -6799,13 +11643,7 @@ class FHIR:
         :rtype: Optional[dict]
         """
         # Check the path
-        for item in FHIR.get_question_path(questionnaire, link_id):
-
-            # Check if group and repeating
-            if item.type == "group" and item.repeats:
-                return item
-
-        return None
+        return QuestionnaireIndex.of(questionnaire).repeating_group(link_id)
 
     @staticmethod
     def int_to_roman(num: int) -> str:
@@ -6853,12 +11691,13 @@ class FHIR:
         # Create a mapping of linkId to index
         indices = {}
         index = 0
+        questionnaire_index = QuestionnaireIndex.of(questionnaire)
 
         # Iterate questions
         for linkId, text in questions.items():
 
             # Check type
-            question = FHIR.find_questionnaire_item(questionnaire.item, linkId)
+            question = questionnaire_index.item(linkId)
 
             # If group, check if subitems are nested or not
             if question.type == "display" or linkId.startswith("display-"):
@@ -6996,12 +11835,12 @@ class FHIR:
         with linkId
         :rtype: list[QuestionnaireItem]
         """
-        # Build items
-        items = [parent] if parent else []
-
-        # If not parent, start with root of Questionnaire
+        # Use the index when searching the whole Questionnaire
         if not parent:
-            parent = questionnaire
+            return QuestionnaireIndex.of(questionnaire).path(linkId)
+
+        # Build items
+        items = [parent]
 
         # Iterate items and break as soon as we find the correct node or path
         for item in parent.item:
@@ -7041,18 +11880,12 @@ class FHIR:
         :return: Whether it is conditionally enabled or not
         :rtype: bool
         """
-        # Find first condition
-        for item in FHIR.get_question_path(questionnaire, linkId):
-
-            # Check this and parent for enableWhen
-            if item.enableWhen:
-                return True
-
-        return False
+        # Check this and parents for enableWhen
+        return bool(QuestionnaireIndex.of(questionnaire).conditions(linkId))
 
     @staticmethod
     def questionnaire_response_is_enabled(
-        questionnaire: Questionnaire, questionnaire_response: QuestionnaireResponse, linkId: str
+        questionnaire: Questionnaire, questionnaire_response: QuestionnaireResponse, linkId: str, enabled: dict = None
     ) -> bool:
         """
         Inspects the Questionnaire for the given link ID and returns whether
@@ -7065,64 +11898,22 @@ class FHIR:
         :type questionnaire_response: QuestionnaireResponse
         :param linkId: The link ID of the item to find and check
         :type linkId: str
+        :param enabled: Whether each item is enabled, as returned by
+        `QuestionnaireIndex.enabled` for the response, to avoid evaluating it
+        :type enabled: dict, defaults to None
         :return: Whether the item is enabled based on the responses
         :rtype: bool
         """
-        # Compile list of conditions
-        enable_whens = []
-
-        # Find first condition
-        for item in FHIR.get_question_path(questionnaire, linkId):
-
-            # Check this and parent for enableWhen
-            if item.enableWhen:
-                enable_whens.extend(item.enableWhen)
-
-        # Iterate conditions and check for failures
-        for enable_when in enable_whens:
-
-            # Get their answer as a list, if not already
-            answer = FHIR.get_questionnaire_response_item_answers(questionnaire_response.item, enable_when.question)
-
-            # Check operation (this is not available on FHIR R3 and below)
-            enable_when_operation = getattr(enable_when, "operation", "=")
-
-            # Check equality of condition and answer
-            if enable_when_operation == "=":
-
-                # Check for answer type and check if it's in their list of items
-                if enable_when.answerString is not None:
-                    if not answer or enable_when.answerString not in answer:
-                        return False
-                elif enable_when.answerBoolean is not None:
-                    if not answer or enable_when.answerBoolean not in answer:
-                        return False
-                elif enable_when.answerDate is not None:
-                    if not answer or enable_when.answerDate.isostring not in answer:
-                        return False
-                elif enable_when.answerDateTime is not None:
-                    if not answer or enable_when.answerDateTime.isostring not in answer:
-                        return False
-                elif enable_when.answerInteger is not None:
-                    if not answer or enable_when.answerInteger not in answer:
-                        return False
-                elif enable_when.answerDecimal is not None:
-                    if not answer or enable_when.answerDecimal not in answer:
-                        return False
-                else:
-                    logger.error(f"PPM/FHIR: Unhandled enableWhen answer type: {enable_when.as_json()}")
-                    return False
+        # Evaluate the response's conditions, if not already
+        if enabled is None:
+            enabled = QuestionnaireIndex.of(questionnaire).enabled(questionnaire_response)
 
-            else:
-                logger.error(f"PPM/FHIR: Unhandled enableWhen operation type: {enable_when.as_json()}")
-                return False
-
-        # If we are here, this item is enabled as dependencies are satisfied (if any)
-        return True
+        # Items not in the Questionnaire have no conditions
+        return enabled.get(linkId, True)
 
     @staticmethod
     def questionnaire_response_is_required(
-        questionnaire: Questionnaire, questionnaire_response: QuestionnaireResponse, linkId: str
+        questionnaire: Questionnaire, questionnaire_response: QuestionnaireResponse, linkId: str, enabled: dict = None
     ) -> bool:
         """
         Inspects the Questionnaire for the given link ID and returns whether
@@ -7135,19 +11926,22 @@ class FHIR:
         :type questionnaire_response: QuestionnaireResponse
         :param linkId: The link ID of the item to check
         :type linkId: str
+        :param enabled: Whether each item is enabled, as returned by
+        `QuestionnaireIndex.enabled` for the response, to avoid evaluating it
+        :type enabled: dict, defaults to None
         :return: Whether the item is required or not based on responses
         :rtype: bool
         """
 
         # Get the question
-        item = FHIR.find_questionnaire_item(questionnaire.item, linkId)
+        item = QuestionnaireIndex.of(questionnaire).item(linkId)
 
         # If not required, return right away
         if not getattr(item, "required", False):
             return False
 
         # Check this and parent for enableWhen
-        if not FHIR.questionnaire_response_is_enabled(questionnaire, questionnaire_response, linkId):
+        if not FHIR.questionnaire_response_is_enabled(questionnaire, questionnaire_response, linkId, enabled):
             return False
 
         # If we are here, this item is required and all dependencies are satisfied (if any)
@@ -7225,6 +12019,7 @@ class FHIR:
         questionnaire: Questionnaire,
         questionnaire_response: QuestionnaireResponse,
         items: list[QuestionnaireResponseItem],
+        enabled: dict = None,
     ) -> dict[str, str]:
         """
         This accepts a questionnaire, a questionnaire response and a list
@@ -7239,10 +12034,17 @@ class FHIR:
         :type questionnaire_response: QuestionnaireResponse
         :param items: A list of response items to iterate through
         :type items: list[QuestionnaireResponseItem]
+        :param enabled: Whether each item is enabled, as returned by
+        `QuestionnaireIndex.enabled` for the response, to avoid evaluating it
+        :type enabled: dict, defaults to None
         :return: A mapping of found item link IDs to the answers from the
         response
         :rtype: dict[str, str]
         """
+        # Evaluate the response's conditions once for all items
+        if enabled is None:
+            enabled = QuestionnaireIndex.of(questionnaire).enabled(questionnaire_response)
+
         # Iterate items
         responses = {}
         for item in items:
@@ -7254,7 +12056,7 @@ class FHIR:
             if not item.answer:
 
                 # Check if omitted due to error
-                if FHIR.questionnaire_response_is_required(questionnaire, questionnaire_response, item.linkId):
+                if FHIR.questionnaire_response_is_required(questionnaire, questionnaire_response, item.linkId, enabled):
                     logger.error(
                         f"FHIR/QuestionnaireResponse/{item.linkId}: Missing answer item(s) for question item",
                         extra={
@@ -7304,7 +12106,9 @@ class FHIR:
             # Check for subtypes
             if item.item:
                 # Get answers
-                sub_answers = FHIR.questionnaire_response_answers(questionnaire, questionnaire_response, item.item)
+                sub_answers = FHIR.questionnaire_response_answers(
+                    questionnaire, questionnaire_response, item.item, enabled
+                )
 
                 # Add them
                 responses[item.linkId].extend(sub_answers)
@@ -7814,11 +12618,8 @@ class FHIR:
         """
         logger.debug("Flatten composition")
 
-        # Parse the bundle in not so strict mode
-        if type(bundle) is dict:
-            incoming_bundle = Bundle(bundle, strict=True)
-        else:
-            incoming_bundle = bundle
+        # Index the bundle, resources are parsed strictly as they are used
+        incoming_bundle = BundleView.of(bundle)
 
         # Prepare the object.
         consent_object = {
@@ -7828,12 +12629,12 @@ class FHIR:
         consent_exceptions = []
         assent_exceptions = []
 
-        if incoming_bundle.total > 0:
+        if (incoming_bundle.get("total") or 0) > 0:
 
-            for bundle_entry in incoming_bundle.entry:
-                if bundle_entry.resource.resource_type == "Consent":
+            for resource in incoming_bundle.models(["Consent", "Composition", "RelatedPerson", "Contract"]):
+                if resource.resource_type == "Consent":
 
-                    signed_consent = bundle_entry.resource
+                    signed_consent = resource
 
                     # We can pull the date from the Consent Resource. It's stamped
                     # in a few places.
@@ -7855,9 +12656,9 @@ class FHIR:
                             for consent_exception in consent_exception_extension.valueCodeableConcept.coding:
                                 consent_exceptions.append(FHIR._exception_description(consent_exception.display))
 
-                elif bundle_entry.resource.resource_type == "Composition":
+                elif resource.resource_type == "Composition":
 
-                    composition = bundle_entry.resource
+                    composition = resource
 
                     entries = [section.entry for section in composition.section if section.entry is not None]
                     references = [
@@ -7872,11 +12673,11 @@ class FHIR:
                     else:
                         consent_object["assent_text"] = text
 
-                elif bundle_entry.resource.resource_type == "RelatedPerson":
+                elif resource.resource_type == "RelatedPerson":
                     pass
-                elif bundle_entry.resource.resource_type == "Contract":
+                elif resource.resource_type == "Contract":
 
-                    contract = bundle_entry.resource
+                    contract = resource
 
                     # Parse out common contract properties
                     consent_object["type"] = "INDIVIDUAL"
@@ -7898,14 +12699,8 @@ class FHIR:
 
                         # Fetch the questionnaire and its responses.
                         questionnaire_response_id = contract.legallyBindingReference.reference.rsplit("/", 1)[-1]
-                        q_response = next(
-                            (
-                                entry.resource
-                                for entry in incoming_bundle.entry
-                                if entry.resource.resource_type == "QuestionnaireResponse"
-                                and entry.resource.id == questionnaire_response_id
-                            ),
-                            None,
+                        q_response = incoming_bundle.model(
+                            incoming_bundle.resource("QuestionnaireResponse", questionnaire_response_id)
                         )
 
                         if not q_response:
@@ -7916,13 +12711,8 @@ class FHIR:
 
                         # Get the questionnaire and its response.
                         questionnaire_id = q_response.questionnaire.rsplit("/", 1)[-1]
-                        questionnaire = next(
-                            (
-                                entry.resource
-                                for entry in incoming_bundle.entry
-                                if entry.resource.id == questionnaire_id
-                            ),
-                            None,
+                        questionnaire = incoming_bundle.model(
+                            incoming_bundle.resource("Questionnaire", questionnaire_id)
                         )
 
                         if not q_response or not questionnaire:
@@ -7945,11 +12735,9 @@ class FHIR:
                             consent_object["type"] = "GUARDIAN"
 
                             related_id = contract.signer[0].party.reference.split("/")[1]
-                            related_person = [
-                                entry.resource
-                                for entry in incoming_bundle.entry
-                                if entry.resource.resource_type == "RelatedPerson" and entry.resource.id == related_id
-                            ][0]
+                            related_person = incoming_bundle.model(
+                                incoming_bundle.resource("RelatedPerson", related_id)
+                            )
 
                             consent_object["signer_name"] = related_person.name[0].text
                             consent_object["signer_relationship"] = related_person.relationship.text
@@ -8104,48 +12892,41 @@ class FHIR:
         """
 
         try:
-            # Check the bundle type
-            if type(bundle) is dict:
-                bundle = Bundle(bundle)
+            # Index the bundle
+            bundle = BundleView.of(bundle)
 
+            # Find the List tracking this resource type
             resource = FHIR._get_list(bundle, resource_type)
             if not resource:
                 logger.debug("No List for resource {} found".format(resource_type))
                 return None
 
             # Get the references
-            references = [entry.item.reference for entry in resource.entry if entry.item.reference]
+            references = [e["item"]["reference"] for e in resource.get("entry", []) if e["item"].get("reference")]
 
             # Find it in the bundle
-            resources = [
-                entry.resource
-                for entry in bundle.entry
-                if "{}/{}".format(resource_type, entry.resource.id) in references
-            ]
+            resource_ids = {r.rsplit("/", 1)[-1] for r in references}
+            resources = [r for r in bundle.find([resource_type]) if r.get("id") in resource_ids]
 
             # Check for missing resources
+            found_resource_ids = {r["id"] for r in resources}
             missing_resource_ids = [
-                r.rsplit("/", 1)[-1] for r in references if r.rsplit("/", 1)[-1] not in [r.id for r in resources]
+                r.rsplit("/", 1)[-1] for r in references if r.rsplit("/", 1)[-1] not in found_resource_ids
             ]
 
             # If no resources, we must fetch them
             if missing_resource_ids:
                 logger.debug(f"PPM/FHIR: Missing {resource_type}/({', '.join(missing_resource_ids)})")
-                resources.extend(
-                    [
-                        FHIRElementFactory.instantiate(resource_type, r)
-                        for r in FHIR._query_resources(resource_type, query={"_id": ",".join(missing_resource_ids)})
-                    ]
-                )
+                resources.extend(FHIR._read_resources(resource_type, missing_resource_ids))
 
             # Flatten them according to type
             if resource_type == "Organization":
 
-                return [organization.name for organization in resources]
+                return [organization.get("name") for organization in resources]
 
             elif resource_type == "ResearchStudy":
 
-                return [study.title for study in resources]
+                return [study.get("title") for study in resources]
 
             else:
                 logger.error("Unhandled list resource type: {}".format(resource_type))
@@ -8271,15 +13052,11 @@ class FHIR:
         :rtype: list[str]
         """
 
-        # Build the bundle
-        if type(bundle) is dict:
-            bundle = Bundle(bundle)
+        # Index the bundle
+        bundle = BundleView.of(bundle)
 
         # Pick out the questionnaire and its response
-        questionnaire = next(
-            (entry.resource for entry in bundle.entry if entry.resource.id == questionnaire_id),
-            None,
-        )
+        questionnaire = bundle.model(bundle.resource("Questionnaire", questionnaire_id))
 
         # Ensure resources exist
         if not questionnaire:
@@ -9610,3 +14387,252 @@ class FHIR:
                     logger.error("----- FHIR/Ops: '{}' Message: ----\n{}\n".format(op.__name__, message))
                     logger.info("----- FHIR/Ops: Operation failed, halting operations ----")
                     break
+
+
+class AsyncFHIR(object):
+    """
+    An asyncio counterpart to the HTTP and query methods of `FHIR`. Calls
+    are dispatched to a thread pool and run against the shared `FHIR`
+    backend, so connection pooling and backend authentication (SigV4,
+    GCP tokens) behave exactly as they do for synchronous calls. The
+    number of calls in flight is bounded by `max_concurrency`. Calls that
+    follow pages or split their work may each make several HTTP requests,
+    so use the backend's rate limits to bound the requests themselves.
+
+    Usage:
+
+        async with AsyncFHIR(max_concurrency=8) as client:
+            participants = await client.get_participants(emails, study="neer")
+    """
+
+    # The default number of concurrent requests
+    MAX_CONCURRENCY = 10
+
+    def __init__(self, max_concurrency: int = None, executor: concurrent.futures.Executor = None):
+        """
+        :param max_concurrency: The maximum number of requests in flight
+        :type max_concurrency: int, defaults to None
+        :param executor: The executor to run requests on
+        :type executor: concurrent.futures.Executor, defaults to None
+        """
+        self.max_concurrency = max_concurrency or _setting("FHIR_ASYNC_MAX_CONCURRENCY", self.MAX_CONCURRENCY)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        # Only shut down executors that were created here
+        self._executor = executor
+        self._owns_executor = executor is None
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    @property
+    def executor(self) -> concurrent.futures.Executor:
+        """
+        Returns the executor requests are run on, creating a thread pool
+        sized to the concurrency limit on first use.
+
+        :return: The executor
+        :rtype: concurrent.futures.Executor
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrency, thread_name_prefix="ppm-fhir-async"
+            )
+
+        return self._executor
+
+    def close(self):
+        """
+        Shuts down the thread pool if it was created by this client.
+        """
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Runs the synchronous method on the executor once a concurrency
+        slot is available. The method runs in a copy of the caller's
+        context so context variables set by the caller are visible to it.
+        The slot is held for the whole method, which may make more than
+        one HTTP request.
+
+        :param func: The method to run
+        :type func: Callable
+        :return: The return value of the method
+        :rtype: Any
+        """
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(self.executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+    async def fhir_get(
+        self, path: list[str], query: dict = None, content: bool = True, conditional: bool = False
+    ) -> Union[requests.Response, Optional[dict]]:
+        """
+        Asynchronous version of `FHIR.fhir_get`.
+
+        :param path: The additional path components to GET from
+        :type path: list[str]
+        :param query: The query to include in the URL of the request
+        :type query: dict, defaults to None
+        :param content: Whether to return parsed response data or the response
+        :type content: bool, defaults to True
+        :param conditional: Whether to make a conditional read
+        :type conditional: bool, defaults to False
+        :return: The response content or None if request failed
+        :rtype: Union[requests.Response, Optional[dict]]
+        """
+        return await self._run(FHIR.fhir_get, path, query=query, content=content, conditional=conditional)
+
+    async def fhir_post(
+        self, resource: dict, path: list[str] = None, content: bool = True
+    ) -> Union[requests.Response, Optional[dict]]:
+        """
+        Asynchronous version of `FHIR.fhir_post`.
+
+        :param resource: The FHIR resource to persist
+        :type resource: dict
+        :param path: The additional path components to POST to
+        :type path: list[str], defaults to None
+        :param content: Whether to return parsed response data or the response
+        :type content: bool, defaults to True
+        :return: The response content or None if request failed
+        :rtype: Union[requests.Response, Optional[dict]]
+        """
+        return await self._run(FHIR.fhir_post, resource, path=path, content=content)
+
+    async def fhir_put(
+        self, resource: dict, path: list[str] = None, content: bool = True
+    ) -> Union[requests.Response, Optional[dict]]:
+        """
+        Asynchronous version of `FHIR.fhir_put`.
+
+        :param resource: The FHIR resource to persist
+        :type resource: dict
+        :param path: The additional path components to PUT to
+        :type path: list[str], defaults to None
+        :param content: Whether to return parsed response data or the response
+        :type content: bool, defaults to True
+        :return: The response content or None if request failed
+        :rtype: Union[requests.Response, Optional[dict]]
+        """
+        return await self._run(FHIR.fhir_put, resource, path=path, content=content)
+
+    async def fhir_patch(
+        self, path: list[str], patch: dict, content: bool = True
+    ) -> Union[requests.Response, Optional[dict]]:
+        """
+        Asynchronous version of `FHIR.fhir_patch`.
+
+        :param path: The additional path components to PATCH to
+        :type path: list[str]
+        :param patch: The patch to apply
+        :type patch: dict
+        :param content: Whether to return parsed response data or the response
+        :type content: bool, defaults to True
+        :return: The response content or None if request failed
+        :rtype: Union[requests.Response, Optional[dict]]
+        """
+        return await self._run(FHIR.fhir_patch, path, patch, content=content)
+
+    async def fhir_delete(self, path: list[str], content: bool = True) -> Union[requests.Response, Optional[dict]]:
+        """
+        Asynchronous version of `FHIR.fhir_delete`.
+
+        :param path: The additional path components to DELETE
+        :type path: list[str]
+        :param content: Whether to return parsed response data or the response
+        :type content: bool, defaults to True
+        :return: The response content or None if request failed
+        :rtype: Union[requests.Response, Optional[dict]]
+        """
+        return await self._run(FHIR.fhir_delete, path, content=content)
+
+    async def fhir_search(self, path: list[str], query: dict = None) -> dict:
+        """
+        Asynchronous version of `FHIR.fhir_search`.
+
+        :param path: The additional path components to search from
+        :type path: list[str]
+        :param query: The query to include in the body of the request
+        :type query: dict, defaults to None
+        :return: The FHIR Bundle object from the search
+        :rtype: dict
+        """
+        return await self._run(FHIR.fhir_search, path, query=query)
+
+    async def _query_bundle(self, resource_type: str, query: dict[str, Any] = None) -> Bundle:
+        """
+        Asynchronous version of `FHIR._query_bundle`.
+
+        :param resource_type: FHIR resource type
+        :type resource_type: str
+        :param query: A dict of key value pairs for searching resources
+        :type query: dict
+        :return: A Bundle resource containing the results of the search
+        :rtype: Bundle
+        """
+        return await self._run(FHIR._query_bundle, resource_type, query=query)
+
+    async def get_participant(
+        self,
+        patient: Union[Patient, dict, str],
+        study: str = None,
+        questionnaires: list[dict] = None,
+        flatten_return: bool = False,
+    ) -> dict:
+        """
+        Asynchronous version of `FHIR.get_participant`.
+
+        :param patient: The participant identifier, PPM ID or email
+        :type patient: Union[Patient, dict, str]
+        :param study: The study to fetch resources for
+        :type study: str, defaults to None
+        :param questionnaires: The list of survey/questionnaires for this study
+        :type questionnaires: list, defaults to None
+        :param flatten_return: Whether to flatten the resources or not
+        :type flatten_return: bool, defaults to False
+        :returns: A dictionary comprising the user's record
+        :rtype: dict
+        """
+        return await self._run(
+            FHIR.get_participant,
+            patient,
+            study=study,
+            questionnaires=questionnaires,
+            flatten_return=flatten_return,
+        )
+
+    async def get_participants(
+        self,
+        patients: list[Union[Patient, dict, str]],
+        study: str = None,
+        questionnaires: list[dict] = None,
+        flatten_return: bool = False,
+    ) -> list[dict]:
+        """
+        Fetches the records for a set of participants concurrently. Results
+        are returned in the same order as the participants passed.
+
+        :param patients: The participant identifiers, PPM IDs or emails
+        :type patients: list[Union[Patient, dict, str]]
+        :param study: The study to fetch resources for
+        :type study: str, defaults to None
+        :param questionnaires: The list of survey/questionnaires for this study
+        :type questionnaires: list, defaults to None
+        :param flatten_return: Whether to flatten the resources or not
+        :type flatten_return: bool, defaults to False
+        :returns: A list of each participant's record
+        :rtype: list[dict]
+        """
+        return await asyncio.gather(
+            *[
+                self.get_participant(patient, study=study, questionnaires=questionnaires, flatten_return=flatten_return)
+                for patient in patients
+            ]
+        )
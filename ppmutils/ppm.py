@@ -1,4 +1,5 @@
 from enum import Enum
+import copy
 import requests
 from furl import furl
 import json
@@ -21,31 +22,87 @@ def django_enum(cls):
     return cls
 
 
+# Lookup indexes for PPMEnum classes, built on first use
+_enum_indexes = {}
+
+# The parsed Qualtrics survey mapping and the raw setting it was parsed from
+_qualtrics_surveys = None
+
+# The compiled test email patterns and the setting they were compiled from
+_tester_patterns = None
+
+
 class PPMEnum(Enum):
     """
     An extended Enum class with some convenience methods for working with
     enum values/keys/etc
     """
 
+    @classmethod
+    def _index_keys(cls, item, title):
+        """
+        Returns the keys that resolve to the passed member: the member
+        itself, its name, value and title, and its title ignoring case.
+        :param item: The enum member
+        :type item: PPMEnum
+        :param title: The member's title from choices, if any
+        :type title: str
+        :return: The exact keys and the lowercase keys
+        :rtype: tuple(list, list)
+        """
+        return [item, item.name, item.value] + ([title] if title else []), [title.lower()] if title else []
+
+    @classmethod
+    def _index(cls):
+        """
+        Returns the lookup index for this enum, building it on first use.
+        Keys map to the position and member they resolve to so that, as
+        with a scan of the members, the first matching member wins.
+        :return: The exact index, the lowercase index and the titles
+        :rtype: tuple(dict, dict, dict)
+        """
+        index = _enum_indexes.get(cls)
+        if index is None:
+            titles = dict(cls.choices())
+            exact, folded = {}, {}
+            for position, item in enumerate(cls):
+                exact_keys, folded_keys = cls._index_keys(item, titles.get(item.value))
+                for key in exact_keys:
+                    exact.setdefault(key, (position, item))
+                for key in folded_keys:
+                    folded.setdefault(key, (position, item))
+
+            index = _enum_indexes[cls] = (exact, folded, titles)
+
+        return index
+
+    @classmethod
+    def _titles(cls):
+        """
+        Returns the titles of this enum's members by value
+        :return: A dict of member values to titles
+        :rtype: dict
+        """
+        return cls._index()[2]
+
     @classmethod
     def enum(cls, enum):
         """Accepts any form of an enum and returns the enum"""
-        for item in cls:
-            if enum is item or enum == item.name or enum == item.value:
-                return item
+        exact, folded, _ = cls._index()
+        try:
+            match = exact.get(enum)
+        except TypeError:
+            match = None
 
-            # Compare titles
-            title = dict(cls.choices()).get(item.value)
-            if title and type(enum) is str:
+        # If case-insensitive, check titles again
+        if type(enum) is str:
+            insensitive = folded.get(enum.lower())
+            if insensitive and (not match or insensitive[0] < match[0]):
+                logger.info(f"PPM: Used case-insensitive check for " f"'{enum}' -> '{insensitive[1]}'")
+                return insensitive[1]
 
-                # Check title
-                if title == enum:
-                    return item
-
-                # If case-insensitive, check titles again
-                elif title.lower() == enum.lower():
-                    logger.info(f"PPM: Used case-insensitive check for " f"'{enum}' -> '{item}'")
-                    return item
+        if match:
+            return match[1]
 
         raise ValueError('Value "{}" is not a valid {}'.format(enum, cls.__name__))
 
@@ -95,10 +152,10 @@ class PPMEnum(Enum):
         :rtype: str
         """
         # Get the value
-        value = cls.get(enum).value
+        item = cls.get(enum)
 
         # Try choices
-        return dict(cls.choices())[value] if value in dict(cls.choices()) else cls.get(enum).name
+        return cls._titles().get(item.value, item.name)
 
     @classmethod
     def choices(cls):
@@ -175,6 +232,51 @@ class PPM:
 
         raise ValueError("FHIR_URL not defined in settings or in environment")
 
+    @staticmethod
+    def tester_patterns():
+        """
+        Returns the test user email patterns compiled into a list of regular
+        expressions. Patterns are combined into a single alternation where
+        possible and are only compiled again when the setting changes.
+        :return: list
+        """
+        global _tester_patterns
+
+        if hasattr(settings, "TEST_EMAIL_PATTERNS") and type(getattr(settings, "TEST_EMAIL_PATTERNS")) is str:
+            testers = tuple(settings.TEST_EMAIL_PATTERNS.split(","))
+        elif hasattr(settings, "TEST_EMAIL_PATTERNS") and type(getattr(settings, "TEST_EMAIL_PATTERNS")) is list:
+            testers = tuple(settings.TEST_EMAIL_PATTERNS)
+        else:
+            return []
+
+        # Check for compiled patterns
+        if _tester_patterns is not None and _tester_patterns[0] == testers:
+            return _tester_patterns[1]
+
+        combined, separate = [], []
+        for tester in testers:
+            pattern = re.compile(tester)
+
+            # Backreferences would point elsewhere once groups are renumbered, so leave those separate
+            if re.search(r"\\[1-9]|\(\?P=", tester):
+                separate.append(pattern)
+                continue
+
+            try:
+                # Inline flags and repeated group names can not be combined
+                re.compile("|".join(f"(?:{t})" for t in combined + [tester]))
+                combined.append(tester)
+
+            except re.error:
+                separate.append(pattern)
+
+        patterns = separate
+        if combined:
+            patterns = [re.compile("|".join(f"(?:{tester})" for tester in combined))] + separate
+
+        _tester_patterns = (testers, patterns)
+        return patterns
+
     @staticmethod
     def is_tester(email):
         """
@@ -183,20 +285,24 @@ class PPM:
         :param email: The user's email address
         :return: bool
         """
-        if hasattr(settings, "TEST_EMAIL_PATTERNS") and type(getattr(settings, "TEST_EMAIL_PATTERNS")) is str:
-            testers = settings.TEST_EMAIL_PATTERNS.split(",")
-        elif hasattr(settings, "TEST_EMAIL_PATTERNS") and type(getattr(settings, "TEST_EMAIL_PATTERNS")) is list:
-            testers = settings.TEST_EMAIL_PATTERNS
-        else:
-            return False
-
         # Iterate through all patterns
-        for pattern in testers:
-            if re.match(pattern, email):
+        for pattern in PPM.tester_patterns():
+            if pattern.match(email):
                 return True
 
         return False
 
+    @staticmethod
+    def classify_testers(emails):
+        """
+        Checks test user email patterns against each of the passed emails.
+        :param emails: The emails to check
+        :return: dict of each email to whether it is a tester's
+        """
+        patterns = PPM.tester_patterns()
+
+        return {email: any(pattern.match(email) for pattern in patterns) for email in emails}
+
     @django_enum
     class Study(PPMEnum):
         NEER = "neer"
@@ -242,19 +348,9 @@ class PPM:
             return identifier.lower() in PPM.Study.identifiers()
 
         @classmethod
-        def enum(cls, enum):
-            """Accepts any form of an enum and returns the enum"""
-            for item in cls:
-                if (
-                    enum is item
-                    or enum == item.name
-                    or enum == item.value
-                    or enum == cls.title(item)
-                    or enum == cls.fhir_id(item)
-                ):
-                    return item
-
-            raise ValueError('Value "{}" is not a valid {}'.format(enum, cls.__name__))
+        def _index_keys(cls, item, title):
+            """Studies also resolve from their FHIR identifier, titles are case-sensitive"""
+            return [item, item.name, item.value, title, "ppm-{}".format(item.value)], []
 
         @classmethod
         def get(cls, enum):
@@ -288,7 +384,7 @@ class PPM:
             :return: The title for the study
             :rtype: str
             """
-            return dict(PPM.Study.choices())[PPM.Study.get(study).value]
+            return PPM.Study._titles()[PPM.Study.get(study).value]
 
         @classmethod
         def choices(cls):
@@ -675,13 +771,9 @@ class PPM:
                 return False
 
         @classmethod
-        def enum(cls, enum):
-            """Accepts any form of an enum and returns the enum"""
-            for item in cls:
-                if enum is item or enum == item.name or enum == item.value or enum == cls.title(item):
-                    return item
-
-            raise ValueError('Value "{}" is not a valid {}'.format(enum, cls.__name__))
+        def _index_keys(cls, item, title):
+            """Titles are case-sensitive"""
+            return [item, item.name, item.value, title], []
 
         @classmethod
         def get(cls, enum):
@@ -708,7 +800,7 @@ class PPM:
         @classmethod
         def title(cls, enrollment):
             """Returns the value to be used as the enrollment's title"""
-            return dict(PPM.Enrollment.choices())[PPM.Enrollment.get(enrollment).value]
+            return PPM.Enrollment._titles()[PPM.Enrollment.get(enrollment).value]
 
         @staticmethod
         def is_active(enrollment):
@@ -754,13 +846,9 @@ class PPM:
         PicnicHealthRegistration = "picnichealth-registration"
 
         @classmethod
-        def enum(cls, enum):
-            """Accepts any form of an enum and returns the enum"""
-            for item in cls:
-                if enum is item or enum == item.name or enum == item.value or enum == cls.title(item):
-                    return item
-
-            raise ValueError('Value "{}" is not a valid {}'.format(enum, cls.__name__))
+        def _index_keys(cls, item, title):
+            """Titles are case-sensitive"""
+            return [item, item.name, item.value, title], []
 
         @classmethod
         def get(cls, enum):
@@ -783,7 +871,7 @@ class PPM:
         @classmethod
         def title(cls, communication):
             """Returns the value to be used as the communication's title"""
-            return dict(PPM.Communication.choices())[PPM.Communication.get(communication).value]
+            return PPM.Communication._titles()[PPM.Communication.get(communication).value]
 
     class Questionnaire(PPMEnum):
         """
@@ -894,18 +982,29 @@ class PPM:
             )
 
         @classmethod
-        def qualtrics_survey_ids(cls):
+        def _qualtrics_surveys(cls, reload=False):
             """
-            This method returns a mapping of Qualtrics survey IDs to PPM
-            Questionnaire IDs.
+            Returns the Qualtrics survey mapping parsed from the environment
+            along with indexes of it. The mapping is only parsed and validated
+            again if the environment variable changes or a reload is forced.
 
-            :return: A dictionary of Qualtrics IDs to PPM Questionnaire IDs
-            :rtype: dict
+            :param reload: Whether to parse the mapping even if unchanged
+            :type reload: bool
+            :return: The mapping, questionnaire IDs by survey ID, survey IDs by
+            questionnaire ID, and questionnaire IDs by survey ID per study
+            :rtype: tuple(dict, dict, dict, dict)
             """
-            # Get mapping from environment
+            global _qualtrics_surveys
+
+            # Check for a parsed mapping
+            raw = os.environ.get("SOURCE_QUALTRICS_SURVEYS")
+            if not reload and _qualtrics_surveys is not None and _qualtrics_surveys[0] == raw:
+                return _qualtrics_surveys[1]
+
+            surveys, by_survey, by_questionnaire, by_study = {}, {}, {}, {}
             try:
                 # Attempt to parse dictionary from environment
-                surveys = json.loads(os.environ.get("SOURCE_QUALTRICS_SURVEYS"))
+                surveys = json.loads(raw)
 
                 # Check format
                 for study, study_surveys in surveys.items():
@@ -920,12 +1019,60 @@ class PPM:
                                 " invalid, unknown key: {} : {}".format(survey, e),
                                 exc_info=True,
                             )
-                return surveys
+
+                # Index both directions, the first mapping for an ID wins
+                for study, study_surveys in surveys.items():
+                    by_study[study] = {}
+                    for survey in study_surveys:
+                        survey_id, questionnaire_id = survey.get("survey_id"), survey.get("questionnaire_id")
+                        if questionnaire_id:
+                            by_survey.setdefault(survey_id, questionnaire_id)
+                            by_study[study].setdefault(survey_id, questionnaire_id)
+                        if survey_id:
+                            by_questionnaire.setdefault(questionnaire_id, survey_id)
 
             except Exception as e:
                 logger.exception("PPM/Questionnaire: Error parsing Qualtrics " "map: {}".format(e), exc_info=True)
+                surveys, by_survey, by_questionnaire, by_study = {}, {}, {}, {}
 
-            return {}
+            _qualtrics_surveys = (raw, (surveys, by_survey, by_questionnaire, by_study))
+            return _qualtrics_surveys[1]
+
+        @classmethod
+        def reload_qualtrics_survey_ids(cls):
+            """
+            Parses the Qualtrics survey mapping from the environment again.
+            """
+            cls._qualtrics_surveys(reload=True)
+
+        @classmethod
+        def qualtrics_survey_ids(cls):
+            """
+            This method returns a mapping of Qualtrics survey IDs to PPM
+            Questionnaire IDs.
+
+            :return: A dictionary of Qualtrics IDs to PPM Questionnaire IDs
+            :rtype: dict
+            """
+            return copy.deepcopy(cls._qualtrics_surveys()[0])
+
+        @classmethod
+        def qualtrics_survey_ids_for_study(cls, study):
+            """
+            Returns the mapping of Qualtrics survey IDs to PPM Questionnaire
+            IDs for the passed study.
+
+            :param study: The study as keyed in the mapping
+            :type study: str
+            :return: A dictionary of Qualtrics IDs to PPM Questionnaire IDs
+            :rtype: dict
+            """
+            by_study = cls._qualtrics_surveys()[3]
+            surveys = by_study.get(study)
+            if surveys is None and PPM.Study.check(study):
+                surveys = by_study.get(PPM.Study.get(study).value)
+
+            return dict(surveys or {})
 
         @classmethod
         def questionnaire_id_for_qualtrics_id(cls, survey_id):
@@ -942,16 +1089,9 @@ class PPM:
             :rtype: str
             """
             try:
-                for _, surveys in cls.qualtrics_survey_ids().items():
-
-                    # Check for questionnaire ID
-                    questionnaire_id = next(
-                        (s.get("questionnaire_id") for s in surveys if s.get("survey_id") == survey_id), None
-                    )
-
-                    # If not questionnaire ID
-                    if not questionnaire_id:
-                        continue
+                # Check for questionnaire ID
+                questionnaire_id = cls._qualtrics_surveys()[1].get(survey_id)
+                if questionnaire_id:
 
                     # Return it
                     logger.debug('PPM/Questionnaire: Found "{}"' 'for "{}"'.format(questionnaire_id, survey_id))
@@ -978,16 +1118,9 @@ class PPM:
             :rtype: str
             """
             try:
-                for _, surveys in cls.qualtrics_survey_ids().items():
-
-                    # Check for questionnaire ID
-                    survey_id = next(
-                        (s.get("survey_id") for s in surveys if s.get("questionnaire_id") == questionnaire_id), None
-                    )
-
-                    # If not survey ID
-                    if not survey_id:
-                        continue
+                # Check for survey ID
+                survey_id = cls._qualtrics_surveys()[2].get(questionnaire_id)
+                if survey_id:
 
                     # Return it
                     logger.debug('PPM/Questionnaire: Found "{}" for "{}"'.format(survey_id, questionnaire_id))
@@ -5,10 +5,14 @@ import unittest
 import uuid
 import re
 import json
+import requests
+import os
+import threading
+import time
 from datetime import datetime, timezone
 
 from ppmutils.ppm import PPM
-from ppmutils.fhir import FHIR
+from ppmutils.fhir import FHIR, Backend
 
 
 class TestFHIR(unittest.TestCase):
@@ -1956,6 +1960,1055 @@ class TestFHIR(unittest.TestCase):
         # Check each transaction request
         self.assertIn("Patient/" + patient["id"], responses.calls[0].request.url)
 
+    @responses.activate
+    def test_backend_session_reused(self):
+
+        # Build the response handler
+        responses.add(
+            responses.GET,
+            re.compile(self.fhir_url + r"/Patient.*"),
+            json=FHIRData.create_bundle([], self.fhir_url),
+            status=200,
+        )
+
+        # Make a few requests
+        session = FHIR.backend().session
+        FHIR.fhir_get(["Patient"])
+        FHIR.fhir_get(["Patient"])
+
+        # Ensure the same pooled session is used
+        self.assertEqual(len(responses.calls), 2)
+        self.assertIs(FHIR.backend().session, session)
+        self.assertEqual(session.get_adapter(self.fhir_url)._pool_maxsize, FHIR.backend().pool_maxsize)
+
+    @responses.activate
+    def test_aws_signer_reused(self):
+        from ppmutils.fhir import AWSHealthlake
+
+        # Set static credentials
+        environ = {"AWS_ACCESS_KEY_ID": "AKIAEXAMPLE", "AWS_SECRET_ACCESS_KEY": "secret", "AWS_REGION": "us-east-1"}
+        with mock.patch.dict("os.environ", environ):
+
+            # Build the response handler
+            responses.add(responses.GET, re.compile(self.fhir_url + r"/Patient.*"), json={}, status=200)
+
+            # Make a few requests
+            backend = AWSHealthlake()
+            backend.request("GET", self.fhir_url + "/Patient")
+            signer = backend.signer("us-east-1")
+            backend.request("GET", self.fhir_url + "/Patient")
+
+            # Ensure requests were signed by the same signer
+            self.assertEqual(len(responses.calls), 2)
+            self.assertIs(backend.signer("us-east-1"), signer)
+            self.assertIn("AWS4-HMAC-SHA256", responses.calls[1].request.headers["Authorization"])
+
+            # Ensure rotated credentials rebuild the signer
+            os.environ["AWS_ACCESS_KEY_ID"] = "AKIAROTATED"
+            backend._boto_sessions.clear()
+            self.assertIsNot(backend.signer("us-east-1"), signer)
+            self.assertEqual(backend.signer("us-east-1").aws_access_key_id, "AKIAROTATED")
+
+    def test_gcp_token_refreshed_in_background(self):
+        from datetime import timedelta
+        from ppmutils.fhir import GCPTokenProvider
+
+        # Build fake credentials that issue numbered tokens
+        refreshed = threading.Event()
+        credentials = mock.MagicMock()
+
+        def refresh(request):
+            credentials.token = "token-{}".format(credentials.refresh.call_count)
+            credentials.expiry = datetime.utcnow() + timedelta(seconds=3600)
+            refreshed.set()
+
+        credentials.refresh.side_effect = refresh
+        provider = GCPTokenProvider(refresh_margin=300)
+        provider._credentials = credentials
+
+        # The first request blocks on a refresh and later requests reuse it
+        self.assertEqual(provider.token, "token-1")
+        self.assertEqual(provider.token, "token-1")
+        self.assertEqual(credentials.refresh.call_count, 1)
+
+        # Once within the margin the current token is returned while refreshing
+        refreshed.clear()
+        provider._state = ("token-1", datetime.utcnow() + timedelta(seconds=60))
+        self.assertEqual(provider.token, "token-1")
+        self.assertTrue(refreshed.wait(5))
+        with provider._lock:
+            self.assertEqual(provider.token, "token-2")
+
+        # An expired token blocks on a refresh
+        provider._state = ("token-2", datetime.utcnow() - timedelta(seconds=1))
+        self.assertEqual(provider.token, "token-3")
+
+    @responses.activate
+    def test_async_fhir_get_concurrency(self):
+        import asyncio
+        import contextvars
+        import time
+        from ppmutils.fhir import AsyncFHIR
+
+        # Track the number of requests in flight and the caller's context
+        lock = threading.Lock()
+        in_flight = {"current": 0, "max": 0}
+        caller = contextvars.ContextVar("caller", default=None)
+        callers = []
+
+        def callback(request):
+            callers.append(caller.get())
+            with lock:
+                in_flight["current"] += 1
+                in_flight["max"] = max(in_flight["max"], in_flight["current"])
+            time.sleep(0.05)
+            with lock:
+                in_flight["current"] -= 1
+
+            return 200, {}, json.dumps({"resourceType": "Patient", "id": request.url.rsplit("/", 1)[-1]})
+
+        # Build the response handler
+        responses.add_callback(responses.GET, re.compile(self.fhir_url + r"/Patient/.*"), callback=callback)
+
+        async def fetch():
+            caller.set("fetch")
+            async with AsyncFHIR(max_concurrency=3) as client:
+                return await asyncio.gather(*[client.fhir_get(["Patient", str(i)]) for i in range(9)])
+
+        # Run the requests
+        patients = asyncio.run(fetch())
+
+        # Ensure all results are returned in order and concurrency was bounded
+        self.assertEqual([p["id"] for p in patients], [str(i) for i in range(9)])
+        self.assertEqual(len(responses.calls), 9)
+        self.assertLessEqual(in_flight["max"], 3)
+        self.assertGreater(in_flight["max"], 1)
+
+        # Ensure the caller's context is visible to each request
+        self.assertEqual(callers, ["fetch"] * 9)
+
+    @responses.activate
+    def test_query_bundle_pages(self):
+
+        # Build pages of resources linked by `next` URLs with an internal host
+        pages = 4
+        for page in range(pages):
+            bundle = FHIRData.create_bundle(
+                [FHIRData.research_subject(f"Patient/{page}", PPM.Study.NEER)], self.fhir_url
+            )
+            if page < pages - 1:
+                bundle["link"] = [{"relation": "next", "url": f"http://internal/ResearchSubject?page={page + 1}"}]
+
+            # The first page is the initial query
+            responses.add(
+                responses.GET,
+                re.compile(self.fhir_url + (rf"/ResearchSubject\?page={page}$" if page else r"/ResearchSubject\?_c.*")),
+                json=bundle,
+                status=200,
+            )
+
+        # Query
+        bundle = FHIR._query_bundle("ResearchSubject")
+
+        # Ensure all pages were fetched from the configured host and merged
+        self.assertEqual(len(bundle.entry), pages)
+        self.assertTrue(all(c.request.url.startswith(self.fhir_url) for c in responses.calls))
+
+    @responses.activate
+    def test_fhir_search_pages(self):
+
+        # Build two pages of results
+        first = FHIRData.create_bundle([FHIRData.research_study(PPM.Study.NEER)], self.fhir_url)
+        first["link"] = [{"relation": "next", "url": f"{self.fhir_url}/?_getpages=abc&_getpagesoffset=1"}]
+        second = FHIRData.create_bundle([FHIRData.research_study(PPM.Study.ASD)], self.fhir_url)
+
+        # The search is a POST and the next page is a GET
+        responses.add(responses.POST, self.fhir_url + "/ResearchStudy/_search", json=first, status=200)
+        responses.add(responses.GET, re.compile(self.fhir_url + r"/\?_getpages=.*"), json=second, status=200)
+
+        # Search
+        bundle = FHIR.fhir_search(["ResearchStudy"])
+
+        # Ensure both pages were merged
+        self.assertEqual(bundle["total"], 2)
+        self.assertEqual([c.request.method for c in responses.calls], ["POST", "GET"])
+
+    @responses.activate
+    def test_query_bundle_page_error(self):
+
+        # The second page fails
+        first = FHIRData.create_bundle([FHIRData.research_study(PPM.Study.NEER)], self.fhir_url)
+        first["link"] = [{"relation": "next", "url": f"{self.fhir_url}/ResearchStudy?page=1"}]
+        responses.add(responses.GET, re.compile(self.fhir_url + r"/ResearchStudy\?_count.*"), json=first, status=200)
+        responses.add(responses.GET, re.compile(self.fhir_url + r"/ResearchStudy\?page.*"), json={}, status=500)
+
+        # Ensure the error is raised to the caller
+        with self.assertRaises(requests.HTTPError):
+            FHIR._query_bundle("ResearchStudy")
+
+    @responses.activate
+    def test_iter_resources(self):
+
+        # Build two pages of resources
+        first = FHIRData.create_bundle([FHIRData.research_study(PPM.Study.NEER)], self.fhir_url)
+        first["link"] = [{"relation": "next", "url": f"{self.fhir_url}/ResearchStudy?page=1"}]
+        second = FHIRData.create_bundle([FHIRData.research_study(PPM.Study.ASD)], self.fhir_url)
+        responses.add(responses.GET, re.compile(self.fhir_url + r"/ResearchStudy\?_count.*"), json=first, status=200)
+        responses.add(responses.GET, re.compile(self.fhir_url + r"/ResearchStudy\?page.*"), json=second, status=200)
+
+        # Ensure resources are yielded as pages arrive
+        resources = FHIR.iter_resources("ResearchStudy")
+        self.assertEqual(next(resources)["id"], first["entry"][0]["resource"]["id"])
+        self.assertEqual(next(resources)["id"], second["entry"][0]["resource"]["id"])
+        self.assertIsNone(next(resources, None))
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_backend_retries_transient_errors(self):
+        from ppmutils.fhir import RetryPolicy
+
+        # Fail twice with throttling before succeeding
+        url = self.fhir_url + "/Patient/123"
+        responses.add(responses.GET, url, json={}, status=429, headers={"Retry-After": "2"})
+        responses.add(responses.GET, url, json={}, status=503)
+        responses.add(responses.GET, url, json={"resourceType": "Patient", "id": "123"}, status=200)
+
+        with mock.patch.object(RetryPolicy, "sleep") as mock_sleep:
+            patient = FHIR.fhir_get(["Patient", "123"])
+
+        # Ensure the request was retried and the server's delay was honored
+        self.assertEqual(patient["id"], "123")
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(mock_sleep.call_args_list[0].args[0], 2.0)
+
+    @responses.activate
+    def test_backend_does_not_retry_unsafe_post(self):
+        import time
+        from ppmutils.fhir import RetryPolicy
+
+        # A plain create is never retried while a search is
+        responses.add(responses.POST, self.fhir_url + "/Patient", json={}, status=503)
+        responses.add(responses.POST, self.fhir_url + "/Patient/_search", json={}, status=503)
+
+        with mock.patch.object(RetryPolicy, "sleep"):
+            response = FHIR.backend().request("post", self.fhir_url + "/Patient", json={})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(len(responses.calls), 1)
+
+            # Conditional creates and searches are retried
+            FHIR.backend().request("post", self.fhir_url + "/Patient", json={}, headers={"If-None-Exist": "_id=1"})
+            FHIR.backend().request("post", self.fhir_url + "/Patient/_search", data={})
+            self.assertEqual(len(responses.calls), 1 + 2 * FHIR.backend().retry_policy.max_attempts)
+
+            # If-Match only makes updates safe to repeat
+            FHIR.backend().request("post", self.fhir_url + "/Patient", json={}, headers={"If-Match": 'W/"1"'})
+            self.assertEqual(len(responses.calls), 2 + 2 * FHIR.backend().retry_policy.max_attempts)
+            self.assertTrue(FHIR.backend().retry_policy.is_retryable("patch", "/Patient/1", {"If-Match": 'W/"1"'}))
+            self.assertFalse(FHIR.backend().retry_policy.is_retryable("patch", "/Patient/1"))
+
+        # Ensure each attempt's timeout is limited by the deadline
+        deadline = FHIR.backend().retry_policy.deadline
+        self.assertLessEqual(responses.calls[0].request.req_kwargs["timeout"], deadline)
+        self.assertEqual(FHIR.backend().retry_policy.timeout(time.monotonic() + deadline, 5.0), 5.0)
+
+    def test_retry_policy_retry_after(self):
+        from email.utils import format_datetime
+        from datetime import timedelta
+        from ppmutils.fhir import RetryPolicy
+
+        # Check both forms of the header
+        policy = RetryPolicy()
+        response = mock.MagicMock(headers={"Retry-After": "5"})
+        self.assertEqual(policy.retry_after(response), 5.0)
+        response.headers = {"Retry-After": format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30))}
+        self.assertAlmostEqual(policy.retry_after(response), 30, delta=2)
+        response.headers = {"Retry-After": "soon"}
+        self.assertIsNone(policy.retry_after(response))
+
+    def test_token_bucket(self):
+        from ppmutils.fhir import TokenBucket
+
+        # Allow a burst of two at ten per second
+        bucket = TokenBucket(10, burst=2)
+        with mock.patch.object(TokenBucket, "sleep") as mock_sleep:
+            waits = [bucket.acquire() for _ in range(4)]
+
+        # Ensure the burst is free and later requests wait their turn
+        self.assertEqual(waits[:2], [0.0, 0.0])
+        self.assertAlmostEqual(waits[2], 0.1, delta=0.02)
+        self.assertAlmostEqual(waits[3], 0.2, delta=0.02)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @responses.activate
+    def test_rate_limiter_budgets(self):
+        from ppmutils.fhir import RateLimiter
+
+        # Limit writes only
+        responses.add(responses.GET, self.fhir_url + "/Patient", json={}, status=200)
+        responses.add(responses.POST, self.fhir_url + "/Patient", json={}, status=201)
+        responses.add(responses.POST, self.fhir_url + "/Patient/_search", json={}, status=200)
+        limiter = RateLimiter(write_rate=5)
+        self.assertIsNone(limiter.read_bucket)
+
+        with mock.patch.object(FHIR.backend(), "rate_limiter", limiter), mock.patch.object(
+            limiter.write_bucket, "acquire", return_value=0.0
+        ) as mock_acquire:
+            FHIR.backend().request("get", self.fhir_url + "/Patient")
+            FHIR.backend().request("post", self.fhir_url + "/Patient/_search", data={})
+            FHIR.backend().request("post", self.fhir_url + "/Patient", json={})
+
+        # Ensure only the write was counted
+        self.assertEqual(mock_acquire.call_count, 1)
+
+    def test_cache_token_bucket(self):
+        from django.core.cache.backends.locmem import LocMemCache
+        from ppmutils.fhir import CacheTokenBucket
+
+        # Share a budget of two per second between two buckets
+        cache = LocMemCache("fhir-rate-limit", {})
+        buckets = [CacheTokenBucket(2, key="test", cache=cache) for _ in range(2)]
+        with mock.patch("ppmutils.fhir.time.time", return_value=1000.5), mock.patch.object(
+            CacheTokenBucket, "sleep", side_effect=lambda seconds: cache.clear()
+        ) as mock_sleep:
+            self.assertEqual(buckets[0].acquire(), 0.0)
+            self.assertEqual(buckets[1].acquire(), 0.0)
+
+            # The third request waits for the next window
+            self.assertEqual(buckets[0].acquire(), 0.5)
+            self.assertEqual(mock_sleep.call_count, 1)
+
+        # Ensure rates below one allow a request per longer window
+        bucket = CacheTokenBucket(0.25, key="slow", cache=cache)
+        with mock.patch("ppmutils.fhir.time.time", return_value=1001.0), mock.patch.object(
+            CacheTokenBucket, "sleep", side_effect=lambda seconds: cache.clear()
+        ) as mock_sleep:
+            self.assertEqual(bucket.acquire(), 0.0)
+            self.assertEqual(bucket.acquire(), 3.0)
+            self.assertEqual(mock_sleep.call_count, 1)
+
+        # Ensure fractional rates above one are honored
+        bucket = CacheTokenBucket(2.5, key="fractional", cache=cache)
+        self.assertEqual((bucket.window, bucket.budget), (1.2, 3))
+        with mock.patch("ppmutils.fhir.time.time", return_value=1200.0), mock.patch.object(
+            CacheTokenBucket, "sleep"
+        ) as mock_sleep:
+            self.assertEqual([bucket.acquire() for _ in range(3)], [0.0, 0.0, 0.0])
+            self.assertEqual(mock_sleep.call_count, 0)
+
+    @responses.activate
+    def test_coalesced_gets(self):
+        import time
+
+        # Hold the response until all callers are waiting
+        release = threading.Event()
+
+        def callback(request):
+            release.wait(5)
+            return 200, {}, json.dumps({"resourceType": "Patient", "id": "123"})
+
+        responses.add_callback(responses.GET, self.fhir_url + "/Patient/123", callback=callback)
+
+        # Make identical reads concurrently
+        results = []
+        with mock.patch.object(FHIR, "COALESCE_GETS", True):
+            threads = [
+                threading.Thread(target=lambda: results.append(FHIR.fhir_get(["Patient", "123"]))) for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.2)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        # Ensure one request was made and each caller got its own copy
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(r == {"resourceType": "Patient", "id": "123"} for r in results))
+        self.assertEqual(len({id(r) for r in results}), 4)
+
+    @responses.activate
+    def test_fhir_read_conditional(self):
+
+        # Serve the resource with an ETag and then as unmodified
+        study = FHIRData.research_study(PPM.Study.NEER)
+        url = f"{self.fhir_url}/ResearchStudy/{study['id']}"
+        responses.add(responses.GET, url, json=study, status=200, headers={"ETag": 'W/"1"'})
+        responses.add(responses.GET, url, body=b"", status=304)
+
+        # Read twice
+        FHIR._conditional_reads.clear()
+        first = FHIR.fhir_read("ResearchStudy", study["id"])
+        first["status"] = "modified"
+        second = FHIR.fhir_read("ResearchStudy", study["id"])
+
+        # Ensure the second read was conditional and returned an unmodified copy
+        self.assertEqual(len(responses.calls), 2)
+        self.assertNotIn("If-None-Match", responses.calls[0].request.headers)
+        self.assertEqual(responses.calls[1].request.headers["If-None-Match"], 'W/"1"')
+        self.assertEqual(second, study)
+
+
+class TestLocalFHIR(unittest.TestCase):
+    def setUp(self):
+
+        # Use the in-memory server
+        self.fhir_url = "memory://fhir"
+        self.ppm_fhir_url_patcher = mock.patch("ppmutils.ppm.PPM.fhir_url")
+        self.mock_ppm_fhir_url = self.ppm_fhir_url_patcher.start()
+        self.mock_ppm_fhir_url.return_value = self.fhir_url
+
+        self.backend = Backend.instance(self.fhir_url)
+        FHIR.set_backend(self.backend)
+
+    def tearDown(self):
+
+        # Reset the backend
+        FHIR.set_backend(None)
+        self.ppm_fhir_url_patcher.stop()
+
+    def load_participant(self, email, study=PPM.Study.NEER):
+        patient = FHIRData.patient(email, firstname="User", lastname="Patient")
+        patient["id"] = str(uuid.uuid4())
+        subject = FHIRData.research_subject(f"Patient/{patient['id']}", study)
+        subject["id"] = str(uuid.uuid4())
+        flag = FHIRData.enrollment_flag(f"Patient/{patient['id']}", study)
+        flag["id"] = str(uuid.uuid4())
+        self.backend.load([patient, subject, flag])
+
+        return patient
+
+    def test_get_participant(self):
+        from ppmutils.fhir import LocalFHIR
+
+        # Load participants and their study
+        self.assertIsInstance(self.backend, LocalFHIR)
+        self.backend.load([FHIRData.research_study(PPM.Study.NEER)])
+        patient = self.load_participant("patient@email.org")
+        self.load_participant("other@email.org")
+
+        # Ensure included and reverse included resources are returned
+        bundle = FHIR.get_participant("patient@email.org")
+        self.assertEqual(
+            sorted(e["resource"]["resourceType"] for e in bundle["entry"]),
+            ["Flag", "Patient", "ResearchStudy", "ResearchSubject"],
+        )
+        self.assertEqual(FHIR._find_resource(bundle, "Patient")["id"], patient["id"])
+
+        # Ensure chained searches work
+        flags = FHIR.query_enrollment_flags("patient@email.org")
+        self.assertEqual([f["subject"]["reference"] for f in flags], [f"Patient/{patient['id']}"])
+
+    def test_search_paging(self):
+
+        # Load enough participants for several pages
+        for index in range(25):
+            self.load_participant(f"patient-{index}@email.org")
+
+        # Ensure all pages are followed
+        bundle = FHIR.fhir_search(["Flag"], {"_count": "10"})
+        self.assertEqual(bundle["total"], 25)
+        self.assertEqual(len({e["resource"]["id"] for e in bundle["entry"]}), 25)
+        self.assertEqual(len(list(FHIR.iter_resources("Patient", {"_count": 7}))), 25)
+
+    def test_transaction(self):
+
+        # Create linked resources with temporary IDs and a conditional create
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": [
+                {
+                    "fullUrl": "urn:uuid:organization",
+                    "resource": {"resourceType": "Organization", "name": "Hospital"},
+                    "request": {"method": "POST", "url": "Organization"},
+                },
+                {
+                    "resource": {
+                        "resourceType": "List",
+                        "status": "current",
+                        "mode": "working",
+                        "identifier": [{"system": "https://example.org", "value": "1"}],
+                        "entry": [{"item": {"reference": "urn:uuid:organization"}}],
+                    },
+                    "request": {"method": "POST", "url": "List", "ifNoneExist": "identifier=https://example.org|1"},
+                },
+            ],
+        }
+        ids = FHIR.get_created_resource_ids(FHIR.fhir_post(bundle, content=False))
+        organization_id = ids["Organization"][0]
+
+        # Ensure the temporary reference was replaced and the second create is skipped
+        resources = FHIR._query_resources("List", {"item": f"Organization/{organization_id}", "_include": "List:item"})
+        self.assertEqual(sorted(r["resourceType"] for r in resources), ["List", "Organization"])
+        FHIR.fhir_transaction(bundle)
+        self.assertEqual(len(FHIR._query_resources("List")), 1)
+
+        # Patch and then delete
+        patch = [{"op": "replace", "path": "/name", "value": "Clinic"}]
+        self.assertEqual(FHIR.fhir_patch(["Organization", organization_id], patch)["name"], "Clinic")
+        self.assertEqual(
+            FHIR._delete_resources([{"resourceType": "Organization", "id": organization_id}]),
+            {f"Organization/{organization_id}": True},
+        )
+        self.assertIsNone(self.backend.resource("Organization", organization_id))
+
+    def test_conditional_read(self):
+
+        # Read a Questionnaire twice
+        self.backend.load([{"resourceType": "Questionnaire", "id": "survey", "status": "active"}])
+        FHIR._conditional_reads.clear()
+        FHIR.fhir_read("Questionnaire", "survey")
+        with mock.patch.object(self.backend, "send", wraps=self.backend.send) as mock_send:
+            questionnaire = FHIR.fhir_read("Questionnaire", "survey")
+
+        # Ensure the server reported it unmodified
+        self.assertEqual(questionnaire["id"], "survey")
+        self.assertEqual(mock_send.call_args.kwargs["headers"], {"If-None-Match": 'W/"1"'})
+
+    def test_record_replay(self):
+        import tempfile
+        from ppmutils.fhir import RecordingBackend, ReplayBackend
+
+        # Record a session
+        self.backend.load([FHIRData.research_study(PPM.Study.NEER)])
+        for index in range(5):
+            self.load_participant(f"patient-{index}@email.org")
+        path = os.path.join(tempfile.mkdtemp(), "session.jsonl.gz")
+        with RecordingBackend(self.backend, path) as recorder:
+            FHIR.set_backend(recorder)
+            participant = FHIR.get_participant("patient-1@email.org")
+            flags = FHIR.fhir_search(["Flag"], {"_count": "2"})
+
+        # Replay it without the server
+        replay = ReplayBackend(path, latency=ReplayBackend.recorded_latency(scale=2))
+        FHIR.set_backend(replay)
+        self.assertEqual(len(replay), 4)
+        with mock.patch.object(replay, "sleep") as mock_sleep:
+            self.assertEqual(FHIR.get_participant("patient-1@email.org"), participant)
+            self.assertEqual(FHIR.fhir_search(["Flag"], {"_count": "2"}), flags)
+        self.assertEqual(mock_sleep.call_count, 4)
+
+        # Ensure unrecorded requests fail
+        with self.assertRaises(ReplayBackend.MissingRecording):
+            replay.request("get", f"{self.fhir_url}/Patient/unknown")
+
+        # Ensure options that only apply to HTTP backends are not accepted
+        self.assertRaises(TypeError, RecordingBackend, self.backend, path, retry_policy=None)
+        self.assertRaises(TypeError, ReplayBackend, path, rate_limiter=None)
+
+    def test_instrumentation(self):
+        from ppmutils.fhir import LatencyHistogram
+
+        # Record requests
+        for index in range(5):
+            self.load_participant(f"patient-{index}@email.org")
+        events = []
+        histogram = LatencyHistogram()
+        FHIR.instrumentation.add_pre_hook(lambda event: events.append(event))
+        FHIR.instrumentation.add_post_hook(histogram)
+        FHIR.instrumentation.add_post_hook(mock.Mock(side_effect=ValueError))
+        try:
+            FHIR.fhir_search(["Flag"], {"_count": "2"})
+            FHIR.fhir_read("Patient", "unknown")
+        finally:
+            FHIR.instrumentation.clear()
+
+        # Ensure events describe each request
+        self.assertEqual(
+            [(e.method, e.resource_type, e.page) for e in events[:3]],
+            [("POST", "Flag", 1), ("GET", "Flag", 2), ("GET", "Flag", 3)],
+        )
+        self.assertEqual([e.status for e in events], [200, 200, 200, 404])
+        self.assertTrue(all(e.latency is not None and e.size > 0 for e in events))
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot[("GET", "Flag")]["count"], 2)
+        self.assertEqual(snapshot[("GET", "Patient")]["errors"], 1)
+        self.assertEqual(histogram.percentile(50, method="get"), LatencyHistogram.BUCKETS[0])
+        self.assertIsNone(histogram.percentile(50, resource_type="Observation"))
+
+    def test_metrics_middleware(self):
+        from ppmutils.fhir import FHIRMetricsMiddleware
+
+        # Handle a view that pages through a search
+        for index in range(5):
+            self.load_participant(f"patient-{index}@email.org")
+        request = mock.Mock(path="/dashboard/", resolver_match=mock.Mock(view_name="dashboard"))
+        response = mock.Mock()
+        middleware = FHIRMetricsMiddleware(lambda request: FHIR.fhir_search(["Flag"], {"_count": "2"}) and response)
+        try:
+            with self.assertLogs("ppmutils.fhir", level="INFO") as logs:
+                self.assertIs(middleware(request), response)
+            FHIR.fhir_search(["Flag"])
+        finally:
+            FHIR.instrumentation.clear()
+            FHIRMetricsMiddleware._hooked = False
+
+        # Ensure only requests for the view, including background pages, were counted
+        self.assertEqual(request.fhir_metrics["calls"], 3)
+        self.assertIn("dashboard made 3 FHIR requests", logs.output[0])
+
+    def test_resource_cache(self):
+        from ppmutils.fhir import ResourceCache
+
+        # Populate the cache from a search
+        FHIR.set_resource_cache(ResourceCache(max_size=10, ttl=60))
+        self.addCleanup(FHIR.set_resource_cache, None)
+        patient = self.load_participant("patient@email.org")
+        FHIR.get_participant("patient@email.org")
+
+        # Ensure reads are served from the cache
+        with mock.patch.object(self.backend, "send", wraps=self.backend.send) as mock_send:
+            first = FHIR.fhir_read("Patient", patient["id"])
+            first["gender"] = "unknown"
+            self.assertEqual(FHIR.fhir_read("Patient", patient["id"])["id"], patient["id"])
+            self.assertNotIn("gender", FHIR.fhir_read("Patient", patient["id"]))
+        mock_send.assert_not_called()
+
+        # Ensure writes invalidate it
+        FHIR.fhir_patch(["Patient", patient["id"]], [{"op": "add", "path": "/gender", "value": "female"}])
+        self.assertEqual(FHIR.fhir_read("Patient", patient["id"])["gender"], "female")
+        FHIR._delete_resources([{"resourceType": "Patient", "id": patient["id"]}])
+        self.assertIsNone(FHIR.fhir_read("Patient", patient["id"]))
+
+        # Ensure batch entries are inspected
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [
+                {"request": {"method": "POST", "url": "Flag"}},
+                {"request": {"method": "GET", "url": "Flag/1"}},
+                {"request": {"method": "PUT", "url": "Flag?identifier=1"}},
+                {"request": {"method": "DELETE", "url": "Device/1"}},
+            ],
+        }
+        self.assertEqual(FHIR._write_targets("post", self.fhir_url, bundle), [("Flag", None), ("Device", "1")])
+        self.assertEqual(FHIR._write_targets("post", f"{self.fhir_url}/Flag/_search", {}), [])
+
+    def test_resource_cache_expiry(self):
+        from ppmutils.fhir import ResourceCache
+
+        # Store resources
+        cache = ResourceCache(max_size=2, ttl=60)
+        generation = cache.generation
+        cache.set_many([{"resourceType": "Device", "id": str(i)} for i in range(3)], generation)
+        cache.set({"resourceType": "Device", "id": "4", "meta": {"tag": [{"code": "SUBSETTED"}]}})
+        self.assertIsNone(cache.get("Device", "0"))
+        self.assertIsNone(cache.get("Device", "4"))
+        self.assertEqual(cache.get("Device", "2"), {"resourceType": "Device", "id": "2"})
+
+        # Ensure stale results are not stored after an invalidation
+        cache.invalidate("Device")
+        cache.set({"resourceType": "Device", "id": "1"}, generation)
+        self.assertIsNone(cache.get("Device", "1"))
+
+        # Ensure entries expire
+        cache.set({"resourceType": "Device", "id": "1"})
+        with mock.patch("ppmutils.fhir.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get("Device", "1"))
+
+    def test_participant_cache(self):
+        from ppmutils.fhir import ParticipantCache
+
+        # Cache a participant
+        FHIR.set_participant_cache(ParticipantCache(probe=False))
+        self.addCleanup(FHIR.set_participant_cache, None)
+        patient = self.load_participant("patient@email.org")
+        bundle = FHIR.get_participant("patient@email.org")
+
+        # Ensure the cached bundle is used
+        with mock.patch.object(self.backend, "send", wraps=self.backend.send) as mock_send:
+            self.assertEqual(FHIR.get_participant("patient@email.org"), bundle)
+        mock_send.assert_not_called()
+
+        # Ensure resources created for the participant invalidate it
+        flag = FHIRData.enrollment_flag(f"Patient/{patient['id']}", PPM.Study.EXAMPLE)
+        FHIR.fhir_create("Flag", flag)
+        self.assertEqual(len(FHIR._find_resources(FHIR.get_participant("patient@email.org"), "Flag")), 2)
+
+        # Ensure updates to the participant's resources invalidate it
+        subject = FHIR._find_resource(bundle, "ResearchSubject")
+        FHIR.fhir_patch(
+            ["ResearchSubject", subject["id"]], [{"op": "replace", "path": "/status", "value": "withdrawn"}]
+        )
+        subject = FHIR._find_resource(FHIR.get_participant("patient@email.org"), "ResearchSubject")
+        self.assertEqual(subject["status"], "withdrawn")
+
+    def test_participant_cache_probe(self):
+        from ppmutils.fhir import ParticipantCache
+
+        # Cache a participant
+        FHIR.set_participant_cache(ParticipantCache(probe=True))
+        self.addCleanup(FHIR.set_participant_cache, None)
+        patient = self.load_participant("patient@email.org")
+        FHIR.get_participant("patient@email.org")
+
+        # Ensure only the probe is made while unchanged
+        with mock.patch.object(self.backend, "send", wraps=self.backend.send) as mock_send:
+            FHIR.get_participant("patient@email.org")
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(mock_send.call_args.args[0], "post")
+
+        # Ensure changes made elsewhere are detected
+        self.backend.load([FHIRData.enrollment_flag(f"Patient/{patient['id']}", PPM.Study.EXAMPLE)])
+        self.assertEqual(len(FHIR._find_resources(FHIR.get_participant("patient@email.org"), "Flag")), 2)
+
+    def test_reference_cache(self):
+        from ppmutils.fhir import ReferenceCache
+
+        # Preload the shared resources
+        FHIR.set_reference_cache(ReferenceCache(resource_types=FHIR.CONDITIONAL_READ_TYPES))
+        self.addCleanup(FHIR.set_reference_cache, None)
+        self.backend.load([FHIRData.research_study(PPM.Study.NEER)])
+        self.load_participant("patient@email.org")
+        self.assertEqual(FHIR.preload_reference_resources(), 1)
+
+        # Ensure the secondary fetch is skipped for a bundle missing the study
+        subject = self.backend._resources["ResearchSubject"]
+        bundle = {"resourceType": "Bundle", "entry": [{"resource": r} for r in subject.values()]}
+        with mock.patch.object(self.backend, "send", wraps=self.backend.send) as mock_send:
+            secondary_bundle = FHIR._get_participant_missing_resources(bundle)
+        mock_send.assert_not_called()
+        self.assertEqual(secondary_bundle["entry"][0]["resource"]["id"], PPM.Study.fhir_id(PPM.Study.NEER))
+
+        # Ensure other resources are not kept and writes invalidate them
+        self.assertIsNone(FHIR.reference_cache().get("ResearchSubject", next(iter(subject))))
+        study = FHIR.fhir_read("ResearchStudy", PPM.Study.fhir_id(PPM.Study.NEER))
+        study["title"] = "Updated"
+        FHIR.fhir_update("ResearchStudy", study["id"], study)
+        self.assertIsNone(FHIR.reference_cache().get("ResearchStudy", study["id"]))
+        self.assertEqual(FHIR._get_participant_missing_resources(bundle)["entry"][0]["resource"]["title"], "Updated")
+
+    def test_bundle_view(self):
+        from ppmutils.fhir import BundleView
+
+        # Load a participant and their study
+        self.backend.load([FHIRData.research_study(PPM.Study.NEER)])
+        patient = self.load_participant("patient@email.org")
+        bundle = FHIR.get_participant("patient@email.org")
+        view = BundleView(bundle)
+
+        # Ensure lookups match a walk of the bundle
+        self.assertEqual(view["entry"], bundle["entry"])
+        self.assertEqual(
+            FHIR.find_resources(view, ["Flag", "Patient"]), FHIR.find_resources(bundle, ["Flag", "Patient"])
+        )
+        self.assertEqual(FHIR._find_resources(view, "ResearchSubject"), FHIR._find_resources(bundle, "ResearchSubject"))
+        self.assertIs(
+            view.resource("Patient", patient["id"]), view.resource(f"{self.fhir_url}/Patient/{patient['id']}")
+        )
+        self.assertIsNone(view.resource("Patient", "missing"))
+
+        # Ensure reverse references are indexed
+        referrers = view.referencing(f"Patient/{patient['id']}")
+        self.assertEqual(sorted(r["resourceType"] for r in referrers), ["Flag", "ResearchSubject"])
+        self.assertEqual(len(view.referencing(f"Patient/{patient['id']}/_history/1", ["Flag"])), 1)
+
+        # Ensure flattening is unchanged
+        participant = FHIR.flatten_participant(bundle)
+        self.assertEqual(participant["email"], "patient@email.org")
+        self.assertEqual(participant["study"], PPM.Study.NEER.value)
+        self.assertEqual(FHIR.flatten_participant(view), participant)
+
+    def test_participant_missing_resources(self):
+
+        # Build a bundle with duplicate references, one of which is present
+        responses = [
+            {"resourceType": "QuestionnaireResponse", "id": str(i), "questionnaire": f"Questionnaire/{q}"}
+            for i, q in enumerate(["missing", "missing", "present"])
+        ]
+        resources = responses + [{"resourceType": "Questionnaire", "id": "present"}]
+        bundle = {"resourceType": "Bundle", "entry": [{"resource": r} for r in resources]}
+
+        # Ensure each missing resource is requested once
+        with mock.patch.object(FHIR, "fhir_transaction", return_value=None) as mock_transaction:
+            self.assertIsNone(FHIR._get_participant_missing_resources(bundle))
+        self.assertEqual(
+            mock_transaction.call_args[0][0]["entry"], [{"request": {"method": "GET", "url": "Questionnaire/missing"}}]
+        )
+
+    def test_bundle_view_models(self):
+        from ppmutils.fhir import BundleView, FHIRElementFactory
+
+        # Build a bundle with a questionnaire and its response
+        questionnaire_id = PPM.Questionnaire.NEERQuestionnaire.value
+        questionnaire = {
+            "resourceType": "Questionnaire",
+            "id": questionnaire_id,
+            "status": "active",
+            "item": [{"linkId": "question-1", "text": "Name?", "type": "string"}],
+        }
+        response = {
+            "resourceType": "QuestionnaireResponse",
+            "id": str(uuid.uuid4()),
+            "status": "completed",
+            "authored": "2020-01-01T00:00:00Z",
+            "questionnaire": f"Questionnaire/{questionnaire_id}",
+            "source": {"reference": "Patient/1"},
+            "item": [{"linkId": "question-1", "answer": [{"valueString": "Answer"}]}],
+        }
+        bundle = FHIRData.create_bundle([questionnaire, response], self.fhir_url)
+        view = BundleView(bundle)
+
+        # Ensure each resource is instantiated once across flattening steps
+        with mock.patch.object(
+            FHIRElementFactory, "instantiate", wraps=FHIRElementFactory.instantiate
+        ) as mock_instantiate:
+            flattened = FHIR.flatten_questionnaire_response(view, questionnaire_id)
+            self.assertEqual(FHIR.flatten_questionnaire_response(view, questionnaire_id), flattened)
+            self.assertIs(
+                view.model(view.resource("Questionnaire", questionnaire_id)), view.models(["Questionnaire"])[0]
+            )
+        self.assertEqual(mock_instantiate.call_count, 2)
+        self.assertEqual(FHIR.flatten_questionnaire_response(bundle, questionnaire_id), flattened)
+        self.assertEqual(list(flattened["responses"].values()), [["Answer"]])
+
+    def test_flatten_participant_fields(self):
+
+        # Load a participant and flatten their whole record
+        self.backend.load([FHIRData.research_study(PPM.Study.NEER)])
+        self.load_participant("patient@email.org")
+        bundle = FHIR.get_participant("patient@email.org")
+        participant = FHIR.flatten_participant(bundle)
+        self.assertIn("composition", participant)
+
+        # Ensure only requested sections are flattened
+        projected = FHIR.flatten_participant(bundle, fields=["enrollment"])
+        self.assertEqual(projected["email"], participant["email"])
+        self.assertEqual(projected["studies"], participant["studies"])
+        self.assertEqual(projected["enrollment"], participant["enrollment"])
+        self.assertNotIn("composition", projected)
+        self.assertRaises(ValueError, FHIR.flatten_participant, bundle, fields=["unknown"])
+
+        # Ensure lazy sections are flattened once, on first access
+        with mock.patch.object(
+            FHIR, "flatten_consent_composition", wraps=FHIR.flatten_consent_composition
+        ) as mock_composition:
+            lazy = FHIR.flatten_participant(bundle, lazy=True)
+            self.assertEqual(lazy["enrollment"], participant["enrollment"])
+            mock_composition.assert_not_called()
+            self.assertEqual(dict(lazy), participant)
+            self.assertEqual(lazy["composition"], participant["composition"])
+            mock_composition.assert_called_once()
+
+    def test_questionnaire_index(self):
+        from fhirclient.models.questionnaire import Questionnaire
+        from ppmutils.fhir import QuestionnaireIndex
+
+        # Build a questionnaire with nested, conditional and repeating items
+        data = {
+            "resourceType": "Questionnaire",
+            "id": "ppm-test-questionnaire",
+            "status": "active",
+            "meta": {"versionId": "1"},
+            "item": [
+                {"linkId": "question-1", "text": "First?", "type": "boolean"},
+                {
+                    "linkId": "question-2",
+                    "text": "Second",
+                    "type": "group",
+                    "repeats": True,
+                    "enableWhen": [{"question": "question-1", "operator": "=", "answerBoolean": True}],
+                    "item": [{"linkId": "question-2-1", "text": "Nested?", "type": "string", "required": True}],
+                },
+            ],
+        }
+        questionnaire = Questionnaire(data)
+        index = QuestionnaireIndex.of(questionnaire)
+
+        # Ensure lookups match a walk of the items
+        for link_id in ["question-1", "question-2", "question-2-1", "missing"]:
+            self.assertIs(index.item(link_id), FHIR.find_questionnaire_item(questionnaire.item, link_id))
+        self.assertEqual(
+            [i.linkId for i in FHIR.get_question_path(questionnaire, "question-2-1")], ["question-2", "question-2-1"]
+        )
+        self.assertEqual(FHIR.get_question_path(questionnaire, "missing"), [])
+        self.assertIs(FHIR.get_questionnaire_repeating_group(questionnaire, "question-2-1"), index.item("question-2"))
+        self.assertIsNone(FHIR.get_questionnaire_repeating_group(questionnaire, "question-1"))
+        self.assertTrue(FHIR.question_is_conditionally_enabled(questionnaire, "question-2-1"))
+        self.assertFalse(FHIR.question_is_conditionally_enabled(questionnaire, "question-1"))
+
+        # Ensure indexes are shared by version
+        self.assertIs(QuestionnaireIndex.of(Questionnaire(data)), index)
+        data["meta"]["versionId"] = "2"
+        self.assertIsNot(QuestionnaireIndex.of(Questionnaire(data)), index)
+        QuestionnaireIndex.clear()
+        self.assertIsNot(QuestionnaireIndex.of(questionnaire), index)
+
+    def test_questionnaire_enable_when(self):
+        from fhirclient.models.questionnaire import Questionnaire
+        from fhirclient.models.questionnaireresponse import QuestionnaireResponse
+        from ppmutils.fhir import QuestionnaireIndex
+
+        # Build a questionnaire using each kind of condition
+        def condition(question, operator, **answer):
+            return {"question": question, "operator": operator, **answer}
+
+        questionnaire = Questionnaire(
+            {
+                "resourceType": "Questionnaire",
+                "status": "active",
+                "item": [
+                    {
+                        "linkId": "question-0",
+                        "type": "string",
+                        "enableWhen": [condition("question-4", "exists", answerBoolean=True)],
+                    },
+                    {"linkId": "question-1", "type": "boolean"},
+                    {"linkId": "question-2", "type": "integer"},
+                    {
+                        "linkId": "question-3",
+                        "type": "string",
+                        "enableWhen": [condition("question-1", "exists", answerBoolean=True)],
+                    },
+                    {
+                        "linkId": "question-4",
+                        "type": "string",
+                        "enableWhen": [condition("question-1", "!=", answerBoolean=True)],
+                    },
+                    {
+                        "linkId": "question-5",
+                        "type": "group",
+                        "enableBehavior": "all",
+                        "enableWhen": [
+                            condition("question-2", ">=", answerInteger=18),
+                            condition("question-2", "<", answerInteger=65),
+                        ],
+                        "item": [
+                            {
+                                "linkId": "question-5-1",
+                                "type": "string",
+                                "required": True,
+                                "enableWhen": [condition("question-2", "<=", answerInteger=20)],
+                            }
+                        ],
+                    },
+                    {
+                        "linkId": "question-6",
+                        "type": "string",
+                        "enableBehavior": "any",
+                        "enableWhen": [
+                            condition("question-2", ">", answerInteger=100),
+                            condition("question-1", "=", answerBoolean=True),
+                        ],
+                    },
+                    {"linkId": "question-7", "type": "string", "repeats": True},
+                    {
+                        "linkId": "question-8",
+                        "type": "string",
+                        "enableWhen": [condition("question-7", "!=", answerString="a")],
+                    },
+                    {"linkId": "question-9", "type": "choice"},
+                    {
+                        "linkId": "question-10",
+                        "type": "string",
+                        "enableWhen": [condition("question-9", "=", answerCoding={"code": "yes"})],
+                    },
+                    {
+                        "linkId": "question-11",
+                        "type": "string",
+                        "enableWhen": [condition("question-9", "!=", answerCoding={"code": "yes"})],
+                    },
+                    {
+                        "linkId": "question-12",
+                        "type": "string",
+                        "enableWhen": [condition("question-9", "=", answerCoding={"system": "other", "code": "yes"})],
+                    },
+                ],
+            }
+        )
+        response = QuestionnaireResponse(
+            {
+                "resourceType": "QuestionnaireResponse",
+                "status": "completed",
+                "item": [
+                    {"linkId": "question-1", "answer": [{"valueBoolean": True}]},
+                    {"linkId": "question-2", "answer": [{"valueInteger": 30}]},
+                    {"linkId": "question-4", "answer": [{"valueString": "Leftover"}]},
+                    {"linkId": "question-7", "answer": [{"valueString": "a"}, {"valueString": "b"}]},
+                    {"linkId": "question-9", "answer": [{"valueCoding": {"system": "answers", "code": "yes"}}]},
+                ],
+            }
+        )
+
+        # Ensure items follow the questions they depend on
+        index = QuestionnaireIndex.of(questionnaire)
+        self.assertLess(index.order.index("question-4"), index.order.index("question-0"))
+        self.assertLess(index.order.index("question-5"), index.order.index("question-5-1"))
+
+        # Ensure every item is evaluated at once, ignoring answers to disabled questions
+        self.assertEqual(
+            index.enabled(response),
+            {
+                "question-0": False,
+                "question-1": True,
+                "question-2": True,
+                "question-3": True,
+                "question-4": False,
+                "question-5": True,
+                "question-5-1": False,
+                "question-6": True,
+                "question-7": True,
+                "question-8": False,
+                "question-9": True,
+                "question-10": True,
+                "question-11": False,
+                "question-12": False,
+            },
+        )
+
+        # Ensure single items are evaluated the same way
+        self.assertFalse(FHIR.questionnaire_response_is_enabled(questionnaire, response, "question-4"))
+        self.assertTrue(FHIR.questionnaire_response_is_enabled(questionnaire, response, "question-6"))
+        self.assertFalse(FHIR.questionnaire_response_is_required(questionnaire, response, "question-5-1"))
+
+    def test_search_dates_and_strings(self):
+
+        # Load patients with names and birth dates
+        self.backend.load(
+            [
+                {
+                    "resourceType": "Patient",
+                    "id": "patient-1",
+                    "birthDate": "1980-03-15",
+                    "name": [{"use": "official", "family": "Smith", "given": ["Ana"]}],
+                },
+                {
+                    "resourceType": "Patient",
+                    "id": "patient-2",
+                    "birthDate": "1990-12-01",
+                    "name": [{"use": "official", "family": "Smithers", "given": ["Bo"]}],
+                },
+            ]
+        )
+
+        def search(query):
+            bundle = FHIR.fhir_search(["Patient"], query)
+            return sorted(e["resource"]["id"] for e in bundle.get("entry", []))
+
+        # Ensure dates match by prefix and cover their precision
+        self.assertEqual(search({"birthdate": "1980"}), ["patient-1"])
+        self.assertEqual(search({"birthdate": "1990-12"}), ["patient-2"])
+        self.assertEqual(search({"birthdate": "gt1980-03-15"}), ["patient-2"])
+        self.assertEqual(search({"birthdate": "le1980-03-15"}), ["patient-1"])
+        self.assertEqual(search({"birthdate": "ne1980-03-15"}), ["patient-2"])
+
+        # Ensure strings match case-insensitively by prefix
+        self.assertEqual(search({"name": "smith"}), ["patient-1", "patient-2"])
+        self.assertEqual(search({"family": "SMITHE"}), ["patient-2"])
+        self.assertEqual(search({"given": "an"}), ["patient-1"])
+        self.assertEqual(search({"name:exact": "Smith"}), ["patient-1"])
+        self.assertEqual(search({"name:contains": "ther"}), ["patient-2"])
+        self.assertEqual(search({"name": "official"}), [])
+
+    def test_read_resources_deduplicated(self):
+
+        # Ensure repeated IDs are only searched for once
+        with mock.patch.object(FHIR, "_query_resources", return_value=[]) as mock_query:
+            FHIR._read_resources("Patient", ["patient-1", "patient-2", "patient-1"])
+        mock_query.assert_called_once_with("Patient", query={"_id": "patient-1,patient-2"})
+
 
 class FHIRData(object):
     """This class is used to manage the emulated data set from which to test
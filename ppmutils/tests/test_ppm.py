@@ -1,3 +1,5 @@
+import os
+import json
 import mock
 import unittest
 from furl import furl
@@ -169,3 +171,99 @@ class TestPPMService(unittest.TestCase):
             self.assertEqual(ppm_enum.enum(enum.value), enum)
             # Compare getters on title
             self.assertEqual(ppm_enum.enum(ppm_enum.title(enum)), enum)
+
+    def test_ppm_questionnaire_meta_1(self):
+
+        # Compare methods for determining questionnaire meta
+        ppm_enum = PPM.Questionnaire
+        for enum in ppm_enum:
+            # Compare getters on name
+            self.assertEqual(ppm_enum.enum(enum.name), enum)
+            # Compare getters on value
+            self.assertEqual(ppm_enum.enum(enum.value), enum)
+
+        # Compare getters on title, ignoring case
+        enum = PPM.Questionnaire.NEERQuestionnaire
+        self.assertEqual(ppm_enum.enum(ppm_enum.title(enum)), enum)
+        self.assertEqual(ppm_enum.enum(ppm_enum.title(enum).upper()), enum)
+
+        # Check edge cases
+        self.assertRaises(ValueError, ppm_enum.enum, "garbage")
+        self.assertRaises(ValueError, ppm_enum.enum, {"unhashable": True})
+        self.assertRaises(ValueError, PPM.Enrollment.enum, "queue")
+
+    def test_ppm_questionnaire_qualtrics_1(self):
+
+        # Set a mapping with a duplicate survey ID across studies
+        surveys = {
+            "neer": [{"survey_id": "SV_1", "questionnaire_id": "ppm-neer-risc-questionnaire"}],
+            "asd": [
+                {"survey_id": "SV_1", "questionnaire_id": "ppm-asd-questionnaire"},
+                {"survey_id": "SV_2", "questionnaire_id": "ppm-asd-questionnaire"},
+            ],
+        }
+        with mock.patch.dict(os.environ, {"SOURCE_QUALTRICS_SURVEYS": json.dumps(surveys)}):
+            ppm_enum = PPM.Questionnaire
+
+            # Check lookups in both directions, the first mapping wins
+            self.assertEqual(ppm_enum.qualtrics_survey_ids(), surveys)
+            self.assertEqual(ppm_enum.questionnaire_id_for_qualtrics_id("SV_1"), "ppm-neer-risc-questionnaire")
+            self.assertEqual(ppm_enum.questionnaire_id_for_qualtrics_id("SV_2"), "ppm-asd-questionnaire")
+            self.assertEqual(ppm_enum.qualtrics_id_for_questionnaire_id("ppm-asd-questionnaire"), "SV_1")
+            self.assertIsNone(ppm_enum.questionnaire_id_for_qualtrics_id("SV_3"))
+            self.assertEqual(
+                ppm_enum.qualtrics_survey_ids_for_study(PPM.Study.ASD),
+                {"SV_1": "ppm-asd-questionnaire", "SV_2": "ppm-asd-questionnaire"},
+            )
+
+            # Returned mappings are copies
+            ppm_enum.qualtrics_survey_ids()["neer"].clear()
+            self.assertEqual(ppm_enum.qualtrics_survey_ids(), surveys)
+
+            # Changes to the environment are picked up
+            os.environ["SOURCE_QUALTRICS_SURVEYS"] = json.dumps({"neer": surveys["neer"]})
+            self.assertIsNone(ppm_enum.questionnaire_id_for_qualtrics_id("SV_2"))
+
+            # Malformed mappings are dropped rather than raised
+            os.environ["SOURCE_QUALTRICS_SURVEYS"] = json.dumps({"neer": ["SV_1"]})
+            self.assertEqual(ppm_enum.qualtrics_survey_ids(), {})
+            self.assertIsNone(ppm_enum.questionnaire_id_for_qualtrics_id("SV_1"))
+
+    @mock.patch("ppmutils.ppm.settings", new_callable=mock.Mock)
+    def test_ppm_is_tester_1(self, mock_settings):
+
+        # Set patterns as a string
+        mock_settings.TEST_EMAIL_PATTERNS = r"^.*@example\.com$,^tester\+.*@"
+        self.assertTrue(PPM.is_tester("someone@example.com"))
+        self.assertTrue(PPM.is_tester("tester+1@ppm.org"))
+        self.assertFalse(PPM.is_tester("someone@ppm.org"))
+        self.assertEqual(
+            PPM.classify_testers(["someone@example.com", "someone@ppm.org"]),
+            {"someone@example.com": True, "someone@ppm.org": False},
+        )
+
+        # Changes to the setting are picked up, including those that can not be combined
+        mock_settings.TEST_EMAIL_PATTERNS = [r"(?i)^.*@PPM\.ORG$", r"^(\w)\1@"]
+        self.assertTrue(PPM.is_tester("someone@ppm.org"))
+        self.assertTrue(PPM.is_tester("aa@test.org"))
+        self.assertFalse(PPM.is_tester("someone@example.com"))
+
+        # Patterns with plain groups are combined, those with backreferences are not
+        mock_settings.TEST_EMAIL_PATTERNS = [
+            r"^.*@(hms|dbmi)\.harvard\.edu$",
+            r"^.*@example\.com$",
+            r"^(\w)\1@",
+            r"(?i)^.*@PPM\.ORG$",
+        ]
+        self.assertEqual(len(PPM.tester_patterns()), 3)
+        self.assertEqual(PPM.tester_patterns()[0].pattern, r"(?:^.*@(hms|dbmi)\.harvard\.edu$)|(?:^.*@example\.com$)")
+        self.assertTrue(PPM.is_tester("someone@dbmi.harvard.edu"))
+        self.assertTrue(PPM.is_tester("someone@example.com"))
+        self.assertTrue(PPM.is_tester("bb@test.org"))
+        self.assertTrue(PPM.is_tester("someone@ppm.org"))
+        self.assertFalse(PPM.is_tester("someone@harvard.edu"))
+
+        # No patterns set
+        del mock_settings.TEST_EMAIL_PATTERNS
+        self.assertFalse(PPM.is_tester("someone@example.com"))
+        self.assertEqual(PPM.classify_testers(["someone@example.com"]), {"someone@example.com": False})